@@ -0,0 +1,1031 @@
+"""
+Python script for benchmarking the data pre-processing and grid computation methods on synthetic crowds
+"""
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import timeit
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import torch
+
+from data_pipeline import SequenceDataset, SequenceIndex, SequenceTensors, collate_sequences
+from grid import (GridMaskUpdater, getBatchGridMask, getGridIndices, getGridMask, getNeighborCandidates,
+                  getOccupancyMap, getSequenceGridMask, getSocialTensor)
+from grid_cache import GridMaskCache
+from tiling import SceneTiler
+from helper import Gaussian2DLikelihoodMasked, vectorize_seq
+from preprocessing import group_frames, preprocess_files, read_test_file, split_frames, stream_file
+from trajectory_store import StoreWriter, TrajectoryStore, write_store
+from utils import DataLoader
+from vlstm_inference import VLSTMInference
+from vlstm_model import VLSTMModel
+
+
+def get_parser_args():
+    parser = argparse.ArgumentParser()
+    # Benchmark to be run
+    parser.add_argument('--target', type=str, default='frame_preprocess',
+                        help='Benchmark to run (frame_preprocess, preprocess_files, test_reader, streaming, '
+                             'sequence_tensors, bucketing, grid_mask, sparse_grid, neighbor_search, sequence_grid, '
+                             'grid_cache, grid_updater, occupancy, max_neighbors, tiling, batched_forward, '
+                             'fused_rnn, inference)')
+    # Number of rows of the synthetic trajectory files
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 2000, 4000, 8000, 16000],
+                        help='Row counts of the synthetic trajectory files')
+    # Number of pedestrians present in each frame of the synthetic files
+    parser.add_argument('--peds_per_frame', type=int, default=10,
+                        help='Number of pedestrians in each frame of the synthetic files')
+    # Number of repetitions for each measurement
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of repetitions, the best time is reported')
+    # Skip the reference (slow) implementation for large inputs
+    parser.add_argument('--max_reference_rows', type=int, default=16000,
+                        help='Largest row count the reference implementation is timed on')
+    # Number of synthetic files for the multi-file benchmarks
+    parser.add_argument('--num_files', type=int, default=8,
+                        help='Number of synthetic trajectory files')
+    # Worker process counts for the multi-file benchmarks
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help='Numbers of worker processes to compare')
+    # Sequence length of the sequence benchmarks
+    parser.add_argument('--seq_length', type=int, default=20,
+                        help='Number of frames of a sequence')
+    # Number of epochs of the sequence benchmarks
+    parser.add_argument('--epochs', type=int, default=3,
+                        help='Number of epochs the sequences are read for')
+    # Block size of the streaming pre-processing
+    parser.add_argument('--chunk_rows', type=int, default=100000,
+                        help='Number of rows read at once by the streaming pre-processing')
+    # Batch size of the batching benchmarks
+    parser.add_argument('--batch_size', type=int, default=16,
+                        help='Number of sequences of a batch')
+    # Bucket boundaries of the bucketing benchmark
+    parser.add_argument('--bucket_boundaries', type=int, nargs='+', default=[4, 8, 12, 16, 24],
+                        help='Ped counts separating the buckets of the batches')
+    # Number of pedestrians of the frames of the grid benchmarks
+    parser.add_argument('--peds', type=int, nargs='+', default=[5, 10, 20, 50, 100, 200],
+                        help='Numbers of pedestrians in a frame')
+    # Grid parameters of the grid benchmarks
+    parser.add_argument('--neighborhood_size', type=int, default=32,
+                        help='Neighborhood size of the grid')
+    parser.add_argument('--grid_size', type=int, default=4,
+                        help='Grid size of the grid')
+    # Neighbor caps of the max_neighbors benchmark
+    parser.add_argument('--max_neighbors', type=int, nargs='+', default=[0, 1, 2, 4, 8, 16],
+                        help='Numbers of nearest neighbors kept in the grid of each ped (0: all neighbors)')
+    # Tile side of the tiling benchmark
+    parser.add_argument('--tile_size', type=int, default=256,
+                        help='Side of the tiles, in the units of the neighborhood size')
+
+    return parser.parse_args()
+
+
+def synthetic_trajectories(num_rows, peds_per_frame, seed=0):
+    """
+    Create a random walk trajectory file content ordered by ped id, like the herms files
+    :param num_rows: number of rows of the file
+    :param peds_per_frame: number of peds in each frame
+    :param seed:
+    :return: array of shape num_rows x 4, each row being [frame_num, ped_id, y, x]
+    """
+    rng = np.random.RandomState(seed)
+    num_frames = max(1, num_rows // peds_per_frame)
+    frame_num = np.tile(np.arange(num_frames), peds_per_frame)[:num_rows]
+    ped_id = np.repeat(np.arange(1, peds_per_frame + 1), num_frames)[:num_rows]
+    steps = rng.normal(0, 0.1, size=(num_rows, 2))
+    positions = np.cumsum(steps, axis=0)
+    return np.column_stack((frame_num, ped_id, positions)).astype(np.float64)
+
+
+def synthetic_crowd(num_rows, max_peds, track_length=40, seed=0):
+    """
+    Create a random walk trajectory file content ordered by ped id, whose crowd density varies between about one
+    and max_peds peds per frame along the file
+    :param num_rows: number of rows of the file
+    :param max_peds: number of peds per frame in the densest frames
+    :param track_length: number of frames each ped is present in
+    :param seed:
+    :return: array of shape num_rows x 4, each row being [frame_num, ped_id, y, x]
+    """
+    rng = np.random.RandomState(seed)
+    num_peds = max(1, num_rows // track_length)
+    num_frames = max(1, num_peds * track_length // ((max_peds + 1) // 2))
+    # start frames drawn from a density going up and down several times along the file
+    density = 1.05 + np.sin(np.linspace(0, 6 * np.pi, num_frames))
+    first_frame = np.sort(rng.choice(num_frames, size=num_peds, p=density / density.sum()))
+
+    frame_num = (first_frame[:, None] + np.arange(track_length)[None]).reshape(-1)[:num_rows]
+    ped_id = np.repeat(np.arange(1, num_peds + 1), track_length)[:num_rows]
+    positions = np.cumsum(rng.normal(0, 0.1, size=(len(frame_num), 2)), axis=0)
+    return np.column_stack((frame_num, ped_id, positions)).astype(np.float64)
+
+
+def write_synthetic_files(path, num_files, num_rows, peds_per_frame):
+    """
+    Write synthetic trajectory files in the tab separated format of the data directory
+    :param path: directory of the files
+    :param num_files:
+    :param num_rows: number of rows of each file
+    :param peds_per_frame:
+    :return: list of file paths
+    """
+    file_names = []
+    for index in range(num_files):
+        file_name = os.path.join(path, 'synthetic_%d.txt' % index)
+        data = synthetic_trajectories(num_rows, peds_per_frame, seed=index)
+        np.savetxt(file_name, data, delimiter='\t', fmt='%d\t%d\t%.4f\t%.4f')
+        file_names.append(file_name)
+    return file_names
+
+
+def write_synthetic_test_file(file_name, num_rows, peds_per_frame, obs_length=8, pred_length=12):
+    """
+    Write a synthetic test file: for each ped, the positions after the observed part are written as '?'
+    :param file_name:
+    :param num_rows:
+    :param peds_per_frame:
+    :param obs_length:
+    :param pred_length:
+    :return:
+    """
+    data = synthetic_trajectories(num_rows, peds_per_frame)
+    unknown = np.arange(num_rows) % (obs_length + pred_length) >= obs_length
+    with open(file_name, 'w') as f:
+        for row, is_unknown in zip(data, unknown):
+            if is_unknown:
+                f.write('%d\t%d\t?\t?\n' % (row[0], row[1]))
+            else:
+                f.write('%d\t%d\t%.4f\t%.4f\n' % tuple(row))
+
+
+def reference_read_test_file(file_name):
+    """
+    Read a test file with a python converter per cell, kept as reference
+    :param file_name:
+    :return: dataframe, target ped ids
+    """
+    column_names = ['frame_num', 'ped_id', 'y', 'x']
+    df = pd.read_csv(file_name, dtype={'frame_num': 'int', 'ped_id': 'int'}, delimiter='\t', header=None,
+                     names=column_names,
+                     converters={c: lambda x: float('nan') if x == '?' else float(x) for c in ['y', 'x']})
+    target_ids = np.array(df[df['y'].isnull()].drop_duplicates(subset=['ped_id'], keep='first')['ped_id'])
+    return df, target_ids
+
+
+def reference_frame_preprocess(data):
+    """
+    Scan based frame grouping (one boolean scan per row and per ped) kept as reference
+    :param data: array of shape num_rows x 4, each row being [frame_num, ped_id, y, x]
+    :return: list of arrays of shape numPeds x 3 (one per row), list of ped lists
+    """
+    data = np.swapaxes(data, 0, 1)
+    frame_data = []
+    peds_data = []
+    for frame in data[0, :].tolist():
+        pedsInFrame = data[:, data[0, :] == frame]
+        pedsList = pedsInFrame[1, :].tolist()
+        pedsWithPos = []
+        for ped in pedsList:
+            current_x = pedsInFrame[3, pedsInFrame[1, :] == ped][0]
+            current_y = pedsInFrame[2, pedsInFrame[1, :] == ped][0]
+            pedsWithPos.append([ped, current_x, current_y])
+        frame_data.append(np.array(pedsWithPos))
+        peds_data.append(pedsList)
+    return frame_data, peds_data
+
+
+def grouped_frame_preprocess(data):
+    """
+    Sort and split frame grouping, same output as reference_frame_preprocess
+    :param data: array of shape num_rows x 4, each row being [frame_num, ped_id, y, x]
+    :return: list of arrays of shape numPeds x 3 (one per row), list of ped lists
+    """
+    frame_rows, frame_offsets, row_frames = group_frames(data)
+    frames = split_frames(frame_rows, frame_offsets)
+    frames_pedsList = [frame[:, 0].tolist() for frame in frames]
+    return [frames[frame] for frame in row_frames], [frames_pedsList[frame] for frame in row_frames]
+
+
+def traced_peak(function):
+    """
+    Run a function and return its wall time and the peak of the memory allocated meanwhile (numpy buffers included)
+    :param function:
+    :return: time in seconds, peak in bytes
+    """
+    tracemalloc.start()
+    start = timeit.default_timer()
+    function()
+    elapsed = timeit.default_timer() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def reference_dense_sequence(frames, pedsList, seq_length):
+    """
+    Per sequence dense conversion (DataLoader.convert_proper_array followed by vectorize_seq) kept as reference
+    :param frames: list of arrays of shape numPeds x 3
+    :param pedsList: ped ids of each frame
+    :param seq_length:
+    :return: x_seq, vectorized x_seq, lookup table
+    """
+    unique_ids = pd.unique(np.concatenate(pedsList).ravel()).astype(int)
+    lookup_table = dict(zip(unique_ids, range(0, len(unique_ids))))
+    seq_data = np.zeros(shape=(seq_length, len(lookup_table), 2))
+    for ind, frame in enumerate(frames):
+        corr_index = [lookup_table[x] for x in frame[:, 0]]
+        seq_data[ind, corr_index, :] = frame[:, 1:3]
+    x_seq = torch.from_numpy(seq_data).float()
+    vectorized_x_seq, _ = vectorize_seq(x_seq, pedsList, lookup_table)
+    return x_seq, vectorized_x_seq, lookup_table
+
+
+def reference_grid_mask(frame, dimensions, num_person, neighborhood_size, grid_size, is_occupancy=False):
+    """
+    Loop over the 2-permutations of the peds of a frame (grid.getGridMask before vectorization) kept as reference
+    :param frame: tensor of shape MNP x 2
+    :param dimensions: [width, height]
+    :param num_person:
+    :param neighborhood_size:
+    :param grid_size:
+    :param is_occupancy:
+    :return:
+    """
+    mnp = num_person
+    width, height = dimensions[0], dimensions[1]
+    if is_occupancy:
+        frame_mask = np.zeros((mnp, grid_size ** 2))
+    else:
+        frame_mask = np.zeros((mnp, mnp, grid_size ** 2))
+    frame_np = frame.data.numpy()
+    width_bound, height_bound = (neighborhood_size / (width * 1.0)) * 2, (neighborhood_size / (height * 1.0)) * 2
+
+    for real_frame_index, other_real_frame_index in itertools.permutations(range(mnp), 2):
+        current_x, current_y = frame_np[real_frame_index, 0], frame_np[real_frame_index, 1]
+        width_low, width_high = current_x - width_bound / 2, current_x + width_bound / 2
+        height_low, height_high = current_y - height_bound / 2, current_y + height_bound / 2
+        other_x, other_y = frame_np[other_real_frame_index, 0], frame_np[other_real_frame_index, 1]
+        if (other_x >= width_high) or (other_x < width_low) or (other_y >= height_high) or (other_y < height_low):
+            continue
+        cell_x = int(np.floor(((other_x - width_low) / width_bound) * grid_size))
+        cell_y = int(np.floor(((other_y - height_low) / height_bound) * grid_size))
+        if cell_x >= grid_size or cell_x < 0 or cell_y >= grid_size or cell_y < 0:
+            continue
+        if is_occupancy:
+            frame_mask[real_frame_index, cell_x + cell_y * grid_size] = 1
+        else:
+            frame_mask[real_frame_index, other_real_frame_index, cell_x + cell_y * grid_size] = 1
+    return frame_mask
+
+
+def synthetic_frame(num_peds, neighborhood_bound, seed=0, snap=None):
+    """
+    Create the positions of the peds of a frame, about four peds per neighborhood
+    :param num_peds:
+    :param neighborhood_bound: side of a neighborhood in the frame coordinates
+    :param seed:
+    :param snap: if given, the positions are rounded to multiples of snap, putting peds on the cell borders
+    :return: tensor of shape num_peds x 2
+    """
+    rng = np.random.RandomState(seed)
+    positions = rng.uniform(0, neighborhood_bound * max(1.0, np.sqrt(num_peds / 4.0)), size=(num_peds, 2))
+    if snap is not None:
+        positions = np.round(positions / snap) * snap
+    return torch.from_numpy(positions).float()
+
+
+def crowd_sequence_tensors(path, args):
+    """
+    Write a synthetic crowd file of args.rows[0] rows in a directory and build the tensors of its shuffled sequences
+    :param path: directory of the files
+    :param args:
+    :return: SequenceIndex and SequenceTensors of the sequences
+    """
+    file_name = os.path.join(path, 'crowd.txt')
+    np.savetxt(file_name, synthetic_crowd(args.rows[0], args.peds_per_frame), delimiter='\t',
+               fmt='%d\t%d\t%.4f\t%.4f')
+    store_path = os.path.join(path, 'crowd.store')
+    write_store(store_path, '', preprocess_files([file_name], {'test_format': False, 'val_fraction': 0}))
+    frames = TrajectoryStore(store_path).frame_sequence(0)
+    index = SequenceIndex([len(frames)], args.seq_length, shuffle=True)
+    return index, SequenceTensors.build([frames], index, args.seq_length)
+
+
+def best_time(function, repeat):
+    """
+    Best wall time of a function over the repetitions
+    :param function:
+    :param repeat:
+    :return:
+    """
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def benchmark_frame_preprocess(args):
+    """
+    Compare scan based and sort based frame grouping for increasing row counts
+    :param args:
+    :return:
+    """
+    print('{:>10} {:>15} {:>15} {:>10}'.format('rows', 'reference (s)', 'grouped (s)', 'speedup'))
+    for num_rows in args.rows:
+        data = synthetic_trajectories(num_rows, args.peds_per_frame)
+        grouped_time = best_time(lambda: grouped_frame_preprocess(data), args.repeat)
+
+        if num_rows > args.max_reference_rows:
+            print('{:>10} {:>15} {:>15.4f} {:>10}'.format(num_rows, '-', grouped_time, '-'))
+            continue
+
+        reference_frames, reference_peds = reference_frame_preprocess(data)
+        grouped_frames, grouped_peds = grouped_frame_preprocess(data)
+        assert reference_peds == grouped_peds
+        assert all(np.array_equal(ref, grp) for ref, grp in zip(reference_frames, grouped_frames))
+
+        reference_time = best_time(lambda: reference_frame_preprocess(data), args.repeat)
+        print('{:>10} {:>15.4f} {:>15.4f} {:>10.1f}'.format(num_rows, reference_time, grouped_time,
+                                                             reference_time / grouped_time))
+
+
+def benchmark_preprocess_files(args):
+    """
+    Pre-process a set of synthetic files with increasing numbers of worker processes
+    :param args:
+    :return:
+    """
+    params = {'test_format': False, 'val_fraction': 0}
+    path = tempfile.mkdtemp()
+    try:
+        print('{:>10} {:>10} {:>10} {:>15} {:>10}'.format('files', 'rows', 'workers', 'time (s)', 'speedup'))
+        for num_rows in args.rows:
+            file_names = write_synthetic_files(path, args.num_files, num_rows, args.peds_per_frame)
+            base_time = None
+            for workers in args.workers:
+                elapsed = best_time(lambda: preprocess_files(file_names, params, workers), args.repeat)
+                base_time = base_time or elapsed
+                print('{:>10} {:>10} {:>10} {:>15.4f} {:>10.1f}'.format(args.num_files, num_rows, workers, elapsed,
+                                                                      base_time / elapsed))
+    finally:
+        shutil.rmtree(path)
+
+
+def benchmark_test_reader(args):
+    """
+    Compare the converter based and the C parser based test file readers for increasing row counts
+    :param args:
+    :return:
+    """
+    path = tempfile.mkdtemp()
+    try:
+        print('{:>10} {:>15} {:>15} {:>10}'.format('rows', 'reference (s)', 'C parser (s)', 'speedup'))
+        for num_rows in args.rows:
+            file_name = os.path.join(path, 'synthetic_test.txt')
+            write_synthetic_test_file(file_name, num_rows, args.peds_per_frame)
+
+            reference_df, reference_targets = reference_read_test_file(file_name)
+            df, target_ids = read_test_file(file_name)
+            assert np.array_equal(reference_targets, target_ids)
+            assert np.allclose(np.array(reference_df), np.array(df), atol=1e-6, equal_nan=True)
+
+            reference_time = best_time(lambda: reference_read_test_file(file_name), args.repeat)
+            parser_time = best_time(lambda: read_test_file(file_name), args.repeat)
+            print('{:>10} {:>15.4f} {:>15.4f} {:>10.1f}'.format(num_rows, reference_time, parser_time,
+                                                                 reference_time / parser_time))
+    finally:
+        shutil.rmtree(path)
+
+
+def benchmark_streaming(args):
+    """
+    Compare the time and peak memory of the whole file and of the streaming pre-processing of one file
+    :param args:
+    :return:
+    """
+    params = {'test_format': False, 'val_fraction': 0}
+    path = tempfile.mkdtemp()
+    memory_store = os.path.join(path, 'memory.store')
+    streaming_store = os.path.join(path, 'streaming.store')
+
+    def streaming_preprocess(file_name):
+        writer = StoreWriter(streaming_store, '')
+        stream_file(file_name, params, writer, args.chunk_rows)
+        writer.close()
+
+    try:
+        print('{:>10} {:>15} {:>15} {:>15} {:>15}'.format('rows', 'memory (s)', 'memory (MB)', 'streaming (s)',
+                                                            'streaming (MB)'))
+        for num_rows in args.rows:
+            file_name = write_synthetic_files(path, 1, num_rows, args.peds_per_frame)[0]
+            memory_time, memory_peak = traced_peak(
+                lambda: write_store(memory_store, '', preprocess_files([file_name], params)))
+            streaming_time, streaming_peak = traced_peak(lambda: streaming_preprocess(file_name))
+
+            # same entries whatever the order the frames are stored in
+            memory, streaming = TrajectoryStore(memory_store), TrajectoryStore(streaming_store)
+            assert np.array_equal(memory.get('orig_data', 0), streaming.get('orig_data', 0))
+            assert np.array_equal(memory.get('target_ids', 0), streaming.get('target_ids', 0))
+            for memory_frame, streaming_frame in zip(memory.frame_sequence(0), streaming.frame_sequence(0)):
+                assert np.array_equal(memory_frame, streaming_frame)
+
+            print('{:>10} {:>15.4f} {:>15.1f} {:>15.4f} {:>15.1f}'.format(num_rows, memory_time, memory_peak / 1e6,
+                                                                         streaming_time, streaming_peak / 1e6))
+    finally:
+        shutil.rmtree(path)
+
+
+def benchmark_sequence_tensors(args):
+    """
+    Compare the per epoch dense conversion of all the sequences with the tensors built once and read every epoch
+    :param args:
+    :return:
+    """
+    params = {'test_format': False, 'val_fraction': 0}
+    path = tempfile.mkdtemp()
+    try:
+        print('{:>10} {:>10} {:>15} {:>15} {:>10}'.format('rows', 'sequences', 'reference (s)', 'tensors (s)',
+                                                           'speedup'))
+        for num_rows in args.rows:
+            file_name = write_synthetic_files(path, 1, num_rows, args.peds_per_frame)[0]
+            store_path = os.path.join(path, 'synthetic.store')
+            write_store(store_path, '', preprocess_files([file_name], params))
+            store = TrajectoryStore(store_path)
+            frames, pedsList = store.frame_sequence(0), store.frame_sequence(0, column=0)
+            index = SequenceIndex([len(frames)], args.seq_length)
+
+            def reference_epochs():
+                for _ in range(args.epochs):
+                    for dataset, start in (index[position] for position in range(len(index))):
+                        reference_dense_sequence(frames[start:start + args.seq_length],
+                                                 pedsList[start:start + args.seq_length], args.seq_length)
+
+            def tensors_epochs():
+                tensors = SequenceTensors.build([frames], index, args.seq_length)
+                for _ in range(args.epochs):
+                    for position in range(len(index)):
+                        tensors.get(index.window(position))
+
+            tensors = SequenceTensors.build([frames], index, args.seq_length)
+            for position in range(len(index)):
+                _, start = index[position]
+                reference = reference_dense_sequence(frames[start:start + args.seq_length],
+                                                     pedsList[start:start + args.seq_length], args.seq_length)
+                x_seq, vectorized_x_seq, lookup_table, _ = tensors.get(index.window(position))
+                assert torch.equal(reference[0], x_seq) and torch.equal(reference[1], vectorized_x_seq)
+                assert reference[2] == lookup_table
+
+            reference_time = best_time(reference_epochs, args.repeat)
+            tensors_time = best_time(tensors_epochs, args.repeat)
+            print('{:>10} {:>10} {:>15.4f} {:>15.4f} {:>10.1f}'.format(num_rows, len(index), reference_time,
+                                                                      tensors_time, reference_time / tensors_time))
+    finally:
+        shutil.rmtree(path)
+
+
+def benchmark_bucketing(args):
+    """
+    Compare the padding and the throughput of padded batches of shuffled sequences with and without bucketing them
+    by ped count. The padded execution of a batch is an LSTM cell run over all the [B, Nmax] slots of each frame,
+    the fill is the fraction of these slots holding a ped of the sequence
+    :param args:
+    :return:
+    """
+    params = {'test_format': False, 'val_fraction': 0}
+    cell = torch.nn.LSTMCell(2, 128)
+    path = tempfile.mkdtemp()
+
+    def padded_epoch(tensors, index, batches):
+        used_slots, padded_slots = 0, 0
+        with torch.no_grad():
+            for batch in batches:
+                sequence_batch = collate_sequences(tensors, index, batch)
+                batch_size, seq_length, max_peds, _ = sequence_batch.relative.shape
+                hidden = torch.zeros(batch_size * max_peds, 128), torch.zeros(batch_size * max_peds, 128)
+                for frame in range(seq_length):
+                    hidden = cell(sequence_batch.relative[:, frame].reshape(-1, 2), hidden)
+                used_slots += int(sequence_batch.num_peds.sum())
+                padded_slots += batch_size * max_peds
+        return used_slots, padded_slots
+
+    try:
+        print('{:>10} {:>10} {:>12} {:>15} {:>15} {:>15} {:>15}'.format(
+            'rows', 'sequences', 'peds range', 'plain fill', 'bucketed fill', 'plain (seq/s)', 'bucketed (seq/s)'))
+        for num_rows in args.rows:
+            file_name = os.path.join(path, 'crowd.txt')
+            np.savetxt(file_name, synthetic_crowd(num_rows, args.peds_per_frame), delimiter='\t',
+                       fmt='%d\t%d\t%.4f\t%.4f')
+            store_path = os.path.join(path, 'crowd.store')
+            write_store(store_path, '', preprocess_files([file_name], params))
+            frames = TrajectoryStore(store_path).frame_sequence(0)
+            index = SequenceIndex([len(frames)], args.seq_length, shuffle=True)
+            tensors = SequenceTensors.build([frames], index, args.seq_length)
+            num_peds = tensors.num_peds()
+
+            plain_batches = index.batches(args.batch_size)
+            bucketed_batches = index.bucket_batches(args.batch_size, num_peds, args.bucket_boundaries)
+            # both batchings hold every sequence once
+            assert np.array_equal(np.sort(np.concatenate(bucketed_batches)), np.arange(len(index)))
+
+            plain_used, plain_padded = padded_epoch(tensors, index, plain_batches)
+            bucketed_used, bucketed_padded = padded_epoch(tensors, index, bucketed_batches)
+            plain_time = best_time(lambda: padded_epoch(tensors, index, plain_batches), args.repeat)
+            bucketed_time = best_time(lambda: padded_epoch(tensors, index, bucketed_batches), args.repeat)
+            print('{:>10} {:>10} {:>12} {:>15.3f} {:>15.3f} {:>15.1f} {:>15.1f}'.format(
+                num_rows, len(index), '%d-%d' % (num_peds.min(), num_peds.max()), plain_used / plain_padded,
+                bucketed_used / bucketed_padded, len(index) / plain_time, len(index) / bucketed_time))
+    finally:
+        shutil.rmtree(path)
+
+
+def benchmark_grid_mask(args):
+    """
+    Compare the 2-permutations loop and the vectorized grid mask of one frame for increasing ped counts, in social
+    and occupancy modes
+    :param args:
+    :return:
+    """
+    dimensions = [1000, 1000]
+    neighborhood_bound = args.neighborhood_size / float(dimensions[0]) * 2
+    print('{:>10} {:>10} {:>15} {:>15} {:>10}'.format('peds', 'mode', 'reference (s)', 'vectorized (s)', 'speedup'))
+    for num_peds in args.peds:
+        frames = [synthetic_frame(num_peds, neighborhood_bound, seed) for seed in range(3)]
+        frames.append(synthetic_frame(num_peds, neighborhood_bound, snap=neighborhood_bound / args.grid_size))
+        for is_occupancy in [False, True]:
+            grid_args = (dimensions, num_peds, args.neighborhood_size, args.grid_size, is_occupancy)
+            for frame in frames:
+                assert np.array_equal(reference_grid_mask(frame, *grid_args), getGridMask(frame, *grid_args))
+
+            reference_time = best_time(lambda: reference_grid_mask(frames[0], *grid_args), args.repeat)
+            vectorized_time = best_time(lambda: getGridMask(frames[0], *grid_args), args.repeat)
+            print('{:>10} {:>10} {:>15.5f} {:>15.5f} {:>10.1f}'.format(
+                num_peds, 'occupancy' if is_occupancy else 'social', reference_time, vectorized_time,
+                reference_time / vectorized_time))
+
+
+def benchmark_sparse_grid(args):
+    """
+    Compare the memory of the dense and sparse grids of one frame and the social pooling of hidden states from them,
+    for increasing ped counts
+    :param args:
+    :return:
+    """
+    dimensions = [1000, 1000]
+    neighborhood_bound = args.neighborhood_size / float(dimensions[0]) * 2
+    rnn_size = 128
+    print('{:>10} {:>10} {:>15} {:>15} {:>15} {:>15}'.format('peds', 'pairs', 'dense (MB)', 'sparse (MB)',
+                                                             'dense pool (s)', 'sparse pool (s)'))
+    for num_peds in args.peds:
+        frame = synthetic_frame(num_peds, neighborhood_bound)
+        grid_args = (dimensions, num_peds, args.neighborhood_size, args.grid_size)
+        dense_grid = torch.from_numpy(getGridMask(frame, *grid_args)).float()
+        grid_indices = torch.from_numpy(getGridIndices(frame, *grid_args))
+        hidden_states = torch.randn(num_peds, rnn_size)
+
+        def dense_pooling():
+            # social tensor of ped i: transposed grid mask of ped i times the hidden states
+            return torch.einsum('ijc,jh->ich', dense_grid, hidden_states).reshape(num_peds, -1)
+
+        def sparse_pooling():
+            return getSocialTensor(grid_indices, hidden_states, args.grid_size)
+
+        # the dense mask holds exactly the triples
+        assert torch.equal(torch.nonzero(dense_grid), grid_indices)
+        assert torch.allclose(dense_pooling(), sparse_pooling(), atol=1e-5)
+
+        dense_time = best_time(dense_pooling, args.repeat)
+        sparse_time = best_time(sparse_pooling, args.repeat)
+        print('{:>10} {:>10} {:>15.3f} {:>15.3f} {:>15.5f} {:>15.5f}'.format(
+            num_peds, len(grid_indices), dense_grid.element_size() * dense_grid.nelement() / 1e6,
+            grid_indices.element_size() * grid_indices.nelement() / 1e6, dense_time, sparse_time))
+
+
+def benchmark_neighbor_search(args):
+    """
+    Compare the sparse grid of one frame computed by testing all the ped pairs and by testing the candidates of the
+    spatial hashing only, for increasing ped counts at a constant crowd density
+    :param args:
+    :return:
+    """
+    dimensions = [1000, 1000]
+    neighborhood_bound = args.neighborhood_size / float(dimensions[0]) * 2
+    all_pairs = np.iinfo(np.int64).max
+    print('{:>10} {:>15} {:>15} {:>15} {:>15} {:>10}'.format('peds', 'all pairs', 'candidates', 'all pairs (s)',
+                                                             'hashing (s)', 'speedup'))
+    for num_peds in args.peds:
+        frame = synthetic_frame(num_peds, neighborhood_bound)
+        grid_args = (dimensions, num_peds, args.neighborhood_size, args.grid_size)
+        assert np.array_equal(getGridIndices(frame, *grid_args, hash_min_peds=all_pairs),
+                              getGridIndices(frame, *grid_args, hash_min_peds=0))
+        candidates, _ = getNeighborCandidates(frame.numpy(), neighborhood_bound, neighborhood_bound, 0)
+
+        all_pairs_time = best_time(lambda: getGridIndices(frame, *grid_args, hash_min_peds=all_pairs), args.repeat)
+        hashing_time = best_time(lambda: getGridIndices(frame, *grid_args, hash_min_peds=0), args.repeat)
+        print('{:>10} {:>15} {:>15} {:>15.5f} {:>15.5f} {:>10.1f}'.format(
+            num_peds, num_peds * (num_peds - 1), len(candidates), all_pairs_time, hashing_time,
+            all_pairs_time / hashing_time))
+
+
+def benchmark_sequence_grid(args):
+    """
+    Compare the grid masks of the frames of sequences computed frame by frame (getGridMask and a conversion to
+    torch per frame), sequence by sequence (getSequenceGridMask) and for a padded batch of sequences at once
+    :param args:
+    :return:
+    """
+    dimensions = [1000, 1000]
+    neighborhood_bound = args.neighborhood_size / float(dimensions[0]) * 2
+    grid_args = (args.neighborhood_size, args.grid_size)
+    print('{:>10} {:>15} {:>15} {:>15} {:>10}'.format('peds', 'frames (s)', 'sequences (s)', 'batch (s)',
+                                                      'speedup'))
+    for num_peds in args.peds:
+        batch = torch.stack([torch.stack([synthetic_frame(num_peds, neighborhood_bound, seed=sequence * 100 + frame)
+                                          for frame in range(args.seq_length)])
+                             for sequence in range(args.batch_size)])
+        pedsList = [list(range(num_peds))] * args.seq_length
+        mask = torch.ones(batch.shape[:3], dtype=torch.bool)
+
+        def frame_grids():
+            return [[torch.from_numpy(getGridMask(frame, dimensions, num_peds, *grid_args)).float()
+                     for frame in sequence] for sequence in batch]
+
+        def sequence_grids():
+            return [getSequenceGridMask(sequence, dimensions, pedsList, *grid_args, False) for sequence in batch]
+
+        def batch_grids():
+            return getBatchGridMask(batch, mask, dimensions, *grid_args)
+
+        batch_grid = batch_grids()
+        for sequence, sequence_grid in enumerate(frame_grids()):
+            for frame, frame_grid in enumerate(sequence_grid):
+                assert torch.equal(frame_grid, batch_grid[sequence, frame])
+
+        frames_time = best_time(frame_grids, args.repeat)
+        sequences_time = best_time(sequence_grids, args.repeat)
+        batch_time = best_time(batch_grids, args.repeat)
+        print('{:>10} {:>15.5f} {:>15.5f} {:>15.5f} {:>10.1f}'.format(num_peds, frames_time, sequences_time,
+                                                                      batch_time, frames_time / batch_time))
+
+
+def benchmark_grid_cache(args):
+    """
+    Compare the time to prepare the sequences of each epoch with their grid masks, computed every epoch or kept in
+    a GridMaskCache (memory tier, then disk tier only as in worker processes)
+    :param args:
+    :return:
+    """
+    path = tempfile.mkdtemp()
+    try:
+        # the training files of a DataLoader are read from <prefix>/data/train/<dataset name>, one track per
+        # sequence as in the herms files
+        train_path = os.path.join(path, 'data', 'train', 'herms')
+        os.makedirs(train_path)
+        np.savetxt(os.path.join(train_path, 'crowd.txt'),
+                   synthetic_crowd(args.rows[0], args.peds_per_frame, track_length=args.seq_length),
+                   delimiter='\t', fmt='%d\t%d\t%.4f\t%.4f')
+        dataloader = DataLoader(path, args.batch_size, args.seq_length, num_of_validation=0)
+        sequence_index = dataloader.get_sequence_index()
+        grid_args = (args.neighborhood_size, args.grid_size, False, 0)
+
+        memory_cache = GridMaskCache()
+        disk_cache = GridMaskCache(path=os.path.join(path, 'grids'))
+        datasets = {'no cache': SequenceDataset(dataloader, sequence_index, grid_args=grid_args),
+                    'memory': SequenceDataset(dataloader, sequence_index, grid_args=grid_args,
+                                              grid_cache=memory_cache),
+                    'disk': SequenceDataset(dataloader, sequence_index, grid_args=grid_args, grid_cache=disk_cache)}
+
+        print('{:>10} {:>15} {:>15} {:>15}'.format('epoch', 'no cache (s)', 'memory (s)', 'disk (s)'))
+        for epoch in range(args.epochs):
+            times = []
+            for name in ['no cache', 'memory', 'disk']:
+                start = timeit.default_timer()
+                items = [datasets[name][window] for window in range(len(sequence_index))]
+                times.append(timeit.default_timer() - start)
+                if name == 'no cache':
+                    reference = items
+                for item, reference_item in zip(items, reference):
+                    assert all(torch.equal(grid, reference_grid)
+                               for grid, reference_grid in zip(item['grid_seq'], reference_item['grid_seq']))
+            # the disk tier is read back as a new worker process would
+            disk_cache.clear()
+            print('{:>10} {:>15.4f} {:>15.4f} {:>15.4f}'.format(epoch, *times))
+        print('memory', memory_cache.stats())
+        print('disk', disk_cache.stats())
+    finally:
+        shutil.rmtree(path)
+
+
+def benchmark_grid_updater(args):
+    """
+    Compare the grid masks of a predicted rollout computed from scratch at each step (getGridMask and a conversion to
+    torch) and kept up to date by a GridMaskUpdater, when all the peds move and when a tenth of them move
+    :param args:
+    :return:
+    """
+    dimensions = [1000, 1000]
+    neighborhood_bound = args.neighborhood_size / float(dimensions[0]) * 2
+    pred_length = 12
+    print('{:>10} {:>10} {:>15} {:>15} {:>10}'.format('peds', 'moving', 'scratch (s)', 'updater (s)', 'speedup'))
+    for num_peds in args.peds:
+        for moving in [num_peds, max(1, num_peds // 10)]:
+            rng = np.random.RandomState(0)
+            rollout = [synthetic_frame(num_peds, neighborhood_bound)]
+            for _ in range(pred_length):
+                frame = rollout[-1].clone()
+                peds = rng.choice(num_peds, size=moving, replace=False)
+                frame[peds] += torch.from_numpy(rng.normal(0, neighborhood_bound / 20, size=(moving, 2))).float()
+                rollout.append(frame)
+
+            def scratch_rollout():
+                return [torch.from_numpy(getGridMask(frame, dimensions, num_peds, args.neighborhood_size,
+                                                     args.grid_size)).float() for frame in rollout]
+
+            def updater_rollout():
+                updater = GridMaskUpdater(dimensions, args.neighborhood_size, args.grid_size)
+                return [updater.update(frame, num_peds) for frame in rollout]
+
+            updater = GridMaskUpdater(dimensions, args.neighborhood_size, args.grid_size)
+            for frame, scratch_grid in zip(rollout, scratch_rollout()):
+                assert torch.equal(updater.update(frame, num_peds), scratch_grid)
+
+            scratch_time = best_time(scratch_rollout, args.repeat)
+            updater_time = best_time(updater_rollout, args.repeat)
+            print('{:>10} {:>10} {:>15.5f} {:>15.5f} {:>10.1f}'.format(num_peds, moving, scratch_time, updater_time,
+                                                                      scratch_time / updater_time))
+
+
+def benchmark_occupancy(args):
+    """
+    Compare the occupancy map of one frame computed by the 2-permutations loop and by the bincount engine, binary
+    and with counts, for increasing ped counts
+    :param args:
+    :return:
+    """
+    dimensions = [1000, 1000]
+    neighborhood_bound = args.neighborhood_size / float(dimensions[0]) * 2
+    print('{:>10} {:>15} {:>15} {:>15} {:>10}'.format('peds', 'reference (s)', 'binary (s)', 'counts (s)',
+                                                      'speedup'))
+    for num_peds in args.peds:
+        frame = synthetic_frame(num_peds, neighborhood_bound)
+        grid_args = (dimensions, num_peds, args.neighborhood_size, args.grid_size)
+        assert np.array_equal(reference_grid_mask(frame, *grid_args, is_occupancy=True),
+                              getOccupancyMap(frame, *grid_args))
+        # counts: number of neighbors of each cell of the social grid
+        assert np.array_equal(getOccupancyMap(frame, *grid_args, counts=True),
+                              reference_grid_mask(frame, *grid_args).sum(axis=1))
+
+        reference_time = best_time(lambda: reference_grid_mask(frame, *grid_args, is_occupancy=True), args.repeat)
+        binary_time = best_time(lambda: getOccupancyMap(frame, *grid_args), args.repeat)
+        counts_time = best_time(lambda: getOccupancyMap(frame, *grid_args, counts=True), args.repeat)
+        print('{:>10} {:>15.5f} {:>15.5f} {:>15.5f} {:>10.1f}'.format(num_peds, reference_time, binary_time,
+                                                                      counts_time, reference_time / binary_time))
+
+
+def benchmark_max_neighbors(args):
+    """
+    Compare the grids of crowded frames (about 64 peds per neighborhood) keeping only the nearest neighbors of each
+    ped: pairs kept, time of the grid and of the social pooling, and relative error of the social tensor against the
+    grid with all the neighbors
+    :param args:
+    :return:
+    """
+    dimensions = [1000, 1000]
+    neighborhood_bound = args.neighborhood_size / float(dimensions[0]) * 2
+    rnn_size = 128
+    print('{:>10} {:>10} {:>10} {:>15} {:>15} {:>15}'.format('peds', 'k', 'pairs', 'grid (s)', 'pool (s)',
+                                                             'rel. error'))
+    for num_peds in args.peds:
+        frame = synthetic_frame(num_peds, neighborhood_bound / 4)
+        grid_args = (dimensions, num_peds, args.neighborhood_size, args.grid_size)
+        hidden_states = torch.randn(num_peds, rnn_size)
+        full_tensor = getSocialTensor(torch.from_numpy(getGridIndices(frame, *grid_args)), hidden_states,
+                                      args.grid_size)
+
+        for max_neighbors in args.max_neighbors:
+            grid_indices = torch.from_numpy(getGridIndices(frame, *grid_args, max_neighbors))
+            # the torch grids keep the same neighbors
+            batch_grid = getBatchGridMask(frame.unsqueeze(0), torch.ones(1, num_peds, dtype=torch.bool), dimensions,
+                                          args.neighborhood_size, args.grid_size, max_neighbors=max_neighbors)[0]
+            assert torch.equal(torch.nonzero(batch_grid), grid_indices)
+
+            social_tensor = getSocialTensor(grid_indices, hidden_states, args.grid_size)
+            error = (torch.norm(social_tensor - full_tensor) / torch.norm(full_tensor).clamp(min=1e-12)).item()
+            grid_time = best_time(lambda: getGridIndices(frame, *grid_args, max_neighbors), args.repeat)
+            pool_time = best_time(lambda: getSocialTensor(grid_indices, hidden_states, args.grid_size), args.repeat)
+            print('{:>10} {:>10} {:>10} {:>15.5f} {:>15.5f} {:>15.4f}'.format(
+                num_peds, max_neighbors, len(grid_indices), grid_time, pool_time, error))
+
+
+def benchmark_tiling(args):
+    """
+    Compare the grid triples and the model step of whole frames with the ones computed tile by tile, in the calling
+    process and in worker processes, for increasing ped counts. The largest tile is the memory bound of a worker
+    :param args:
+    :return:
+    """
+    dimensions = [1000, 1000]
+    neighborhood_bound = args.neighborhood_size / float(dimensions[0]) * 2
+    model_args = argparse.Namespace(use_cuda=False, rnn_size=128, embedding_size=64, input_size=2, output_size=5,
+                                    maxNumPeds=args.peds[-1], seq_length=args.seq_length, gru=False, dropout=0.)
+    net = VLSTMModel(model_args, True)
+    net.eval()
+
+    print('{:>10} {:>10} {:>10} {:>10} {:>15} {:>15} {:>15} {:>15}'.format(
+        'peds', 'workers', 'tiles', 'max tile', 'frame grid (s)', 'tiled grid (s)', 'frame step (s)',
+        'tiled step (s)'))
+    for num_peds in args.peds:
+        frame = synthetic_frame(num_peds, neighborhood_bound)
+        hidden_states, cell_states = torch.randn(num_peds, model_args.rnn_size), torch.randn(num_peds,
+                                                                                             model_args.rnn_size)
+        grid_args = (dimensions, num_peds, args.neighborhood_size, args.grid_size)
+        grid_indices = getGridIndices(frame, *grid_args)
+        with torch.no_grad():
+            outputs = net.step(frame, hidden_states, cell_states)[0]
+        frame_grid_time = best_time(lambda: getGridIndices(frame, *grid_args), args.repeat)
+        with torch.no_grad():
+            frame_step_time = best_time(lambda: net.step(frame, hidden_states, cell_states), args.repeat)
+
+        for num_workers in [0] + args.workers:
+            tiler = SceneTiler(dimensions, args.neighborhood_size, args.grid_size, args.tile_size,
+                               num_workers=num_workers, net=net)
+            try:
+                tiles = tiler.tiles(frame)
+                assert np.array_equal(tiler.grid_indices(frame), grid_indices)
+                assert torch.allclose(tiler.step(frame, hidden_states, cell_states)[0], outputs, atol=1e-6)
+                # a present ped without position gets the outputs of the whole frame forward (NaN), not zeros
+                nan_frame, look_up = frame.clone(), dict(zip(range(num_peds), range(num_peds)))
+                nan_frame[num_peds // 2] = float('nan')
+                with torch.no_grad():
+                    nan_outputs = net(nan_frame.view(1, num_peds, 2), hidden_states.clone(), cell_states.clone(),
+                                      [list(range(num_peds))], [num_peds], None, look_up)[0][0]
+                tiled_nan_outputs = tiler.model_step(nan_frame, hidden_states, cell_states, list(range(num_peds)),
+                                                     look_up)[0][0]
+                assert torch.allclose(tiled_nan_outputs, nan_outputs, atol=1e-6, equal_nan=True)
+                tiled_grid_time = best_time(lambda: tiler.grid_indices(frame), args.repeat)
+                tiled_step_time = best_time(lambda: tiler.step(frame, hidden_states, cell_states), args.repeat)
+            finally:
+                tiler.close()
+            print('{:>10} {:>10} {:>10} {:>10} {:>15.5f} {:>15.5f} {:>15.5f} {:>15.5f}'.format(
+                num_peds, num_workers, len(tiles), max(len(members) for _, members in tiles), frame_grid_time,
+                tiled_grid_time, frame_step_time, tiled_step_time))
+
+
+def benchmark_batched_forward(args):
+    """
+    Compare the forward pass of VLSTMModel over the sequences of a batch, one sequence at a time and for the whole
+    padded batch at once, for increasing batch sizes
+    :param args:
+    :return:
+    """
+    model_args = argparse.Namespace(use_cuda=False, rnn_size=128, embedding_size=64, input_size=2, output_size=5,
+                                    maxNumPeds=args.peds_per_frame, seq_length=args.seq_length, gru=False, dropout=0.)
+    net = VLSTMModel(model_args)
+    net.eval()
+    path = tempfile.mkdtemp()
+
+    def sequence_forwards(sequence_batch):
+        outputs = []
+        for sequence in range(len(sequence_batch)):
+            num_peds = int(sequence_batch.num_peds[sequence])
+            ped_ids = sequence_batch.ped_ids[sequence, :num_peds]
+            peds_list = [ped_ids[sequence_batch.mask[sequence, frame, :num_peds]].tolist()
+                         for frame in range(args.seq_length)]
+            outputs.append(net(sequence_batch.relative[sequence, :, :num_peds], torch.zeros(num_peds, 128),
+                               torch.zeros(num_peds, 128), peds_list, [len(peds) for peds in peds_list], None,
+                               sequence_batch.lookup_table(sequence))[0])
+        return outputs
+
+    try:
+        index, tensors = crowd_sequence_tensors(path, args)
+
+        print('{:>10} {:>10} {:>15} {:>15} {:>10}'.format('batch', 'slots', 'sequences (s)', 'batched (s)',
+                                                          'speedup'))
+        for batch_size in [1, 4, 16, 64]:
+            sequence_batch = collate_sequences(tensors, index, list(range(min(batch_size, len(index)))))
+            with torch.no_grad():
+                batched_outputs = net.forward_batch(sequence_batch.relative, sequence_batch.mask)[0]
+                for sequence, outputs in enumerate(sequence_forwards(sequence_batch)):
+                    assert torch.allclose(outputs, batched_outputs[sequence, :, :outputs.size(1)], atol=1e-5)
+
+                sequences_time = best_time(lambda: sequence_forwards(sequence_batch), args.repeat)
+                batched_time = best_time(lambda: net.forward_batch(sequence_batch.relative, sequence_batch.mask),
+                                         args.repeat)
+            print('{:>10} {:>10} {:>15.5f} {:>15.5f} {:>10.1f}'.format(
+                len(sequence_batch), sequence_batch.mask[:, 0].numel(), sequences_time, batched_time,
+                sequences_time / batched_time))
+    finally:
+        shutil.rmtree(path)
+
+
+def benchmark_fused_rnn(args):
+    """
+    Compare the teacher-forced forward pass and training pass (forward, masked loss and backward) of VLSTMModel over
+    padded batches with one cell call per frame (forward_batch) and with one nn.LSTM call over the ped tracks
+    (forward_tracks), for increasing batch sizes
+    :param args:
+    :return:
+    """
+    model_args = argparse.Namespace(use_cuda=False, rnn_size=128, embedding_size=64, input_size=2, output_size=5,
+                                    maxNumPeds=args.peds_per_frame, seq_length=args.seq_length, gru=False, dropout=0.)
+    net = VLSTMModel(model_args)
+    path = tempfile.mkdtemp()
+
+    def training_pass(forward, sequence_batch):
+        net.zero_grad()
+        outputs, _, _ = forward(sequence_batch.relative, sequence_batch.mask)
+        loss = Gaussian2DLikelihoodMasked(outputs, sequence_batch.relative, sequence_batch.mask).mean()
+        loss.backward()
+        return outputs
+
+    try:
+        index, tensors = crowd_sequence_tensors(path, args)
+
+        print('{:>10} {:>10} {:>15} {:>15} {:>15} {:>15}'.format('batch', 'slots', 'loop fwd (s)', 'fused fwd (s)',
+                                                                 'loop train (s)', 'fused train (s)'))
+        for batch_size in [1, 4, 16, 64]:
+            sequence_batch = collate_sequences(tensors, index, list(range(min(batch_size, len(index)))))
+            assert torch.allclose(training_pass(net.forward_batch, sequence_batch),
+                                  training_pass(net.forward_tracks, sequence_batch), atol=1e-5)
+
+            with torch.no_grad():
+                loop_forward_time = best_time(lambda: net.forward_batch(sequence_batch.relative, sequence_batch.mask),
+                                              args.repeat)
+                fused_forward_time = best_time(
+                    lambda: net.forward_tracks(sequence_batch.relative, sequence_batch.mask), args.repeat)
+            loop_time = best_time(lambda: training_pass(net.forward_batch, sequence_batch), args.repeat)
+            fused_time = best_time(lambda: training_pass(net.forward_tracks, sequence_batch), args.repeat)
+            print('{:>10} {:>10} {:>15.5f} {:>15.5f} {:>15.5f} {:>15.5f}'.format(
+                len(sequence_batch), sequence_batch.mask[:, 0].numel(), loop_forward_time, fused_forward_time,
+                loop_time, fused_time))
+    finally:
+        shutil.rmtree(path)
+
+
+def benchmark_inference(args):
+    """
+    Compare the latency of one prediction step of the Vanilla LSTM model in eager mode (VLSTMModel.forward on one
+    frame, with its lookup table) and with the tensor only VLSTMInference, eager and scripted, for increasing ped
+    counts
+    :param args:
+    :return:
+    """
+    model_args = argparse.Namespace(use_cuda=False, rnn_size=128, embedding_size=64, input_size=2, output_size=5,
+                                    maxNumPeds=args.peds[-1], seq_length=1, gru=False, dropout=0.)
+    net = VLSTMModel(model_args, True)
+    net.eval()
+    inference_net = VLSTMInference(net).eval()
+    scripted_net = torch.jit.script(inference_net)
+
+    print('{:>10} {:>15} {:>15} {:>15} {:>10}'.format('peds', 'forward (ms)', 'tensor (ms)', 'scripted (ms)',
+                                                      'speedup'))
+    for num_peds in args.peds:
+        positions = torch.randn(1, num_peds, 2)
+        mask = torch.ones(1, num_peds, dtype=torch.bool)
+        hidden_states, cell_states = torch.zeros(num_peds, 128), torch.zeros(num_peds, 128)
+        look_up = {ped: ped for ped in range(num_peds)}
+        peds_list = [list(range(num_peds))]
+
+        def forward_step():
+            return net(positions, hidden_states.clone(), cell_states.clone(), peds_list, [num_peds], None, look_up)
+
+        with torch.no_grad():
+            outputs = forward_step()[0]
+            assert torch.allclose(inference_net(positions, mask, hidden_states, cell_states)[0], outputs, atol=1e-6)
+            assert torch.allclose(scripted_net(positions, mask, hidden_states, cell_states)[0], outputs, atol=1e-6)
+
+            number = 200
+            forward_time = best_time(lambda: [forward_step() for _ in range(number)], args.repeat) / number
+            tensor_time = best_time(lambda: [inference_net.step(positions[0], mask[0], hidden_states, cell_states)
+                                             for _ in range(number)], args.repeat) / number
+            scripted_time = best_time(lambda: [scripted_net.step(positions[0], mask[0], hidden_states, cell_states)
+                                               for _ in range(number)], args.repeat) / number
+        print('{:>10} {:>15.4f} {:>15.4f} {:>15.4f} {:>10.1f}'.format(
+            num_peds, forward_time * 1e3, tensor_time * 1e3, scripted_time * 1e3, forward_time / scripted_time))
+
+
+if __name__ == '__main__':
+    args = get_parser_args()
+
+    benchmarks = {
+        'frame_preprocess': benchmark_frame_preprocess,
+        'preprocess_files': benchmark_preprocess_files,
+        'test_reader': benchmark_test_reader,
+        'streaming': benchmark_streaming,
+        'sequence_tensors': benchmark_sequence_tensors,
+        'bucketing': benchmark_bucketing,
+        'grid_mask': benchmark_grid_mask,
+        'sparse_grid': benchmark_sparse_grid,
+        'neighbor_search': benchmark_neighbor_search,
+        'sequence_grid': benchmark_sequence_grid,
+        'grid_cache': benchmark_grid_cache,
+        'grid_updater': benchmark_grid_updater,
+        'occupancy': benchmark_occupancy,
+        'max_neighbors': benchmark_max_neighbors,
+        'tiling': benchmark_tiling,
+        'batched_forward': benchmark_batched_forward,
+        'fused_rnn': benchmark_fused_rnn,
+        'inference': benchmark_inference,
+    }
+    benchmarks[args.target](args)
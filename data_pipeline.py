@@ -0,0 +1,488 @@
+"""
+Python script includes the random access index of the sequences of a split, used to shuffle, sample and feed
+sequences to workers without the pointer state of the DataLoader, the dense tensors of these sequences and the
+pipeline preparing batches in worker processes
+"""
+import numpy as np
+import torch
+from torch.utils.data import DataLoader as TorchDataLoader
+from torch.utils.data import Dataset
+
+from grid import getSequenceGridMask
+from tiling import SceneTiler
+
+
+class SequenceIndex:
+    """
+    Precomputed (dataset, start) windows of a split. Item i of an epoch is looked up in O(1), the order of the
+    windows changes with set_epoch: file order, a permutation, or a weighted sampling across datasets
+    """
+
+    def __init__(self, dataset_lengths, window_length, stride=None, shuffle=False, weights=None, seed=0):
+        """
+        Initializer function
+        params:
+        dataset_lengths: number of entries of each dataset
+        window_length: number of entries a window needs from its start
+        stride: distance between the starts of two consecutive windows of a dataset (window_length if None, that is
+        non-overlapping windows)
+        shuffle: permute the windows at each epoch
+        weights: sampling weight of each dataset. If given, each epoch draws len(self) windows with replacement, the
+        windows of a dataset sharing its weight
+        seed: seed of the random orders, epoch e uses seed + e
+        """
+        self.window_length = window_length
+        self.stride = stride or window_length
+        self.shuffle = shuffle
+        self.seed = seed
+
+        starts = [np.arange(0, max(length - window_length + 1, 0), self.stride, dtype=np.int64)
+                  for length in dataset_lengths]
+        self.counts = np.array([len(dataset_starts) for dataset_starts in starts], dtype=np.int64)
+        self.datasets = np.repeat(np.arange(len(starts), dtype=np.int64), self.counts)
+        self.starts = np.concatenate(starts) if starts else np.empty(0, dtype=np.int64)
+
+        # probability of each window
+        self.probabilities = None
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+            if len(weights) != len(starts):
+                raise ValueError("%d weights given for %d datasets" % (len(weights), len(starts)))
+            window_weights = (weights / np.maximum(self.counts, 1))[self.datasets]
+            self.probabilities = window_weights / window_weights.sum()
+
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        """
+        Set the order of the windows for an epoch
+        :param epoch:
+        :return:
+        """
+        rng = np.random.RandomState(self.seed + epoch)
+        if self.probabilities is not None:
+            self.order = rng.choice(len(self.starts), size=len(self.starts), p=self.probabilities)
+        elif self.shuffle:
+            self.order = rng.permutation(len(self.starts))
+        else:
+            self.order = np.arange(len(self.starts))
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, index):
+        """
+        Return the window at a position of the current epoch
+        :param index:
+        :return: dataset, start entry
+        """
+        window = self.order[index]
+        return int(self.datasets[window]), int(self.starts[window])
+
+    def window(self, index):
+        """
+        Return the number of the window at a position of the current epoch, windows being numbered in file order
+        :param index:
+        :return:
+        """
+        return int(self.order[index])
+
+    def batches(self, batch_size, drop_last=False):
+        """
+        Split the current epoch into batches of positions
+        :param batch_size:
+        :param drop_last: drop the last batch if it is not full
+        :return: list of arrays of positions
+        """
+        end = len(self) - len(self) % batch_size if drop_last else len(self)
+        return [np.arange(begin, min(begin + batch_size, end)) for begin in range(0, end, batch_size)]
+
+    def bucket_batches(self, batch_size, num_peds, boundaries, drop_last=False):
+        """
+        Split the current epoch into batches of windows with similar ped counts, so that padded batches hold few
+        empty slots. Bucket i holds the windows with boundaries[i-1] <= num_peds < boundaries[i], the batches of a
+        bucket follow the order of the epoch and the batches are ordered by their first position
+        :param batch_size:
+        :param num_peds: number of peds of each window, windows being numbered in file order
+        :param boundaries: ascending ped counts separating the buckets
+        :param drop_last: drop the last batch of each bucket if it is not full
+        :return: list of arrays of positions
+        """
+        positions = np.arange(len(self))
+        buckets = np.searchsorted(np.asarray(boundaries), np.asarray(num_peds)[self.order], side='right')
+        batches = []
+        for bucket in np.unique(buckets):
+            bucket_positions = positions[buckets == bucket]
+            end = len(bucket_positions) - len(bucket_positions) % batch_size if drop_last else len(bucket_positions)
+            batches.extend(bucket_positions[begin:min(begin + batch_size, end)] for begin in range(0, end, batch_size))
+        batches.sort(key=lambda batch: batch[0])
+        return batches
+
+
+def dense_sequence(frames):
+    """
+    Dense form of a sequence of frames, same layout as DataLoader.convert_proper_array: peds are numbered in order
+    of first appearance
+    :param frames: list of arrays of shape numPeds x 3, each row being [pedID, x, y]
+    :return: positions [T, N, 2] float32, presence mask [T, N], ped ids [N], first position of each ped [N, 2]
+    """
+    rows = np.concatenate(frames)
+    frame_of_row = np.repeat(np.arange(len(frames)), [len(frame) for frame in frames])
+
+    # column of each row: rank of its ped in order of first appearance
+    ped_ids, first_index, inverse = np.unique(rows[:, 0], return_index=True, return_inverse=True)
+    order = np.argsort(first_index, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    columns = rank[inverse.reshape(-1)]
+
+    positions = np.zeros((len(frames), len(ped_ids), 2), dtype=np.float32)
+    positions[frame_of_row, columns] = rows[:, 1:3]
+    mask = np.zeros((len(frames), len(ped_ids)), dtype=bool)
+    mask[frame_of_row, columns] = True
+
+    first_frame = np.full(len(ped_ids), len(frames), dtype=np.int64)
+    np.minimum.at(first_frame, columns, frame_of_row)
+    first_positions = positions[first_frame, np.arange(len(ped_ids))]
+
+    return positions, mask, ped_ids[order].astype(np.int64), first_positions
+
+
+class SequenceTensors:
+    """
+    Dense tensors of all the windows of a SequenceIndex, built once and kept as flat arrays: window w holds
+    num_peds[w] peds, its [T, N] slots start at T * ped_offsets[w]
+    """
+
+    # Stored arrays, in the order of the constructor
+    ARRAYS = ['positions', 'masks', 'ped_ids', 'first_positions', 'ped_offsets']
+
+    def __init__(self, positions, masks, ped_ids, first_positions, ped_offsets):
+        """
+        Initializer function
+        params:
+        positions: x, y of each slot of each window, float32
+        masks: presence of each slot
+        ped_ids: ped id of each column of each window
+        first_positions: first position of each ped of each window
+        ped_offsets: offset of the peds of each window, with the closing offset
+        """
+        self.positions = positions
+        self.masks = masks
+        self.ped_ids = ped_ids
+        self.first_positions = first_positions
+        self.ped_offsets = ped_offsets
+        self.seq_length = len(masks) // max(int(ped_offsets[-1]), 1)
+
+    @classmethod
+    def build(cls, frame_sequences, sequence_index, seq_length):
+        """
+        Build the dense tensors of the windows of an index
+        :param frame_sequences: entries of each dataset (list of FrameSequence)
+        :param sequence_index: SequenceIndex of the entries
+        :param seq_length: number of frames of a sequence
+        :return:
+        """
+        positions, masks, ped_ids, first_positions = [], [], [], []
+        for dataset, start in zip(sequence_index.datasets, sequence_index.starts):
+            window_positions, window_mask, window_ped_ids, window_first_positions = dense_sequence(
+                frame_sequences[dataset][start:start + seq_length])
+            positions.append(window_positions.reshape(-1, 2))
+            masks.append(window_mask.reshape(-1))
+            ped_ids.append(window_ped_ids)
+            first_positions.append(window_first_positions)
+
+        ped_offsets = np.zeros(len(ped_ids) + 1, dtype=np.int64)
+        np.cumsum([len(ids) for ids in ped_ids], out=ped_offsets[1:])
+        if not ped_ids:
+            return cls(np.empty((0, 2), np.float32), np.empty(0, bool), np.empty(0, np.int64),
+                       np.empty((0, 2), np.float32), ped_offsets)
+        return cls(np.concatenate(positions), np.concatenate(masks), np.concatenate(ped_ids),
+                   np.concatenate(first_positions), ped_offsets)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load tensors saved with save
+        :param path:
+        :return:
+        """
+        with np.load(path) as arrays:
+            return cls(*[arrays[name] for name in cls.ARRAYS])
+
+    def save(self, path):
+        """
+        Save the tensors as an npz file
+        :param path:
+        :return:
+        """
+        np.savez(path, **{name: getattr(self, name) for name in self.ARRAYS})
+
+    def __len__(self):
+        return len(self.ped_offsets) - 1
+
+    def num_peds(self):
+        """
+        Return the number of peds of each window
+        :return:
+        """
+        return np.diff(self.ped_offsets)
+
+    def get_arrays(self, window):
+        """
+        Return the arrays of a window as views
+        :param window: window number of the SequenceIndex
+        :return: positions [T, N, 2], mask [T, N], ped ids [N], first positions [N, 2]
+        """
+        begin, end = self.ped_offsets[window], self.ped_offsets[window + 1]
+        num_peds = end - begin
+        slots = slice(self.seq_length * begin, self.seq_length * end)
+        return (self.positions[slots].reshape(self.seq_length, num_peds, 2),
+                self.masks[slots].reshape(self.seq_length, num_peds),
+                self.ped_ids[begin:end], self.first_positions[begin:end])
+
+    def get(self, window):
+        """
+        Return a window in the form used by the training loops
+        :param window: window number of the SequenceIndex
+        :return: x_seq as returned by DataLoader.convert_proper_array, x_seq as returned by helper.vectorize_seq,
+        lookup table, first values dictionary
+        """
+        positions, mask, ped_ids, first_positions = self.get_arrays(window)
+        relative = np.where(mask[:, :, None], positions - first_positions[None], np.float32(0))
+        lookup_table = dict(zip(ped_ids, range(len(ped_ids))))
+        first_values_dict = {ped_id: torch.from_numpy(first_positions[index].copy())
+                             for index, ped_id in enumerate(ped_ids)}
+        return torch.from_numpy(positions.copy()), torch.from_numpy(relative), lookup_table, first_values_dict
+
+
+class SequenceBatch:
+    """
+    Sequences of a batch packed in padded tensors. Sequence b has num_peds[b] peds, in the first columns
+    """
+
+    def __init__(self, positions, relative, mask, ped_ids, first_positions, num_peds, datasets, starts,
+                 target_ids=None):
+        """
+        Initializer function
+        params:
+        positions: absolute positions [B, T, Nmax, 2]
+        relative: positions relative to the first position of each ped [B, T, Nmax, 2] (helper.vectorize_seq)
+        mask: presence of each ped in each frame [B, T, Nmax]
+        ped_ids: ped id of each column [B, Nmax], -1 for padding
+        first_positions: first position of each ped [B, Nmax, 2]
+        num_peds: number of peds of each sequence [B]
+        datasets: dataset of each sequence
+        starts: first entry of each sequence
+        target_ids: target ped id of each sequence
+        """
+        self.positions = positions
+        self.relative = relative
+        self.mask = mask
+        self.ped_ids = ped_ids
+        self.first_positions = first_positions
+        self.num_peds = num_peds
+        self.datasets = datasets
+        self.starts = starts
+        self.target_ids = target_ids
+
+    def __len__(self):
+        return len(self.num_peds)
+
+    def lookup_table(self, sequence):
+        """
+        Return the lookup table (ped id -> column) of a sequence, as DataLoader.convert_proper_array
+        :param sequence:
+        :return:
+        """
+        ped_ids = self.ped_ids[sequence, :self.num_peds[sequence]].tolist()
+        return dict(zip(ped_ids, range(len(ped_ids))))
+
+    def to(self, device):
+        """
+        Move the tensors of the batch to a device
+        :param device:
+        :return: the batch
+        """
+        for name in ['positions', 'relative', 'mask', 'ped_ids', 'first_positions', 'num_peds']:
+            setattr(self, name, getattr(self, name).to(device))
+        return self
+
+
+def collate_sequences(sequence_tensors, sequence_index, positions, target_ids=None):
+    """
+    Pack the sequences at some positions of a sequence index into one padded batch
+    :param sequence_tensors: SequenceTensors of the index
+    :param sequence_index: SequenceIndex
+    :param positions: positions of the sequences in the current epoch of the index
+    :param target_ids: target ped id of each sequence
+    :return: SequenceBatch
+    """
+    windows = [sequence_index.window(position) for position in positions]
+    return collate_windows(sequence_tensors, sequence_index, windows, target_ids)
+
+
+def collate_windows(sequence_tensors, sequence_index, windows, target_ids=None):
+    """
+    Pack some windows of a sequence index into one padded batch
+    :param sequence_tensors: SequenceTensors of the index
+    :param sequence_index: SequenceIndex
+    :param windows: window numbers of the sequences
+    :param target_ids: target ped id of each sequence
+    :return: SequenceBatch
+    """
+    num_peds = sequence_tensors.num_peds()[windows] if windows else np.empty(0, dtype=np.int64)
+    batch_size, seq_length, max_peds = len(windows), sequence_tensors.seq_length, int(num_peds.max(initial=0))
+
+    batch_positions = np.zeros((batch_size, seq_length, max_peds, 2), dtype=np.float32)
+    batch_mask = np.zeros((batch_size, seq_length, max_peds), dtype=bool)
+    batch_ped_ids = np.full((batch_size, max_peds), -1, dtype=np.int64)
+    batch_first_positions = np.zeros((batch_size, max_peds, 2), dtype=np.float32)
+    for sequence, window in enumerate(windows):
+        positions, mask, ped_ids, first_positions = sequence_tensors.get_arrays(window)
+        peds = len(ped_ids)
+        batch_positions[sequence, :, :peds] = positions
+        batch_mask[sequence, :, :peds] = mask
+        batch_ped_ids[sequence, :peds] = ped_ids
+        batch_first_positions[sequence, :peds] = first_positions
+
+    relative = np.where(batch_mask[..., None], batch_positions - batch_first_positions[:, None], np.float32(0))
+
+    return SequenceBatch(torch.from_numpy(batch_positions), torch.from_numpy(relative), torch.from_numpy(batch_mask),
+                         torch.from_numpy(batch_ped_ids), torch.from_numpy(batch_first_positions),
+                         torch.from_numpy(num_peds), [int(sequence_index.datasets[window]) for window in windows],
+                         [int(sequence_index.starts[window]) for window in windows], target_ids)
+
+
+class SequenceDataset(Dataset):
+    """
+    torch Dataset of the prepared sequences of a SequenceIndex. Items are addressed by window number, so the
+    order of the windows can change at each epoch without touching the dataset (and the workers holding it)
+    """
+
+    def __init__(self, dataloader, sequence_index, valid=False, grid_args=None, grid_cache=None, tile_size=0):
+        """
+        Initializer function
+        params:
+        dataloader: DataLoader holding the loaded datasets
+        sequence_index: SequenceIndex of the loaded datasets
+        valid: true if the index was built on the validation entries
+        grid_args: (neighborhood_size, grid_size, is_occupancy, max_neighbors) to compute the grid masks of the
+        sequences, None for no grid mask
+        grid_cache: GridMaskCache the grid masks are kept in across epochs, None to compute them every time
+        tile_size: if not 0, the grid masks are computed tile by tile (tiling.SceneTiler) with tiles of this side
+        """
+        self.dataloader = dataloader
+        self.sequence_index = sequence_index
+        self.valid = valid
+        self.grid_args = grid_args
+        self.grid_cache = grid_cache
+        self.tile_size = tile_size
+        # SceneTiler of the grid masks of each dataset dimensions, built at the first sequence of the dimensions
+        self.tilers = {}
+        # built before the workers start, so they share it
+        self.sequence_tensors = dataloader.get_sequence_tensors(sequence_index, valid)
+        self.sequence_key = dataloader.get_sequence_key(sequence_index, valid)
+
+    def __len__(self):
+        return len(self.sequence_tensors)
+
+    def __getitem__(self, window):
+        """
+        Prepare a sequence
+        :param window: window number of the SequenceIndex
+        :return: dictionary of the sequence data, named as in the training loops
+        """
+        dataset, start = int(self.sequence_index.datasets[window]), int(self.sequence_index.starts[window])
+        _, _, numPedsList_seq, PedsList_seq, target_id = self.dataloader.get_sequence(dataset, start, self.valid)
+        x_seq, vectorized_x_seq, lookup_seq, first_values_dict = self.sequence_tensors.get(window)
+
+        grid_seq = None
+        if self.grid_args is not None:
+            neighborhood_size, grid_size, is_occupancy, max_neighbors = self.grid_args
+            folder_name = self.dataloader.get_directory_name_with_pointer(dataset)
+            dataset_data = self.dataloader.get_dataset_dimension(folder_name)
+
+            def compute_grid_seq():
+                if self.tile_size > 0:
+                    tiler = self.tilers.get(tuple(dataset_data))
+                    if tiler is None:
+                        tiler = SceneTiler(dataset_data, neighborhood_size, grid_size, self.tile_size, max_neighbors)
+                        self.tilers[tuple(dataset_data)] = tiler
+                    return tiler.sequence_grid_mask(x_seq, PedsList_seq, False, is_occupancy)
+                return getSequenceGridMask(x_seq, dataset_data, PedsList_seq, neighborhood_size, grid_size, False,
+                                           is_occupancy, max_neighbors=max_neighbors)
+
+            if self.grid_cache is None:
+                grid_seq = compute_grid_seq()
+            else:
+                key = (self.sequence_key, window, tuple(dataset_data)) + tuple(self.grid_args)
+                grid_seq = self.grid_cache.get(key, compute_grid_seq)
+
+        seq_length = self.dataloader.seq_length
+        return {'x_seq': x_seq, 'vectorized_x_seq': vectorized_x_seq, 'lookup_seq': lookup_seq,
+                'first_values_dict': first_values_dict, 'numPedsList_seq': numPedsList_seq,
+                'PedsList_seq': PedsList_seq, 'target_id': target_id, 'dataset': dataset, 'grid_seq': grid_seq,
+                'frame_numbers': self.dataloader.orig_data[dataset][start:start + seq_length, 0]}
+
+    def collate(self, windows):
+        """
+        Pack sequences into one padded batch
+        :param windows: window numbers of the SequenceIndex
+        :return: SequenceBatch
+        """
+        seq_length = self.dataloader.seq_length
+        target_ids = [self.dataloader.target_ids[int(self.sequence_index.datasets[window])][
+                          int(self.sequence_index.starts[window]) // seq_length] for window in windows]
+        return collate_windows(self.sequence_tensors, self.sequence_index, windows, target_ids)
+
+
+class SequenceBatchDataset(Dataset):
+    """
+    torch Dataset of the padded batches of a SequenceDataset. Items are lists of window numbers, so a worker packs
+    a whole batch and only the padded tensors go through its queue
+    """
+
+    def __init__(self, sequence_dataset):
+        """
+        Initializer function
+        params:
+        sequence_dataset: SequenceDataset of the sequences
+        """
+        self.sequence_dataset = sequence_dataset
+
+    def __len__(self):
+        return len(self.sequence_dataset)
+
+    def __getitem__(self, windows):
+        return self.sequence_dataset.collate(windows)
+
+
+def prefetch_batches(sequence_dataset, batches, num_workers=0, prefetch=2, collate=False):
+    """
+    Iterate over the prepared batches of a SequenceDataset. With worker processes, each worker keeps up to prefetch
+    batches ready in a bounded queue while the caller trains on the current batch
+    :param sequence_dataset: SequenceDataset
+    :param batches: list of batches of positions of the current epoch of the index
+    :param num_workers: number of worker processes, 0 to prepare the batches in the calling process
+    :param prefetch: number of batches prepared in advance by each worker
+    :param collate: pack each batch into a padded SequenceBatch instead of preparing its sequences one by one
+    :return: iterator of lists of prepared sequences, or of SequenceBatch if collate
+    """
+    windows = [[sequence_dataset.sequence_index.window(position) for position in batch] for batch in batches]
+    if num_workers <= 0:
+        for batch in windows:
+            yield sequence_dataset.collate(batch) if collate else [sequence_dataset[window] for window in batch]
+        return
+
+    # the seed of the workers is drawn from a private generator: using workers does not change the random numbers
+    # of the training process
+    if collate:
+        # one item per batch, the SequenceBatch is passed through as is
+        loader = TorchDataLoader(SequenceBatchDataset(sequence_dataset), sampler=windows, batch_size=None,
+                                 num_workers=num_workers, prefetch_factor=prefetch, generator=torch.Generator())
+    else:
+        loader = TorchDataLoader(sequence_dataset, batch_sampler=windows, num_workers=num_workers,
+                                 prefetch_factor=prefetch, collate_fn=list, generator=torch.Generator())
+    for batch in loader:
+        yield batch
@@ -36,7 +36,7 @@ class data_augmentator():
         self.val_percent = val_percent
         self.f_prefix = f_prefix
 
-        self.dataloader = DataLoader(f_prefix, 1, seq_length, 0, forcePreProcess=True, infer=False, generate=True)
+        self.dataloader = DataLoader(f_prefix, 1, seq_length, 0, infer=False, generate=True)
 
         # noise parameter definition
         self.noise_std_min = 0.05
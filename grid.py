@@ -1,63 +1,184 @@
-import itertools
-
 import numpy as np
 import torch
 from torch.autograd import Variable
 
 
-def getGridMask(frame, dimensions, num_person, neighborhood_size, grid_size, is_occupancy=False):
+# Number of peds from which the neighbors of a frame are searched with spatial hashing instead of testing all pairs
+HASH_MIN_PEDS = 128
+
+
+def getNeighborCandidates(frame_np, width_bound, height_bound, hash_min_peds=HASH_MIN_PEDS):
     '''
-    This function computes the binary mask that represents the
-    occupancy of each ped in the other's grid
+    This function returns the (ego, other) pairs of peds to test for the neighborhood
+    of a frame, in row-major order. From hash_min_peds peds, the peds are hashed into
+    buckets of the size of a neighborhood and only the pairs of adjacent buckets are
+    candidates (O(N.k) pairs), otherwise all the pairs are
     params:
-    frame : This will be a MNP x 3 matrix with each row being [pedID, x, y]
+    frame_np : MNP x 2 array with each row being [x, y]
+    width_bound, height_bound : size of the neighborhood
+    hash_min_peds : Number of peds from which spatial hashing is used
+    '''
+    num_person = len(frame_np)
+    if num_person < hash_min_peds:
+        return np.nonzero(~np.eye(num_person, dtype=bool))
+
+    # peds with an unknown position are never in a neighborhood
+    peds = np.flatnonzero(np.isfinite(frame_np).all(axis=1))
+    if len(peds) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # a neighbor is at most half a neighborhood away, so it is in the same or in an adjacent bucket
+    bucket_x = np.floor(frame_np[peds, 0] / width_bound).astype(np.int64)
+    bucket_y = np.floor(frame_np[peds, 1] / height_bound).astype(np.int64)
+    bucket_x -= bucket_x.min() - 1
+    bucket_y -= bucket_y.min() - 1
+    stride = bucket_y.max() + 2
+    keys = bucket_x * stride + bucket_y
+
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    ego, other = [], []
+    for offset_x in [-1, 0, 1]:
+        for offset_y in [-1, 0, 1]:
+            neighbor_keys = keys + offset_x * stride + offset_y
+            begin = np.searchsorted(sorted_keys, neighbor_keys, side='left')
+            counts = np.searchsorted(sorted_keys, neighbor_keys, side='right') - begin
+            # position in sorted_keys of each candidate of each ped
+            positions = np.arange(counts.sum()) + np.repeat(begin - (np.cumsum(counts) - counts), counts)
+            ego.append(np.repeat(peds, counts))
+            other.append(peds[order[positions]])
+
+    ego, other = np.concatenate(ego), np.concatenate(other)
+    pair_keys = ego * num_person + other
+    pair_keys = np.sort(pair_keys[ego != other])
+    return pair_keys // num_person, pair_keys % num_person
+
+
+def keepNearestNeighbors(grid_indices, frame_np, max_neighbors):
+    '''
+    This function keeps the max_neighbors nearest neighbors of each ego ped in its grid,
+    ties going to the lowest neighbor index
+    params:
+    grid_indices : (ego, neighbor, cell) triples in row-major order
+    frame_np : MNP x 2 array with each row being [x, y]
+    max_neighbors : number of neighbors kept for each ped
+    returns:
+    the kept triples, in row-major order
+    '''
+    ego, other = grid_indices[:, 0], grid_indices[:, 1]
+    offset_x = frame_np[other, 0] - frame_np[ego, 0]
+    offset_y = frame_np[other, 1] - frame_np[ego, 1]
+    distances = offset_x * offset_x + offset_y * offset_y
+
+    # rank of each neighbor of an ego by distance, the stable sort keeps ties in the row-major order
+    order = np.lexsort((distances, ego))
+    rank = np.arange(len(order)) - np.searchsorted(ego[order], ego[order], side='left')
+    keep = np.zeros(len(order), dtype=bool)
+    keep[order[rank < max_neighbors]] = True
+    return grid_indices[keep]
+
+
+def getGridIndices(frame, dimensions, num_person, neighborhood_size, grid_size, max_neighbors=0,
+                   hash_min_peds=HASH_MIN_PEDS):
+    '''
+    This function computes the sparse form of the grid mask: the (ego, neighbor, cell)
+    triples of the peds present in the grid of each other ped, in row-major order
+    params:
+    frame : This will be a MNP x 2 matrix with each row being [x, y]
     dimensions : This will be a list [width, height]
+    num_person : number of people exist in given frame
     neighborhood_size : Scalar value representing the size of neighborhood considered
     grid_size : Scalar value representing the size of the grid discretization
-    num_person : number of people exist in given frame
-    is_occupancy: A flag using for calculation of accupancy map
-
+    max_neighbors : if not 0, only the nearest max_neighbors neighbors of each ped are kept
+    hash_min_peds : Number of peds from which the neighbors are searched with spatial hashing
+    returns:
+    int64 array of shape K x 3, one row per neighbor pair
     '''
-    mnp = num_person
-
     width, height = dimensions[0], dimensions[1]
-    if is_occupancy:
-        frame_mask = np.zeros((mnp, grid_size ** 2))
-    else:
-        frame_mask = np.zeros((mnp, mnp, grid_size ** 2))
-    frame_np = frame.data.numpy()
+    frame_np = frame.data.numpy()[:num_person]
 
     # width_bound, height_bound = (neighborhood_size/(width*1.0)), (neighborhood_size/(height*1.0))
     width_bound, height_bound = (neighborhood_size / (width * 1.0)) * 2, (neighborhood_size / (height * 1.0)) * 2
     # print("weight_bound: ", width_bound, "height_bound: ", height_bound)
 
-    # instead of 2 inner loop, we check all possible 2-permutations which is 2 times faster.
-    list_indices = list(range(0, mnp))
-    for real_frame_index, other_real_frame_index in itertools.permutations(list_indices, 2):
-        current_x, current_y = frame_np[real_frame_index, 0], frame_np[real_frame_index, 1]
+    # only the candidate pairs are tested: real_frame_index is the current ped, other_real_frame_index the other ped
+    real_frame_index, other_real_frame_index = getNeighborCandidates(frame_np, width_bound, height_bound,
+                                                                     hash_min_peds)
+    current_x, current_y = frame_np[:, 0], frame_np[:, 1]
 
-        width_low, width_high = current_x - width_bound / 2, current_x + width_bound / 2
-        height_low, height_high = current_y - height_bound / 2, current_y + height_bound / 2
+    width_low, width_high = current_x - width_bound / 2, current_x + width_bound / 2
+    height_low, height_high = current_y - height_bound / 2, current_y + height_bound / 2
+    width_low, width_high = width_low[real_frame_index], width_high[real_frame_index]
+    height_low, height_high = height_low[real_frame_index], height_high[real_frame_index]
 
-        other_x, other_y = frame_np[other_real_frame_index, 0], frame_np[other_real_frame_index, 1]
+    other_x, other_y = current_x[other_real_frame_index], current_y[other_real_frame_index]
 
-        # if (other_x >= width_high).all() or (other_x < width_low).all() or (other_y >= height_high).all() or (other_y < height_low).all():
-        if (other_x >= width_high) or (other_x < width_low) or (other_y >= height_high) or (other_y < height_low):
-            # Ped not in surrounding, so binary mask should be zero
-            # print("not surrounding")
-            continue
-        # If in surrounding, calculate the grid cell
-        cell_x = int(np.floor(((other_x - width_low) / width_bound) * grid_size))
-        cell_y = int(np.floor(((other_y - height_low) / height_bound) * grid_size))
+    # Ped not in surrounding, so binary mask should be zero
+    in_surrounding = ~((other_x >= width_high) | (other_x < width_low) | (other_y >= height_high) |
+                       (other_y < height_low))
 
-        if cell_x >= grid_size or cell_x < 0 or cell_y >= grid_size or cell_y < 0:
-            continue
+    # If in surrounding, calculate the grid cell
+    cell_x = np.floor(((other_x - width_low) / width_bound) * grid_size)
+    cell_y = np.floor(((other_y - height_low) / height_bound) * grid_size)
+    in_grid = in_surrounding & (cell_x < grid_size) & (cell_x >= 0) & (cell_y < grid_size) & (cell_y >= 0)
 
-        if is_occupancy:
-            frame_mask[real_frame_index, cell_x + cell_y * grid_size] = 1
-        else:
-            # Other ped is in the corresponding grid cell of current ped
-            frame_mask[real_frame_index, other_real_frame_index, cell_x + cell_y * grid_size] = 1
+    cells = cell_x[in_grid].astype(np.int64) + cell_y[in_grid].astype(np.int64) * grid_size
+
+    grid_indices = np.column_stack((real_frame_index[in_grid], other_real_frame_index[in_grid], cells))
+    grid_indices = grid_indices.astype(np.int64)
+    if max_neighbors > 0:
+        grid_indices = keepNearestNeighbors(grid_indices, frame_np, max_neighbors)
+    return grid_indices
+
+
+def getOccupancyMap(frame, dimensions, num_person, neighborhood_size, grid_size, counts=False, max_neighbors=0):
+    '''
+    This function computes the occupancy map of each ped: the cells of its grid holding
+    other peds. The (ego, cell) index of each neighbor pair is reduced with a bincount
+    params:
+    frame : This will be a MNP x 2 matrix with each row being [x, y]
+    dimensions : This will be a list [width, height]
+    num_person : number of people exist in given frame
+    neighborhood_size : Scalar value representing the size of neighborhood considered
+    grid_size : Scalar value representing the size of the grid discretization
+    counts : return the number of peds in each cell instead of the binary occupancy
+    max_neighbors : if not 0, only the nearest max_neighbors neighbors of each ped are counted
+    returns:
+    float64 array of shape MNP x grid_size**2
+    '''
+    grid_indices = getGridIndices(frame, dimensions, num_person, neighborhood_size, grid_size, max_neighbors)
+    occupancy = np.bincount(grid_indices[:, 0] * grid_size ** 2 + grid_indices[:, 2],
+                            minlength=num_person * grid_size ** 2).reshape(num_person, grid_size ** 2)
+    if counts:
+        return occupancy.astype(np.float64)
+    return (occupancy > 0).astype(np.float64)
+
+
+def getGridMask(frame, dimensions, num_person, neighborhood_size, grid_size, is_occupancy=False, max_neighbors=0):
+    '''
+    This function computes the binary mask that represents the
+    occupancy of each ped in the other's grid
+    params:
+    frame : This will be a MNP x 3 matrix with each row being [pedID, x, y]
+    dimensions : This will be a list [width, height]
+    neighborhood_size : Scalar value representing the size of neighborhood considered
+    grid_size : Scalar value representing the size of the grid discretization
+    num_person : number of people exist in given frame
+    is_occupancy: A flag using for calculation of accupancy map
+    max_neighbors: if not 0, only the nearest max_neighbors neighbors of each ped are in its grid
+
+    '''
+    mnp = num_person
+
+    if is_occupancy:
+        return getOccupancyMap(frame, dimensions, mnp, neighborhood_size, grid_size, max_neighbors=max_neighbors)
+
+    frame_mask = np.zeros((mnp, mnp, grid_size ** 2))
+
+    # scatter the neighbor pairs into the dense mask in one shot
+    grid_indices = getGridIndices(frame, dimensions, mnp, neighborhood_size, grid_size, max_neighbors)
+    # Other ped is in the corresponding grid cell of current ped
+    frame_mask[grid_indices[:, 0], grid_indices[:, 1], grid_indices[:, 2]] = 1
 
     # Two inner loops aproach -> slower
     # # For each ped in the frame (existent and non-existent)
@@ -108,8 +229,210 @@ def getGridMask(frame, dimensions, num_person, neighborhood_size, grid_size, is_
     return frame_mask
 
 
+def getPairCells(current, other, dimensions, neighborhood_size, grid_size):
+    '''
+    This function computes with torch operations the cell of each other ped in the grid
+    of each current ped, the same way as getGridMask
+    params:
+    current : tensor of shape [..., 2], positions of the current peds
+    other : tensor of shape [..., 2], positions of the other peds, broadcast against current
+    dimensions : This will be a list [width, height]
+    neighborhood_size : Scalar value representing the size of neighborhood considered
+    grid_size : Scalar value representing the size of the grid discretization
+    returns:
+    long tensor of the broadcast shape, the cell index or -1 if the other ped is out of the grid
+    '''
+    width, height = dimensions[0], dimensions[1]
+    width_bound, height_bound = (neighborhood_size / (width * 1.0)) * 2, (neighborhood_size / (height * 1.0)) * 2
+
+    current_x, current_y = current[..., 0], current[..., 1]
+    width_low, width_high = current_x - width_bound / 2, current_x + width_bound / 2
+    height_low, height_high = current_y - height_bound / 2, current_y + height_bound / 2
+    other_x, other_y = other[..., 0], other[..., 1]
+
+    in_surrounding = ~((other_x >= width_high) | (other_x < width_low) | (other_y >= height_high) |
+                       (other_y < height_low))
+
+    cell_x = torch.floor(((other_x - width_low) / width_bound) * grid_size)
+    cell_y = torch.floor(((other_y - height_low) / height_bound) * grid_size)
+    in_grid = in_surrounding & (cell_x < grid_size) & (cell_x >= 0) & (cell_y < grid_size) & (cell_y >= 0)
+
+    cells = torch.where(in_grid, cell_x + cell_y * grid_size, torch.zeros_like(cell_x)).long()
+    return torch.where(in_grid, cells, torch.full_like(cells, -1))
+
+
+def keepNearestPairCells(cells, positions, max_neighbors):
+    '''
+    This function keeps the max_neighbors nearest neighbors of each current ped in the pair
+    cells of getPairCells, ties going to the lowest neighbor index (same as keepNearestNeighbors)
+    params:
+    cells : long tensor of shape [..., MNP, MNP], -1 out of the grid
+    positions : tensor of shape [..., MNP, 2]
+    max_neighbors : number of neighbors kept for each ped
+    returns:
+    the pair cells, -1 for the neighbors not kept
+    '''
+    offset_x = positions[..., 0].unsqueeze(-2) - positions[..., 0].unsqueeze(-1)
+    offset_y = positions[..., 1].unsqueeze(-2) - positions[..., 1].unsqueeze(-1)
+    distances = offset_x * offset_x + offset_y * offset_y
+    distances = torch.where(cells >= 0, distances, torch.full_like(distances, float('inf')))
+
+    # rank of each neighbor by distance, the stable sort keeps ties in neighbor order
+    order = torch.sort(distances, dim=-1, stable=True).indices
+    rank = torch.empty_like(order)
+    rank.scatter_(-1, order, torch.arange(order.size(-1), device=order.device).expand_as(order))
+    return torch.where(rank < max_neighbors, cells, torch.full_like(cells, -1))
+
+
+def getBatchGridMask(sequence, mask, dimensions, neighborhood_size, grid_size, is_occupancy=False, counts=False,
+                     max_neighbors=0):
+    '''
+    This function computes the grid masks of all the frames of a sequence (or of a padded
+    batch of sequences) in one call, with torch operations on the device of the sequence.
+    On CPU the masks are bit-identical to getGridMask
+    params:
+    sequence : tensor of shape [..., SL, MNP, 2] with each row being [x, y]
+    mask : bool tensor of shape [..., SL, MNP], the peds taking part in each frame
+    dimensions : This will be a list [width, height]
+    neighborhood_size : Scalar value representing the size of neighborhood considered
+    grid_size : Scalar value representing the size of the grid discretization
+    is_occupancy: A flag using for calculation of accupancy map
+    counts : with is_occupancy, return the number of peds in each cell instead of the binary occupancy
+    max_neighbors : if not 0, only the nearest max_neighbors neighbors of each ped are in its grid
+    returns:
+    float tensor of shape [..., SL, MNP, MNP, grid_size**2] ([..., SL, MNP, grid_size**2] for occupancy)
+    '''
+    # dimension -2 is the current ped, dimension -1 the other ped
+    cells = getPairCells(sequence.unsqueeze(-2), sequence.unsqueeze(-3), dimensions, neighborhood_size, grid_size)
+    num_peds = sequence.size(-2)
+    pairs = mask.unsqueeze(-1) & mask.unsqueeze(-2) & ~torch.eye(num_peds, dtype=torch.bool, device=sequence.device)
+    if max_neighbors > 0:
+        cells = keepNearestPairCells(torch.where(pairs, cells, torch.full_like(cells, -1)), sequence, max_neighbors)
+    in_grid = pairs & (cells >= 0)
+
+    # only the pairs in a grid are written
+    pair_index = in_grid.nonzero(as_tuple=True)
+    cells = cells[pair_index]
+    if is_occupancy:
+        # (ego, cell) of each pair in a grid, reduced with a bincount
+        ego_index = torch.arange(mask.numel(), device=sequence.device).view(mask.size())[pair_index[:-1]]
+        occupancy = torch.bincount(ego_index * grid_size ** 2 + cells, minlength=mask.numel() * grid_size ** 2)
+        occupancy = occupancy.view(mask.size() + (grid_size ** 2,))
+        return occupancy.float() if counts else (occupancy > 0).float()
+    else:
+        sequence_mask = torch.zeros(in_grid.size() + (grid_size ** 2,), device=sequence.device)
+        sequence_mask[pair_index + (cells,)] = 1
+    return sequence_mask
+
+
+class GridMaskUpdater():
+    '''
+    Grid mask of a frame kept up to date while the peds move, on the device of their
+    positions. The cell of each pair is kept: at each update only the pairs of the peds
+    that moved are computed again and only the pairs whose cell changed are written
+    '''
+
+    def __init__(self, dimensions, neighborhood_size, grid_size, is_occupancy=False, counts=False, max_neighbors=0):
+        '''
+        Initializer function
+        params:
+        dimensions : This will be a list [width, height]
+        neighborhood_size : Scalar value representing the size of neighborhood considered
+        grid_size : Scalar value representing the size of the grid discretization
+        is_occupancy: A flag using for calculation of accupancy map
+        counts : with is_occupancy, the map holds the number of peds in each cell instead of the binary occupancy
+        max_neighbors : if not 0, only the nearest max_neighbors neighbors of each ped are in its grid. The
+        nearest neighbors of a ped change with any move, so the mask is then computed from scratch at each update
+        '''
+        self.dimensions = dimensions
+        self.neighborhood_size = neighborhood_size
+        self.grid_size = grid_size
+        self.is_occupancy = is_occupancy
+        self.counts_map = counts
+        self.max_neighbors = max_neighbors
+
+        self.positions = None
+        # cell of each other ped in the grid of each ped, -1 out of the grid
+        self.cells = None
+        # number of peds in each cell of the grid of each ped (occupancy)
+        self.counts = None
+        self.mask = None
+
+    def pair_cells(self, current, other):
+        return getPairCells(current, other, self.dimensions, self.neighborhood_size, self.grid_size)
+
+    def update(self, frame, num_person):
+        '''
+        Update the grid mask with new positions. The returned mask is the same tensor at
+        each update, changed in place
+        params:
+        frame : tensor of shape MNP x 2 with each row being [x, y]
+        num_person : number of people exist in given frame, the grid is computed on the first num_person rows
+        returns:
+        same mask as getGridMask, as a float tensor
+        '''
+        frame = frame.data[:num_person]
+        if self.positions is None or len(self.positions) != num_person or self.max_neighbors > 0:
+            return self.reset(frame)
+
+        # peds whose position changed, only their rows and columns are computed again
+        moved = (frame != self.positions).any(dim=1).nonzero().view(-1)
+        if len(moved) == 0:
+            return self.mask
+        if 2 * len(moved) >= num_person:
+            # most peds moved: all the pairs at once costs less than their rows and columns
+            cells = self.pair_cells(frame.unsqueeze(1), frame.unsqueeze(0))
+            cells.fill_diagonal_(-1)
+        else:
+            cells = self.cells.clone()
+            cells[moved] = self.pair_cells(frame[moved].unsqueeze(1), frame.unsqueeze(0))
+            cells[:, moved] = self.pair_cells(frame.unsqueeze(1), frame[moved].unsqueeze(0))
+            cells[moved, moved] = -1
+
+        current, other = (cells != self.cells).nonzero(as_tuple=True)
+        old_cells, new_cells = self.cells[current, other], cells[current, other]
+        removed, added = old_cells >= 0, new_cells >= 0
+        if self.is_occupancy:
+            self.counts.index_put_((current[removed], old_cells[removed]), -torch.ones_like(old_cells[removed]),
+                                   accumulate=True)
+            self.counts.index_put_((current[added], new_cells[added]), torch.ones_like(new_cells[added]),
+                                   accumulate=True)
+            self.mask[current] = self.counts[current].float() if self.counts_map else (self.counts[current] > 0).float()
+        else:
+            self.mask[current[removed], other[removed], old_cells[removed]] = 0
+            self.mask[current[added], other[added], new_cells[added]] = 1
+
+        self.positions = frame.clone()
+        self.cells = cells
+        return self.mask
+
+    def reset(self, frame):
+        '''
+        Compute the grid mask of a frame from scratch
+        params:
+        frame : tensor of shape MNP x 2, the peds of the frame
+        '''
+        num_person = len(frame)
+        self.positions = frame.clone()
+        self.cells = self.pair_cells(frame.unsqueeze(1), frame.unsqueeze(0))
+        self.cells.fill_diagonal_(-1)
+        if self.max_neighbors > 0:
+            self.cells = keepNearestPairCells(self.cells, frame, self.max_neighbors)
+
+        current, other = (self.cells >= 0).nonzero(as_tuple=True)
+        cells = self.cells[current, other]
+        self.counts = torch.zeros(num_person, self.grid_size ** 2, dtype=torch.long, device=frame.device)
+        self.counts.index_put_((current, cells), torch.ones_like(cells), accumulate=True)
+        if self.is_occupancy:
+            self.mask = self.counts.float() if self.counts_map else (self.counts > 0).float()
+        else:
+            self.mask = torch.zeros(num_person, num_person, self.grid_size ** 2, device=frame.device)
+            self.mask[current, other, cells] = 1
+        return self.mask
+
+
 def getSequenceGridMask(sequence, dimensions, pedlist_seq, neighborhood_size, grid_size, using_cuda,
-                        is_occupancy=False):
+                        is_occupancy=False, sparse=False, max_neighbors=0):
     '''
     Get the grid masks for all the frames in the sequence
     params:
@@ -119,16 +442,56 @@ def getSequenceGridMask(sequence, dimensions, pedlist_seq, neighborhood_size, gr
     grid_size : Scalar value representing the size of the grid discretization
     using_cuda: Boolean value denoting if using GPU or not
     is_occupancy: A flag using for calculation of accupancy map
+    sparse: return the (ego, neighbor, cell) triples of each frame (getGridIndices) instead of the dense masks
+    max_neighbors: if not 0, only the nearest max_neighbors neighbors of each ped are in its grid
     '''
     sl = len(sequence)
     sequence_mask = []
 
+    if sparse:
+        for i in range(sl):
+            mask = torch.from_numpy(
+                getGridIndices(sequence[i], dimensions, len(pedlist_seq[i]), neighborhood_size, grid_size,
+                               max_neighbors))
+            if using_cuda:
+                mask = mask.cuda()
+            sequence_mask.append(mask)
+        return sequence_mask
+
+    # all the frames at once, the grid of frame i is computed on its first len(pedlist_seq[i]) peds
+    sequence = sequence.data[:sl]
+    if using_cuda:
+        sequence = sequence.cuda()
+    num_persons = torch.tensor([len(pedlist) for pedlist in pedlist_seq[:sl]], device=sequence.device)
+    mask = torch.arange(sequence.size(1), device=sequence.device).unsqueeze(0) < num_persons.unsqueeze(1)
+    masks = getBatchGridMask(sequence, mask, dimensions, neighborhood_size, grid_size, is_occupancy,
+                             max_neighbors=max_neighbors)
+
     for i in range(sl):
-        mask = Variable(torch.from_numpy(
-            getGridMask(sequence[i], dimensions, len(pedlist_seq[i]), neighborhood_size, grid_size,
-                        is_occupancy)).float())
-        if using_cuda:
-            mask = mask.cuda()
-        sequence_mask.append(mask)
+        num_person = len(pedlist_seq[i])
+        if is_occupancy:
+            sequence_mask.append(Variable(masks[i, :num_person]))
+        else:
+            sequence_mask.append(Variable(masks[i, :num_person, :num_person]))
 
     return sequence_mask
+
+
+def getSocialTensor(grid_indices, hidden_states, grid_size):
+    '''
+    Social pooling of the hidden states from the sparse grid of a frame: the hidden states
+    of the neighbors are summed into the cells of the grid of each ego ped with a
+    scatter-add, the same as multiplying the transposed dense grid mask of each ped with
+    the hidden states, with memory linear in the number of neighbor pairs
+    params:
+    grid_indices : (ego, neighbor, cell) triples of the frame, LongTensor of shape K x 3
+    hidden_states : hidden states of the peds of the frame, of shape MNP x rnn_size
+    grid_size : Scalar value representing the size of the grid discretization
+    returns:
+    social tensor of shape MNP x (grid_size**2 * rnn_size)
+    '''
+    num_nodes, rnn_size = hidden_states.size()
+    social_tensor = hidden_states.new_zeros(num_nodes * grid_size ** 2, rnn_size)
+    social_tensor = social_tensor.index_add(0, grid_indices[:, 0] * grid_size ** 2 + grid_indices[:, 2],
+                                            hidden_states[grid_indices[:, 1]])
+    return social_tensor.view(num_nodes, grid_size ** 2 * rnn_size)
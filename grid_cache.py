@@ -0,0 +1,129 @@
+"""
+Python script for caching the grid masks of the ground truth sequences, so they are computed once per sequence and
+grid parameters instead of once per epoch
+"""
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class GridMaskCache:
+    """
+    Grid masks of sequences keyed by (sequence key, window, dimensions, neighborhood_size, grid_size, is_occupancy,
+    max_neighbors).
+    The most recently used entries are kept in memory up to max_bytes of masks, the others are read back from the
+    cache directory if one is given. Each process has its own memory tier: worker processes share the masks through
+    the directory only, and need it to keep them past their own lifetime (one epoch of prefetch_batches)
+    """
+
+    def __init__(self, max_bytes=1 << 30, path=None):
+        """
+        Initializer function
+        params:
+        max_bytes: size of the grid masks kept in memory, in bytes. A dense mask of N peds takes N * N * grid_size**2
+        floats, so the size of an entry grows quickly with the crowd
+        path: cache directory of the disk tier (no disk tier if None)
+        """
+        self.max_bytes = max_bytes
+        self.path = path
+        if path is not None and not os.path.exists(path):
+            os.makedirs(path)
+
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def entry_path(self, key):
+        """
+        Return the file of an entry in the cache directory
+        :param key:
+        :return:
+        """
+        return os.path.join(self.path, 'grid-%s.npz' % hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def write_entry(self, path, grids):
+        """
+        Write the grid masks of a sequence. The masks are mostly zeros, only their shapes and the flat indices of
+        their ones are written. The file is written under a temporary name first, so a reader never sees a partial
+        file
+        :param path:
+        :param grids: list of grid masks (binary tensors)
+        :return:
+        """
+        flat = torch.cat([grid.reshape(-1) for grid in grids]).cpu().numpy() if grids else np.empty(0)
+        shapes = np.array([tuple(grid.size()) for grid in grids], dtype=np.int64)
+        tmp_path = path + '.%d.tmp.npz' % os.getpid()
+        np.savez(tmp_path, shapes=shapes, ones=np.flatnonzero(flat))
+        os.replace(tmp_path, path)
+
+    def read_entry(self, path):
+        """
+        Read the grid masks written by write_entry
+        :param path:
+        :return: list of float tensors, views of one flat tensor
+        """
+        with np.load(path) as arrays:
+            shapes, ones = arrays['shapes'], arrays['ones']
+        sizes = [int(np.prod(shape)) for shape in shapes]
+        flat = torch.zeros(sum(sizes))
+        flat[torch.from_numpy(ones)] = 1
+        return [grid.view(*shape) for grid, shape in zip(torch.split(flat, sizes), shapes.tolist())]
+
+    def get(self, key, compute):
+        """
+        Return the grid masks of a key, computed with compute() and stored if they are not in the cache
+        :param key: hashable key of the grid masks
+        :param compute: function returning the grid masks of the key, as a list of tensors
+        :return:
+        """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        if self.path is not None and os.path.isfile(self.entry_path(key)):
+            self.disk_hits += 1
+            value = self.read_entry(self.entry_path(key))
+        else:
+            self.misses += 1
+            value = compute()
+            if self.path is not None:
+                self.write_entry(self.entry_path(key), value)
+
+        self.entries[key] = value
+        self.nbytes += self.entry_bytes(value)
+        # least recently used first, an entry larger than max_bytes is not kept
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= self.entry_bytes(evicted)
+        return value
+
+    @staticmethod
+    def entry_bytes(grids):
+        """
+        Return the memory size of the grid masks of an entry
+        :param grids: list of tensors
+        :return: number of bytes
+        """
+        return sum(grid.nelement() * grid.element_size() for grid in grids)
+
+    def clear(self):
+        """
+        Drop the memory tier, the disk tier is kept
+        :return:
+        """
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """
+        Return the hit and miss counts as a string
+        :return:
+        """
+        return 'grid cache: %d hits, %d disk hits, %d misses, %d entries (%.1f MB) in memory' % (
+            self.hits, self.disk_hits, self.misses, len(self.entries), self.nbytes / 2 ** 20)
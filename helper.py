@@ -186,6 +186,52 @@ def get_final_error(ret_nodes, nodes, assumedNodesPresent, trueNodesPresent, loo
     return error
 
 
+def get_mean_error_masked(ret_nodes, nodes, mask):
+    """
+    Mean error of a padded batch of sequences, same as get_mean_error for each sequence
+    :param ret_nodes: A tensor of shape batch_size x pred_length x numNodes x 2. Contains the predicted positions
+    :param nodes: A tensor of shape batch_size x pred_length x numNodes x 2. Contains the true positions
+    :param mask: A tensor of shape batch_size x pred_length x numNodes, true for the nodes present at each time-step
+    :return: Error of each sequence; Mean euclidean distance between predicted trajectory and the true trajectory
+    """
+    mask = mask.float()
+    distances = torch.norm(ret_nodes - nodes, p=2, dim=-1) * mask
+    # mean over the present nodes of each time-step, 0 for the time-steps without node
+    error = distances.sum(dim=-1) / torch.clamp(mask.sum(dim=-1), min=1)
+    return error.mean(dim=-1)
+
+
+def Gaussian2DLikelihoodMasked(outputs, targets, mask):
+    """
+    Loss of a padded batch of sequences, same as Gaussian2DLikelihood for each sequence
+    :param outputs: predicted distributions, batch_size x seq_length x numNodes x 5
+    :param targets: true locations, batch_size x seq_length x numNodes x 2
+    :param mask: batch_size x seq_length x numNodes, true for the nodes present in each frame
+    :return: loss of each sequence
+    """
+    mux, muy = outputs[..., 0], outputs[..., 1]
+    sx, sy, corr = torch.exp(outputs[..., 2]), torch.exp(outputs[..., 3]), torch.tanh(outputs[..., 4])
+
+    # Compute factors
+    normx = targets[..., 0] - mux
+    normy = targets[..., 1] - muy
+    sxsy = sx * sy
+
+    z = (normx / sx) ** 2 + (normy / sy) ** 2 - 2 * ((corr * normx * normy) / sxsy)
+    negRho = 1 - corr ** 2
+
+    # Final PDF calculation
+    result = torch.exp(-z / (2 * negRho)) / (2 * np.pi * (sxsy * torch.sqrt(negRho)))
+
+    # Numerical stability
+    epsilon = 1e-20
+    result = -torch.log(torch.clamp(result, min=epsilon))
+
+    mask = mask.float()
+    counter = mask.sum(dim=(1, 2))
+    return (result * mask).sum(dim=(1, 2)) / torch.clamp(counter, min=1)
+
+
 def Gaussian2DLikelihoodInference(outputs, targets, nodesPresent, pred_length, look_up):
     """
     Computes the likelihood of predicted locations under a bivariate Gaussian distribution at test time
@@ -559,7 +605,7 @@ def sample_validation_data(x_seq, Pedlist, grid, args, net, look_up, num_pedlist
     return ret_x_seq, total_loss / args.seq_length
 
 
-def sample_validation_data_vanilla(x_seq, Pedlist, args, net, look_up, num_pedlist, dataloader):
+def sample_validation_data_vanilla(x_seq, Pedlist, args, net, look_up, num_pedlist, dataloader, tiler=None):
     """
     The validation sample function for vanilla method
     :param x_seq: Input positions
@@ -569,6 +615,7 @@ def sample_validation_data_vanilla(x_seq, Pedlist, args, net, look_up, num_pedli
     :param look_up: lookup table for determining which ped is in which array index
     :param num_pedlist: number of peds in each frame
     :param dataloader:
+    :param tiler: tiling.SceneTiler running the steps of the model tile by tile, None to run them on whole frames
     :return:
     """
 
@@ -600,8 +647,12 @@ def sample_validation_data_vanilla(x_seq, Pedlist, args, net, look_up, num_pedli
     for tstep in range(args.seq_length - 1):
         loss = 0
         # Do a forward prop
-        out_, hidden_states, cell_states = net(x_seq[tstep].view(1, numx_seq, 2), hidden_states, cell_states,
-                                               [Pedlist[tstep]], [num_pedlist[tstep]], dataloader, look_up)
+        if tiler is not None:
+            out_, hidden_states, cell_states = tiler.model_step(x_seq[tstep], hidden_states, cell_states,
+                                                                Pedlist[tstep], look_up)
+        else:
+            out_, hidden_states, cell_states = net(x_seq[tstep].view(1, numx_seq, 2), hidden_states, cell_states,
+                                                   [Pedlist[tstep]], [num_pedlist[tstep]], dataloader, look_up)
         # loss_obs = Gaussian2DLikelihood(out_obs, x_seq[tstep+1].view(1, numx_seq, 2), [Pedlist[tstep+1]])
 
         # Extract the mean, std and corr of the bivariate Gaussian
@@ -5,8 +5,10 @@ import argparse
 import itertools
 import time
 
-from grid import getSequenceGridMask
+from data_pipeline import SequenceDataset, prefetch_batches
+from grid_cache import GridMaskCache
 from helper import *
+from tiling import SceneTiler
 from utils import DataLoader
 
 
@@ -26,6 +28,13 @@ class parameters():
         self.method = args.method
         self.best_n = args.best_n
         self.batch_size = args.batch_size
+        self.num_workers = args.num_workers
+        self.prefetch = args.prefetch
+        self.grid_cache_mb = args.grid_cache_mb
+        self.grid_cache_disk = args.grid_cache_disk
+        self.max_neighbors = args.max_neighbors
+        self.tile_size = args.tile_size
+        self.tile_workers = args.tile_workers
 
 
 def sample_hyperparameters():
@@ -56,7 +65,7 @@ def write_to_file(file, args):
         # "decay_rate: "+str(args.decay_rate)+
         " dropout: " + str(args.dropout) + " embedding_size: " + str(
             args.embedding_size) + " neighborhood_size: " + str(args.neighborhood_size) + " grid_size: " + str(
-            args.grid_size) + '\n')
+            args.grid_size) + " max_neighbors: " + str(args.max_neighbors) + '\n')
 
 
 def print_to_screen(args):
@@ -64,7 +73,7 @@ def print_to_screen(args):
           str(args.grad_clip), " learning_rate: ", str(args.learning_rate),
           # "decay_rate: ",str(args.decay_rate),
           " dropout: ", str(args.dropout), " embedding_size: ", str(args.embedding_size), " neighborhood_size: ",
-          str(args.neighborhood_size), " grid_size: ", str(args.grid_size))
+          str(args.neighborhood_size), " grid_size: ", str(args.grid_size), " max_neighbors: ", str(args.max_neighbors))
 
 
 def main():
@@ -106,6 +115,30 @@ def main():
     # number of parameter set will be logged
     parser.add_argument('--best_n', type=int, default=100,
                         help='Number of best n configuration will be logged')
+    # number of worker processes preparing the training batches
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='Number of worker processes preparing the batches (0: prepared by the training process)')
+    # number of batches prepared in advance by each worker
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='Number of batches prepared in advance by each worker process')
+    # size of the grid masks kept in memory
+    parser.add_argument('--grid_cache_mb', type=int, default=1024,
+                        help='Size in MB of the grid masks kept in memory across epochs')
+    # keep the grid masks in the cache directory too
+    parser.add_argument('--grid_cache_disk', action="store_true", default=False,
+                        help='Keep the grid masks in the cache directory too, shared by the runs (always on with '
+                             'worker processes)')
+    # number of nearest neighbors pooled by each ped
+    parser.add_argument('--max_neighbors', type=int, default=0,
+                        help='Number of nearest neighbors in the grid of each ped (0: all neighbors)')
+    # side of the tiles of large scenes
+    parser.add_argument('--tile_size', type=int, default=0,
+                        help='Compute the grid masks and the validation model steps tile by tile, with tiles of this '
+                             'side (0: whole frames)')
+    # number of worker processes computing the tiles of the validation model steps
+    parser.add_argument('--tile_workers', type=int, default=0,
+                        help='Number of worker processes computing the tiles of the validation model steps (0: '
+                             'computed by the main process)')
 
     # Parse the parameters
     # sample_args = parser.parse_args()
@@ -141,9 +174,24 @@ def main():
     log_file = open(os.path.join(param_log, param_log_file, 'log.txt'), 'w+')
 
     dataloader_t = DataLoader(f_prefix, args.batch_size, args.seq_length, num_of_validation=args.num_validation,
-                              forcePreProcess=True, infer=True)
-    dataloader_v = DataLoader(f_prefix, 1, args.seq_length, num_of_validation=args.num_validation, forcePreProcess=True,
                               infer=True)
+    dataloader_v = DataLoader(f_prefix, 1, args.seq_length, num_of_validation=args.num_validation,
+                              infer=True)
+
+    # grid masks of the training and validation sequences, computed once for each sampled grid parameters. The
+    # worker processes only last one epoch and their memory tier goes with them, so they keep the masks in the disk
+    # tier
+    grid_cache_path = None
+    if args.grid_cache_disk or args.num_workers > 0:
+        grid_cache_path = os.path.join(dataloader_t.cache.path, 'grids')
+    grid_cache = GridMaskCache(args.grid_cache_mb * 2 ** 20, grid_cache_path)
+
+    # validation model steps of large scenes tile by tile (no halo, the steps of the peds are independent). The
+    # model of each trial is set before its validation, so the workers step with its parameters
+    tiler = None
+    if args.tile_size > 0 and args.method == 3:
+        tiler = SceneTiler(dataloader_v.get_dataset_dimension(dataloader_v.get_directory_name_with_pointer(0)), 0, 0,
+                           args.tile_size, num_workers=args.tile_workers)
 
     for hyperparams in itertools.islice(sample_hyperparameters(), args.num_samples):
         args = parameters(parser)
@@ -179,44 +227,51 @@ def main():
 
         total_process_start = time.time()
 
+        # grid mask calculation of the sampled parameters, done with the rest of the batch preparation
+        grid_args = None
+        if args.method == 2:  # obstacle lstm
+            grid_args = (args.neighborhood_size, args.grid_size, True, args.max_neighbors)
+        elif args.method == 1:  # social lstm
+            grid_args = (args.neighborhood_size, args.grid_size, False, args.max_neighbors)
+
         # Training
         for epoch in range(args.num_epochs):
             print('****************Training epoch beginning******************')
             dataloader_t.reset_batch_pointer()
             loss_epoch = 0
 
+            # Sequences of the epoch in the order of next_batch, their dense tensors are built once for all trials.
+            # The batches are prepared in worker processes while the model trains if num_workers > 0
+            sequence_index = dataloader_t.get_sequence_index()
+            sequence_dataset = SequenceDataset(dataloader_t, sequence_index, grid_args=grid_args,
+                                               grid_cache=grid_cache, tile_size=args.tile_size)
+            batches = sequence_index.batches(dataloader_t.batch_size, drop_last=True)[:dataloader_t.num_batches]
+            prepared_batches = prefetch_batches(sequence_dataset, batches, args.num_workers, args.prefetch)
+
             # For each batch
             for batch in range(dataloader_t.num_batches):
                 start = time.time()
 
                 # Get batch data
-                x, y, d, numPedsList, PedsList, target_ids = dataloader_t.next_batch()
+                prepared_batch = next(prepared_batches)
 
                 loss_batch = 0
 
                 # For each sequence
                 for sequence in range(dataloader_t.batch_size):
                     # Get the data corresponding to the current sequence
-                    x_seq, _, d_seq, numPedsList_seq, PedsList_seq = x[sequence], y[sequence], d[sequence], numPedsList[
-                        sequence], PedsList[sequence]
-                    target_id = target_ids[sequence]
-
-                    # get processing file name and then get dimensions of file
-                    folder_name = dataloader_t.get_directory_name_with_pointer(d_seq)
-                    dataset_data = dataloader_t.get_dataset_dimension(folder_name)
+                    prepared = prepared_batch[sequence]
+                    numPedsList_seq, PedsList_seq = prepared['numPedsList_seq'], prepared['PedsList_seq']
+                    target_id = prepared['target_id']
 
-                    # dense vector creation
-                    x_seq, lookup_seq = dataloader_t.convert_proper_array(x_seq, numPedsList_seq, PedsList_seq)
+                    # precomputed dense vector, vectorized trajectories and grid masks
+                    x_seq, lookup_seq = prepared['x_seq'], prepared['lookup_seq']
                     target_id_values = x_seq[0][lookup_seq[target_id], 0:2]
-                    # grid mask calculation
-                    if args.method == 2:  # obstacle lstm
-                        grid_seq = getSequenceGridMask(x_seq, dataset_data, PedsList_seq, args.neighborhood_size,
-                                                       args.grid_size, args.use_cuda, True)
-                    elif args.method == 1:  # social lstm
-                        grid_seq = getSequenceGridMask(x_seq, dataset_data, PedsList_seq, args.neighborhood_size,
-                                                       args.grid_size, args.use_cuda)
-                    # vectorize trajectories in sequence
-                    x_seq, _ = vectorize_seq(x_seq, PedsList_seq, lookup_seq)
+                    grid_seq = prepared['grid_seq']
+                    if args.use_cuda and grid_seq is not None:
+                        grid_seq = [grid.cuda() for grid in grid_seq]
+                    # vectorized trajectories in sequence
+                    x_seq = prepared['vectorized_x_seq']
 
                     if args.use_cuda:
                         x_seq = x_seq.cuda()
@@ -271,6 +326,8 @@ def main():
             loss_epoch /= dataloader_t.num_batches
             # Log loss values
             log_file.write("Training epoch: " + str(epoch) + " loss: " + str(loss_epoch) + '\n')
+            if grid_args is not None:
+                print(grid_cache.stats())
 
         net = get_model(args.method, args, True)
 
@@ -284,10 +341,20 @@ def main():
         else:
             optimizer = torch.optim.Adam(net.parameters(), weight_decay=args.lambda_param)
 
+        if tiler is not None:
+            tiler.set_net(net)
+
         print('****************Validation dataset batch processing******************')
         dataloader_v.reset_batch_pointer()
         dataset_pointer_ins = dataloader_v.dataset_pointer
 
+        # Sequences in the order of next_batch, prepared in worker processes if num_workers > 0
+        sequence_index = dataloader_v.get_sequence_index()
+        sequence_dataset = SequenceDataset(dataloader_v, sequence_index, grid_args=grid_args, grid_cache=grid_cache,
+                                           tile_size=args.tile_size)
+        batches = sequence_index.batches(dataloader_v.batch_size, drop_last=True)[:dataloader_v.num_batches]
+        prepared_batches = prefetch_batches(sequence_dataset, batches, args.num_workers, args.prefetch)
+
         loss_epoch = 0
         err_epoch = 0
         f_err_epoch = 0
@@ -298,7 +365,8 @@ def main():
         for batch in range(dataloader_v.num_batches):
             start = time.time()
             # Get batch data
-            x, y, d, numPedsList, PedsList, target_ids = dataloader_v.next_batch()
+            prepared_batch = next(prepared_batches)
+            dataloader_v.dataset_pointer = prepared_batch[-1]['dataset']
 
             if dataset_pointer_ins is not dataloader_v.dataset_pointer:
                 if dataloader_v.dataset_pointer is not 0:
@@ -307,6 +375,10 @@ def main():
                     num_of_batch = 0
                 dataset_pointer_ins = dataloader_v.dataset_pointer
 
+            if tiler is not None:
+                tiler.set_dimensions(dataloader_v.get_dataset_dimension(
+                    dataloader_v.get_directory_name_with_pointer(dataloader_v.dataset_pointer)))
+
             # Loss for this batch
             loss_batch = 0
             err_batch = 0
@@ -315,29 +387,22 @@ def main():
             # For each sequence
             for sequence in range(dataloader_v.batch_size):
                 # Get data corresponding to the current sequence
-                x_seq, _, d_seq, numPedsList_seq, PedsList_seq = x[sequence], y[sequence], d[sequence], numPedsList[
-                    sequence], PedsList[sequence]
-                target_id = target_ids[sequence]
+                prepared = prepared_batch[sequence]
+                numPedsList_seq, PedsList_seq = prepared['numPedsList_seq'], prepared['PedsList_seq']
+                target_id = prepared['target_id']
 
-                folder_name = dataloader_v.get_directory_name_with_pointer(d_seq)
-                dataset_data = dataloader_v.get_dataset_dimension(folder_name)
-
-                # dense vector creation
-                x_seq, lookup_seq = dataloader_v.convert_proper_array(x_seq, numPedsList_seq, PedsList_seq)
+                # precomputed dense vector and grid masks
+                x_seq, lookup_seq = prepared['x_seq'], prepared['lookup_seq']
 
                 # will be used for error calculation
                 orig_x_seq = x_seq.clone()
                 target_id_values = x_seq[0][lookup_seq[target_id], 0:2]
 
-                # grid mask calculation
-                if args.method == 2:  # obstacle lstm
-                    grid_seq = getSequenceGridMask(x_seq, dataset_data, PedsList_seq, args.neighborhood_size,
-                                                   args.grid_size, args.use_cuda, True)
-                elif args.method == 1:  # social lstm
-                    grid_seq = getSequenceGridMask(x_seq, dataset_data, PedsList_seq, args.neighborhood_size,
-                                                   args.grid_size, args.use_cuda)
-                # vectorize trajectories in sequence
-                x_seq, first_values_dict = vectorize_seq(x_seq, PedsList_seq, lookup_seq)
+                grid_seq = prepared['grid_seq']
+                if args.use_cuda and grid_seq is not None:
+                    grid_seq = [grid.cuda() for grid in grid_seq]
+                # vectorized trajectories in sequence
+                x_seq, first_values_dict = prepared['vectorized_x_seq'], prepared['first_values_dict']
 
                 # <--------------Experimental block ---------------> Construct variables x_seq, lookup_seq =
                 # dataloader_v.convert_proper_array(x_seq, numPedsList_seq, PedsList_seq) x_seq, target_id_values,
@@ -351,7 +416,7 @@ def main():
 
                 if args.method == 3:  # vanilla lstm
                     ret_x_seq, loss = sample_validation_data_vanilla(x_seq, PedsList_seq, args, net, lookup_seq,
-                                                                     numPedsList_seq, dataloader_v)
+                                                                     numPedsList_seq, dataloader_v, tiler)
 
                 else:
                     ret_x_seq, loss = sample_validation_data(x_seq, PedsList_seq, grid_seq, args, net, lookup_seq,
@@ -418,6 +483,9 @@ def main():
         print('error = {:.3f}, time = {:.3f}'.format(curr_arg.avg_err, curr_arg.time))
         log_file.write('error = {:.3f}, time = {:.3f}'.format(curr_arg.avg_err, curr_arg.time) + '\n')
 
+    if tiler is not None:
+        tiler.close()
+
 
 if __name__ == '__main__':
     main()
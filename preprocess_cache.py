@@ -0,0 +1,112 @@
+"""
+Python script for caching the pre-processed data file by file. Each file gets its own single dataset store, so adding
+or changing a file only pre-processes that file again
+"""
+import hashlib
+import json
+import os
+
+from trajectory_store import STORE_VERSION, CompositeStore, cache_key, read_manifest
+
+SOURCE_FILE = 'source.json'
+
+
+def file_stat(path):
+    """
+    Return the path, size and modification time of a file
+    :param path:
+    :return:
+    """
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class PreprocessCache:
+    """
+    Directory of pre-processed files. An entry is keyed by the path of the file and the pre-processing parameters,
+    and is up to date if its store has been built with the content hash of the file. The size and mtime of the file
+    are recorded next to the store, the content is only hashed again when they change
+    """
+
+    def __init__(self, path):
+        """
+        Initializer function
+        params:
+        path: cache directory
+        """
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def entry_path(self, data_dir, params):
+        """
+        Return the store directory of a file pre-processed with the given parameters
+        :param data_dir: path of the file
+        :param params: dictionary of pre-processing parameters
+        :return:
+        """
+        sha = hashlib.sha1(json.dumps({'path': os.path.abspath(data_dir), 'params': params}, sort_keys=True).encode())
+        return os.path.join(self.path, '%s-%s.store' % (os.path.basename(data_dir), sha.hexdigest()[:16]))
+
+    def entry_key(self, data_dir, params):
+        """
+        Return the key the store of a file must be built with
+        :param data_dir:
+        :param params:
+        :return:
+        """
+        return cache_key([data_dir], params)
+
+    def is_current(self, data_dir, params):
+        """
+        Check if the entry of a file is up to date
+        :param data_dir:
+        :param params:
+        :return:
+        """
+        entry_path = self.entry_path(data_dir, params)
+        manifest = read_manifest(entry_path)
+        if manifest is None or manifest.get('version') != STORE_VERSION:
+            return False
+
+        stat = file_stat(data_dir)
+        source_path = os.path.join(entry_path, SOURCE_FILE)
+        if os.path.isfile(source_path):
+            with open(source_path, 'r') as f:
+                if json.load(f) == stat:
+                    return True
+
+        # size or mtime changed (or unknown): the file is only pre-processed again if its content changed
+        if manifest.get('key') != self.entry_key(data_dir, params):
+            return False
+        self.record_source(data_dir, params, stat)
+        return True
+
+    def record_source(self, data_dir, params, stat):
+        """
+        Record the size and mtime of a file next to its entry
+        :param data_dir:
+        :param params:
+        :param stat: file_stat of the file, taken before it was read
+        :return:
+        """
+        with open(os.path.join(self.entry_path(data_dir, params), SOURCE_FILE), 'w') as f:
+            json.dump(stat, f)
+
+    def stale_files(self, data_dirs, params):
+        """
+        Return the files whose entry is missing or outdated
+        :param data_dirs: List of directories where raw data resides
+        :param params:
+        :return:
+        """
+        return [data_dir for data_dir in data_dirs if not self.is_current(data_dir, params)]
+
+    def open(self, data_dirs, params):
+        """
+        Open the entries of a list of files as one store, datasets in the order of the files
+        :param data_dirs:
+        :param params:
+        :return:
+        """
+        return CompositeStore([self.entry_path(data_dir, params) for data_dir in data_dirs])
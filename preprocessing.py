@@ -0,0 +1,219 @@
+"""
+Python script includes the methods for reading raw trajectory files and grouping their rows into frames
+"""
+import math
+import os
+import shutil
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+COLUMN_NAMES = ['frame_num', 'ped_id', 'y', 'x']
+
+# Rough size of a row in the txt files, used to size the buckets of the streaming mode
+ROW_BYTES = 32
+
+
+def group_frames(data):
+    """
+    Group the rows of a trajectory file by frame number with a single sort instead of one scan per row.
+    Rows of a frame keep their file order. If a ped appears more than once in a frame, all of its rows get the
+    position of its first row in that frame (same as the scan based approach)
+    :param data: array of shape num_rows x 4, each row being [frame_num, ped_id, y, x]
+    :return:
+        frame_rows: array of shape num_rows x 3, each row being [pedID, x, y], grouped frame by frame
+        frame_offsets: array of shape num_frames+1, rows of frame i are frame_rows[frame_offsets[i]:frame_offsets[i+1]]
+        row_frames: array of shape num_rows, index of the frame each row of the file belongs to
+    """
+    data = np.asarray(data)
+    num_rows = data.shape[0]
+
+    # sorted unique frame numbers and the frame index of each row
+    frames, row_frames = np.unique(data[:, 0], return_inverse=True)
+    row_frames = row_frames.reshape(-1)
+
+    # stable sort keeps the file order inside each frame
+    order = np.argsort(row_frames, kind='stable')
+    sorted_data = data[order]
+
+    frame_offsets = np.zeros(len(frames) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_frames, minlength=len(frames)), out=frame_offsets[1:])
+
+    # (frame, ped) key of each sorted row -> position of the first row with the same key
+    _, ped_index = np.unique(sorted_data[:, 1], return_inverse=True)
+    keys = row_frames[order].astype(np.int64) * (num_rows + 1) + ped_index.reshape(-1)
+    _, first_index, key_inverse = np.unique(keys, return_index=True, return_inverse=True)
+    position_index = first_index[key_inverse.reshape(-1)]
+
+    # Swap x and y points (in txt file it is like -> y,x)
+    frame_rows = np.column_stack((sorted_data[:, 1], sorted_data[position_index, 3], sorted_data[position_index, 2]))
+
+    return frame_rows, frame_offsets, row_frames
+
+
+def split_frames(frame_rows, frame_offsets):
+    """
+    Split grouped frame rows into one array per frame
+    :param frame_rows:
+    :param frame_offsets:
+    :return: list of arrays of shape numPeds x 3
+    """
+    return np.split(frame_rows, frame_offsets[1:-1])
+
+
+def read_trajectory_file(directory, test_format, chunk_rows=None):
+    """
+    Read a trajectory file. In test files the positions to predict are written as '?'. The '?' token is parsed as
+    NaN by the C parser of pandas, so no python code runs per cell
+    :param directory: path of the txt file
+    :param test_format: true for test files
+    :param chunk_rows: if given, the file is read in blocks of chunk_rows rows
+    :return: dataframe (iterator of dataframes if chunk_rows is given)
+    """
+    if not test_format:
+        return pd.read_csv(directory, dtype={'frame_num': 'int', 'ped_id': 'int'}, delimiter='\t', header=None,
+                           names=COLUMN_NAMES, chunksize=chunk_rows)
+
+    return pd.read_csv(directory, delimiter='\t', header=None, names=COLUMN_NAMES,
+                       dtype={'frame_num': np.int64, 'ped_id': np.int64, 'y': np.float32, 'x': np.float32},
+                       na_values={'y': ['?'], 'x': ['?']}, keep_default_na=False, chunksize=chunk_rows)
+
+
+def get_target_ids(df, test_format):
+    """
+    Return the target ped ids of a file, in order of first appearance
+    :param df: dataframe of the file (or of a block of the file)
+    :param test_format: true for test files, the targets are the peds with unknown positions
+    :return:
+    """
+    ped_ids = df['ped_id'].to_numpy()
+    if test_format:
+        ped_ids = ped_ids[np.isnan(df['y'].to_numpy())]
+    return pd.unique(ped_ids)
+
+
+def read_test_file(directory):
+    """
+    Read a test file
+    :param directory: path of the txt file
+    :return: dataframe with int64 frame_num, ped_id and float32 y, x columns, target ped ids
+    """
+    df = read_trajectory_file(directory, True)
+    return df, get_target_ids(df, True)
+
+
+def preprocess_file(directory, params):
+    """
+    Read a trajectory file and group its rows by frame
+    :param directory: path of the txt file
+    :param params: pre-processing parameters (test_format, val_fraction)
+    :return: dictionary of the arrays of the pre-processed dataset
+        frame_rows: [pedID, x, y] rows of all the frames, grouped frame by frame
+        frame_offsets: offsets of each frame in frame_rows
+        row_frames: frame of each row of the file. Each row gives one entry holding all the peds of its frame
+        orig_data: original copy of the file
+        target_ids: target ped ids of the file
+        num_valid: number of leading entries used as validation data
+    """
+    # Load the data from the txt file
+    print("Now processing: ", directory)
+    df = read_trajectory_file(directory, params['test_format'])
+    target_ids = get_target_ids(df, params['test_format'])
+
+    # Convert pandas -> numpy array
+    data = np.array(df)
+
+    # Group the rows by frame number: [pedID, x, y] rows of each frame and the frame of each row
+    frame_rows, frame_offsets, row_frames = group_frames(data)
+
+    return {'frame_rows': frame_rows, 'frame_offsets': frame_offsets, 'row_frames': row_frames, 'orig_data': data,
+            'target_ids': target_ids, 'num_valid': int(math.ceil(len(data) * params['val_fraction']))}
+
+
+def stream_file(directory, params, writer, chunk_rows=1000000):
+    """
+    Pre-process a trajectory file in blocks of chunk_rows rows and write it straight into a store, without
+    holding the whole file in memory. The files are ordered by ped, so the rows of a frame are spread over the
+    whole file: each block is first scattered into frame buckets on disk (frame_num modulo the number of buckets,
+    so a frame is never split between buckets), then each bucket is grouped in memory and its frames are written.
+    Last, the frame of each row is looked up block by block
+    :param directory: path of the txt file
+    :param params: pre-processing parameters (test_format, val_fraction)
+    :param writer: StoreWriter the dataset is appended to
+    :param chunk_rows: number of rows read at once
+    :return:
+    """
+    print("Now processing: ", directory)
+    bucket_path = os.path.join(writer.tmp_path, 'buckets')
+    os.makedirs(bucket_path)
+    frames_file = os.path.join(bucket_path, 'frames.bin')
+    # about chunk_rows rows per bucket
+    num_buckets = max(1, int(math.ceil(os.path.getsize(directory) / float(ROW_BYTES * chunk_rows))))
+    bucket_files = [os.path.join(bucket_path, '%d.bin' % bucket) for bucket in range(num_buckets)]
+
+    # First pass: rows are written to the store as they come and scattered into buckets as [row, frame, ped, y, x]
+    num_rows = 0
+    target_ids = []
+    with open(frames_file, 'wb') as f:
+        for df in read_trajectory_file(directory, params['test_format'], chunk_rows):
+            data = np.array(df)
+            writer.write('orig_data', data)
+            data[:, 0].tofile(f)
+            target_ids.append(get_target_ids(df, params['test_format']))
+
+            rows = np.column_stack((np.arange(num_rows, num_rows + len(data)), data))
+            buckets = data[:, 0].astype(np.int64) % num_buckets
+            for bucket in np.unique(buckets):
+                with open(bucket_files[bucket], 'ab') as bucket_file:
+                    rows[buckets == bucket].tofile(bucket_file)
+            num_rows += len(data)
+
+    # Second pass: the buckets hold complete frames, each one is grouped like a whole file
+    bucket_frames = []
+    for bucket_file in bucket_files:
+        if not os.path.exists(bucket_file):
+            bucket_frames.append((0, np.empty(0)))
+            continue
+        rows = np.fromfile(bucket_file).reshape(-1, 5)
+        os.remove(bucket_file)
+        frame_rows, frame_offsets, _ = group_frames(rows[:, 1:])
+        first_frame = writer.write_frames(frame_rows, frame_offsets)
+        # group_frames orders the frames of the bucket by frame number
+        bucket_frames.append((first_frame, np.unique(rows[:, 1])))
+
+    # Third pass: frame index of each row
+    frames = np.memmap(frames_file, dtype=np.float64, mode='r') if num_rows else np.empty(0)
+    for begin in range(0, num_rows, chunk_rows):
+        block = np.asarray(frames[begin:begin + chunk_rows])
+        buckets = block.astype(np.int64) % num_buckets
+        row_frames = np.empty(len(block), dtype=np.int64)
+        for bucket in np.unique(buckets):
+            first_frame, bucket_frame_nums = bucket_frames[bucket]
+            in_bucket = buckets == bucket
+            row_frames[in_bucket] = first_frame + np.searchsorted(bucket_frame_nums, block[in_bucket])
+        writer.write('row_frames', row_frames)
+    del frames
+    shutil.rmtree(bucket_path)
+
+    target_ids = pd.unique(np.concatenate(target_ids)) if target_ids else np.empty(0, dtype=np.int64)
+    writer.write('target_ids', target_ids)
+    writer.end_dataset(int(math.ceil(num_rows * params['val_fraction'])))
+
+
+def preprocess_files(data_dirs, params, num_workers=1):
+    """
+    Pre-process a list of trajectory files, each file in a worker process if num_workers > 1
+    :param data_dirs: List of directories where raw data resides
+    :param params: pre-processing parameters (test_format, val_fraction)
+    :param num_workers: number of worker processes
+    :return: list of pre-processed datasets in the order of data_dirs
+    """
+    num_workers = min(num_workers, len(data_dirs))
+    if num_workers <= 1:
+        return [preprocess_file(directory, params) for directory in data_dirs]
+
+    # map keeps the order of data_dirs whatever the order the workers finish in
+    with Pool(num_workers) as pool:
+        return pool.map(partial(preprocess_file, params=params), data_dirs, chunksize=1)
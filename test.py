@@ -6,8 +6,9 @@ import pickle
 import subprocess
 import time
 
-from grid import getSequenceGridMask, getGridMask
+from grid import getSequenceGridMask, GridMaskUpdater
 from helper import *
+from tiling import SceneTiler
 from utils import DataLoader
 
 
@@ -39,12 +40,25 @@ def get_parser_args():
     # method selection
     parser.add_argument('--method', type=int, default=1,
                         help='Method of lstm will be used (1 = social lstm, 2 = obstacle lstm, 3 = vanilla lstm)')
+    # number of worker processes for preprocessing
+    parser.add_argument('--preprocess_workers', type=int, default=1,
+                        help='Number of worker processes used to preprocess the data files')
+    # number of rows read at once when preprocessing in streaming mode
+    parser.add_argument('--preprocess_chunk_rows', type=int, default=0,
+                        help='Preprocess the data files in blocks of this number of rows (0: whole files in memory)')
+    # side of the tiles of large scenes
+    parser.add_argument('--tile_size', type=int, default=0,
+                        help='Compute the grid masks and the model steps tile by tile, with tiles of this side '
+                             '(0: whole frames)')
+    # number of worker processes computing the tiles
+    parser.add_argument('--tile_workers', type=int, default=0,
+                        help='Number of worker processes computing the tiles (0: computed by the main process)')
 
     return parser.parse_args()
 
 
 def sample(x_seq, Pedlist, args, net, true_x_seq, true_Pedlist, saved_args, dimensions, dataloader, look_up,
-           num_pedlist, is_gru, grid=None):
+           num_pedlist, is_gru, grid=None, tiler=None):
     """
     The sample function
     params:
@@ -57,6 +71,7 @@ def sample(x_seq, Pedlist, args, net, true_x_seq, true_Pedlist, saved_args, dime
     saved_args: Training arguments
     dimensions: The dimensions of the dataset
     target_id: ped_id number that try to predict in this sequence
+    tiler: SceneTiler running the steps of the vanilla model tile by tile, None to run them on whole frames
     """
     # Number of peds in the sequence
     numx_seq = len(look_up)
@@ -81,7 +96,10 @@ def sample(x_seq, Pedlist, args, net, true_x_seq, true_Pedlist, saved_args, dime
 
         # For the observed part of the trajectory
         for tstep in range(args.obs_length - 1):
-            if grid is None:  # vanilla lstm
+            if grid is None and tiler is not None:  # vanilla lstm, tile by tile
+                out_obs, hidden_states, cell_states = tiler.model_step(x_seq[tstep], hidden_states, cell_states,
+                                                                       Pedlist[tstep], look_up)
+            elif grid is None:  # vanilla lstm
                 # Do a forward prop
                 out_obs, hidden_states, cell_states = net(x_seq[tstep].view(1, numx_seq, 2), hidden_states, cell_states,
                                                           [Pedlist[tstep]], [num_pedlist[tstep]], dataloader, look_up)
@@ -105,6 +123,9 @@ def sample(x_seq, Pedlist, args, net, true_x_seq, true_Pedlist, saved_args, dime
         # Last seen grid
         if grid is not None:  # no vanilla lstm
             prev_grid = grid[-1].clone()
+            # grid masks of the predicted positions, updated step by step on the device of the positions
+            grid_updater = GridMaskUpdater(dimensions, saved_args.neighborhood_size, saved_args.grid_size,
+                                           args.method == 2, max_neighbors=getattr(saved_args, 'max_neighbors', 0))
 
         # assign last position of observed data to temp
         # temp_last_observed = ret_x_seq[args.obs_length-1].clone()
@@ -113,7 +134,10 @@ def sample(x_seq, Pedlist, args, net, true_x_seq, true_Pedlist, saved_args, dime
         # For the predicted part of the trajectory
         for tstep in range(args.obs_length - 1, args.pred_length + args.obs_length - 1):
             # Do a forward prop
-            if grid is None:  # vanilla lstm
+            if grid is None and tiler is not None:  # vanilla lstm, tile by tile
+                outputs, hidden_states, cell_states = tiler.model_step(ret_x_seq[tstep], hidden_states, cell_states,
+                                                                       true_Pedlist[tstep], look_up)
+            elif grid is None:  # vanilla lstm
                 outputs, hidden_states, cell_states = net(ret_x_seq[tstep].view(1, numx_seq, 2), hidden_states,
                                                           cell_states, [true_Pedlist[tstep]], [num_pedlist[tstep]],
                                                           dataloader, look_up)
@@ -145,17 +169,8 @@ def sample(x_seq, Pedlist, args, net, true_x_seq, true_Pedlist, saved_args, dime
             current_x_seq = torch.index_select(ret_x_seq[tstep + 1], 0, list_of_x_seq)
 
             if grid is not None:  # no vanilla lstm
-                # Compute the new grid masks with the predicted positions
-                if args.method == 2:  # obstacle lstm
-                    prev_grid = getGridMask(current_x_seq.data.cpu(), dimensions, len(true_Pedlist[tstep + 1]),
-                                            saved_args.neighborhood_size, saved_args.grid_size, True)
-                elif args.method == 1:  # social lstm
-                    prev_grid = getGridMask(current_x_seq.data.cpu(), dimensions, len(true_Pedlist[tstep + 1]),
-                                            saved_args.neighborhood_size, saved_args.grid_size)
-
-                prev_grid = Variable(torch.from_numpy(prev_grid).float())
-                if args.use_cuda:
-                    prev_grid = prev_grid.cuda()
+                # Update the grid masks with the predicted positions (occupancy map for obstacle lstm)
+                prev_grid = Variable(grid_updater.update(current_x_seq, len(true_Pedlist[tstep + 1])))
 
         # ret_x_seq[args.obs_length-1] = temp_last_observed
 
@@ -223,7 +238,8 @@ if __name__ == '__main__':
     seq_lenght = sample_args.pred_length + sample_args.obs_length
 
     # Create the DataLoader object
-    dataloader = DataLoader(f_prefix, 1, seq_lenght, forcePreProcess=True, infer=True)
+    dataloader = DataLoader(f_prefix, 1, seq_lenght, infer=True, preprocess_workers=sample_args.preprocess_workers,
+                            preprocess_chunk_rows=sample_args.preprocess_chunk_rows)
     create_directories(os.path.join(result_directory, model_name), dataloader.get_all_directory_namelist())
     create_directories(plot_directory, [plot_test_file_directory])
     dataloader.reset_batch_pointer()
@@ -238,6 +254,14 @@ if __name__ == '__main__':
     submission_store = []  # store submission data points (txt)
     result_store = []  # store points for plotting
 
+    # grid masks (social methods) or model steps (vanilla) of large scenes tile by tile, the tiles are cut for the
+    # dimensions of the dataset of each sequence
+    tiler = None
+    if sample_args.tile_size > 0:
+        tiler = SceneTiler(dataloader.get_dataset_dimension(dataloader.get_directory_name_with_pointer(0)),
+                           getattr(saved_args, 'neighborhood_size', 0), getattr(saved_args, 'grid_size', 0),
+                           sample_args.tile_size, getattr(saved_args, 'max_neighbors', 0), sample_args.tile_workers)
+
     for iteration in range(sample_args.iteration):
         # Initialize net
         net = get_model(sample_args.method, saved_args, True)
@@ -254,6 +278,10 @@ if __name__ == '__main__':
             net.load_state_dict(checkpoint['state_dict'])
             print('Loaded checkpoint at epoch', model_epoch)
 
+        # the workers of the tiler step with the parameters of the loaded checkpoint
+        if tiler is not None and sample_args.method == 3:
+            tiler.set_net(net)
+
         # For each batch
         iteration_submission = []
         iteration_result = []
@@ -287,13 +315,20 @@ if __name__ == '__main__':
 
             target_id_values = orig_x_seq[0][lookup_seq[target_id], 0:2]
 
+            if tiler is not None:
+                tiler.set_dimensions(dataset_data)
+
             # grid mask calculation
-            if sample_args.method == 2:  # obstacle lstm
+            if tiler is not None and sample_args.method in [1, 2]:
+                grid_seq = tiler.sequence_grid_mask(x_seq, PedsList_seq, saved_args.use_cuda, sample_args.method == 2)
+            elif sample_args.method == 2:  # obstacle lstm
                 grid_seq = getSequenceGridMask(x_seq, dataset_data, PedsList_seq, saved_args.neighborhood_size,
-                                               saved_args.grid_size, saved_args.use_cuda, True)
+                                               saved_args.grid_size, saved_args.use_cuda, True,
+                                               max_neighbors=getattr(saved_args, 'max_neighbors', 0))
             elif sample_args.method == 1:  # social lstm
                 grid_seq = getSequenceGridMask(x_seq, dataset_data, PedsList_seq, saved_args.neighborhood_size,
-                                               saved_args.grid_size, saved_args.use_cuda)
+                                               saved_args.grid_size, saved_args.use_cuda,
+                                               max_neighbors=getattr(saved_args, 'max_neighbors', 0))
 
             # Vectorize data points
             x_seq, first_values_dict = vectorize_seq(x_seq, PedsList_seq, lookup_seq)
@@ -313,7 +348,8 @@ if __name__ == '__main__':
                 # Extract the observed part of the trajectories
                 obs_traj, obs_PedsList_seq = x_seq[:sample_args.obs_length], PedsList_seq[:sample_args.obs_length]
                 ret_x_seq = sample(obs_traj, obs_PedsList_seq, sample_args, net, x_seq, PedsList_seq, saved_args,
-                                   dataset_data, dataloader, lookup_seq, numPedsList_seq, sample_args.gru)
+                                   dataset_data, dataloader, lookup_seq, numPedsList_seq, sample_args.gru,
+                                   tiler=tiler)
 
             else:
                 # Extract the observed part of the trajectories
@@ -387,3 +423,6 @@ if __name__ == '__main__':
     dataloader.write_to_plot_file(result_store[smallest_err_iter_num],
                                   os.path.join(plot_directory, plot_test_file_directory))
 
+    if tiler is not None:
+        tiler.close()
+
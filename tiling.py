@@ -0,0 +1,281 @@
+"""
+Python script for computing the grids and model steps of very large scenes tile by tile. The scene is split into
+square tiles, each tile holds its own peds (core) and the peds of a halo margin around it, wide enough for the grids
+of the core peds to be complete. Tiles are computed in worker processes and stitched back, so a worker only ever
+holds the peds of one tile
+"""
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+
+from grid import getGridIndices
+from vlstm_model import VLSTMModel
+
+# model of the worker processes, built once by init_worker
+worker_net = None
+
+
+def init_worker(model_args, state_dict):
+    """
+    Build the model of a worker process. Each worker uses one thread, the workers share the cores
+    :param model_args: arguments of the model
+    :param state_dict: parameters of the model
+    :return:
+    """
+    global worker_net
+    torch.set_num_threads(1)
+    if model_args is not None:
+        worker_net = VLSTMModel(model_args, True)
+        worker_net.load_state_dict(state_dict)
+        worker_net.eval()
+
+
+def tile_grid_indices(tile, dimensions, neighborhood_size, grid_size, max_neighbors=0):
+    """
+    Compute the grid triples of the core peds of a tile
+    :param tile: (positions of the tile peds, core flag of the tile peds)
+    :param dimensions:
+    :param neighborhood_size:
+    :param grid_size:
+    :param max_neighbors:
+    :return: (ego, neighbor, cell) triples, indices local to the tile
+    """
+    positions, core = tile
+    grid_indices = getGridIndices(torch.from_numpy(positions), dimensions, len(positions), neighborhood_size,
+                                  grid_size, max_neighbors)
+    return grid_indices[core[grid_indices[:, 0]]]
+
+
+def tile_step(tile, net=None):
+    """
+    Run one model step on the peds of a tile
+    :param tile: (positions, hidden states, cell states) of the tile peds, cell states None for a GRU
+    :param net: model, the model of the worker process if None
+    :return: outputs, hidden states and cell states of the tile peds
+    """
+    net = worker_net if net is None else net
+    positions, hidden_states, cell_states = tile
+    with torch.no_grad():
+        return net.step(positions, hidden_states, cell_states)
+
+
+class SceneTiler:
+    """
+    Splits the frames of a scene into tiles of tile_size (in the units of neighborhood_size) with halo margins of
+    neighborhood_size, and computes the grids and model steps of the frames tile by tile. The stitched results are
+    the ones of the whole frame
+    """
+
+    def __init__(self, dimensions, neighborhood_size, grid_size, tile_size, max_neighbors=0, num_workers=0,
+                 net=None):
+        """
+        Initializer function
+        params:
+        dimensions : This will be a list [width, height]
+        neighborhood_size : Scalar value representing the size of neighborhood considered
+        grid_size : Scalar value representing the size of the grid discretization
+        tile_size : side of the tiles, in the units of neighborhood_size
+        max_neighbors : if not 0, only the nearest max_neighbors neighbors of each ped are in its grid
+        num_workers : number of worker processes, 0 to compute the tiles in the calling process
+        net : VLSTMModel of the model steps (no model steps if None). The workers get a copy of its parameters when
+        they start, see set_net
+        """
+        self.neighborhood_size = neighborhood_size
+        self.grid_size = grid_size
+        self.tile_size = tile_size
+        self.max_neighbors = max_neighbors
+        self.num_workers = num_workers
+
+        self.set_dimensions(dimensions)
+        self.pool = None
+        self.set_net(net)
+
+    def set_dimensions(self, dimensions):
+        """
+        Set the dimensions of the scene, the tiles of the next frames are cut for them
+        :param dimensions: This will be a list [width, height]
+        :return:
+        """
+        self.dimensions = dimensions
+        # tile side and halo width in the frame coordinates (the grid of a ped spans neighborhood_size)
+        width, height = dimensions[0], dimensions[1]
+        self.tile_bound = np.array([self.tile_size / (width * 1.0), self.tile_size / (height * 1.0)]) * 2
+        self.halo_bound = np.array([self.neighborhood_size / (width * 1.0),
+                                    self.neighborhood_size / (height * 1.0)]) * 2
+
+    def set_net(self, net):
+        """
+        Set the model of the model steps. The worker processes only hold a copy of the parameters taken when they
+        start, so they are restarted here: call it again whenever the parameters of the model change (checkpoint
+        loaded, training epoch), or the workers keep stepping with the old ones
+        :param net: VLSTMModel, None for no model steps
+        :return:
+        """
+        self.close()
+        self.net = net
+        if self.num_workers > 0:
+            model_args = None if net is None else net.args
+            state_dict = None if net is None else {name: value.cpu() for name, value in net.state_dict().items()}
+            self.pool = Pool(self.num_workers, initializer=init_worker, initargs=(model_args, state_dict))
+
+    def tiles(self, frame, present=None):
+        """
+        Split the peds of a frame into tiles. Present peds without a finite position are put in the first tile, so
+        they are computed as in the whole frame
+        :param frame: MNP x 2 array or tensor of positions
+        :param present: indices of the peds present in the frame, the peds with a finite position if None
+        :return: list of (core, members) index arrays of the non empty tiles: the peds of the tile and the peds of
+        the tile and its halo, in increasing order
+        """
+        positions = np.asarray(frame)[:, :2]
+        if present is None:
+            present = np.flatnonzero(np.isfinite(positions).all(axis=1))
+        present = np.unique(np.asarray(present, dtype=np.int64))
+        finite = np.isfinite(positions[present]).all(axis=1)
+        located, unlocated = present[finite], present[~finite]
+        if len(located) == 0:
+            return [(unlocated, unlocated)] if len(unlocated) else []
+
+        origin = positions[located].min(axis=0)
+        tile = np.floor((positions[located] - origin) / self.tile_bound).astype(np.int64)
+        num_tiles_x = tile[:, 0].max() + 1
+        tile_ids, tile_of_ped = np.unique(tile[:, 1] * num_tiles_x + tile[:, 0], return_inverse=True)
+
+        tiles = []
+        for number, tile_id in enumerate(tile_ids):
+            low = origin + np.array([tile_id % num_tiles_x, tile_id // num_tiles_x]) * self.tile_bound
+            low, high = low - self.halo_bound, low + self.tile_bound + self.halo_bound
+            in_halo = ((positions[located] >= low) & (positions[located] < high)).all(axis=1)
+            tiles.append((located[tile_of_ped == number], located[in_halo]))
+
+        core, members = tiles[0]
+        tiles[0] = (np.union1d(core, unlocated), np.union1d(members, unlocated))
+        return tiles
+
+    def map(self, function, tiles):
+        """
+        Apply a function to tiles, in the worker processes if any
+        :param function:
+        :param tiles:
+        :return: results in the order of the tiles
+        """
+        if self.pool is None:
+            return [function(tile) for tile in tiles]
+        return self.pool.map(function, tiles, chunksize=1)
+
+    def grid_indices(self, frame):
+        """
+        Compute the grid triples of a frame tile by tile
+        :param frame: MNP x 2 array or tensor of positions
+        :return: (ego, neighbor, cell) triples in row-major order, the same as getGridIndices of the whole frame
+        """
+        positions = np.asarray(frame)[:, :2]
+        tiles = self.tiles(positions)
+        function = partial(tile_grid_indices, dimensions=self.dimensions, neighborhood_size=self.neighborhood_size,
+                           grid_size=self.grid_size, max_neighbors=self.max_neighbors)
+        results = self.map(function, [(positions[members], np.isin(members, core)) for core, members in tiles])
+
+        # local tile indices back to frame indices
+        grid_indices = [np.column_stack((members[local[:, 0]], members[local[:, 1]], local[:, 2]))
+                        for (_, members), local in zip(tiles, results)]
+        grid_indices = np.concatenate(grid_indices) if grid_indices else np.empty((0, 3), dtype=np.int64)
+        return grid_indices[np.lexsort((grid_indices[:, 1], grid_indices[:, 0]))].astype(np.int64)
+
+    def occupancy_map(self, frame, counts=False):
+        """
+        Compute the occupancy map of a frame tile by tile
+        :param frame: MNP x 2 array or tensor of positions
+        :param counts: return the number of peds in each cell instead of the binary occupancy
+        :return: float64 array of shape MNP x grid_size**2, the same as getOccupancyMap of the whole frame
+        """
+        grid_indices = self.grid_indices(frame)
+        occupancy = np.bincount(grid_indices[:, 0] * self.grid_size ** 2 + grid_indices[:, 2],
+                                minlength=len(frame) * self.grid_size ** 2).reshape(len(frame), -1)
+        return occupancy.astype(np.float64) if counts else (occupancy > 0).astype(np.float64)
+
+    def grid_mask(self, frame, is_occupancy=False):
+        """
+        Compute the grid mask of a frame tile by tile
+        :param frame: MNP x 2 array or tensor of positions
+        :param is_occupancy: compute the occupancy map instead of the social grid mask
+        :return: the same as getGridMask of the whole frame
+        """
+        if is_occupancy:
+            return self.occupancy_map(frame)
+
+        grid_indices = self.grid_indices(frame)
+        frame_mask = np.zeros((len(frame), len(frame), self.grid_size ** 2))
+        frame_mask[grid_indices[:, 0], grid_indices[:, 1], grid_indices[:, 2]] = 1
+        return frame_mask
+
+    def sequence_grid_mask(self, sequence, pedlist_seq, using_cuda, is_occupancy=False):
+        """
+        Compute the grid masks of the frames of a sequence tile by tile
+        :param sequence: SL x MNP x 2 tensor of positions
+        :param pedlist_seq: peds of each frame, the grid of frame i is computed on its first len(pedlist_seq[i])
+        peds
+        :param using_cuda: move the masks to the GPU
+        :param is_occupancy: compute the occupancy maps instead of the social grid masks
+        :return: the same as getSequenceGridMask
+        """
+        sequence_mask = []
+        for i in range(len(sequence)):
+            frame = sequence[i][:len(pedlist_seq[i])].detach().cpu()
+            mask = torch.from_numpy(self.grid_mask(frame, is_occupancy)).float()
+            if using_cuda:
+                mask = mask.cuda()
+            sequence_mask.append(mask)
+        return sequence_mask
+
+    def step(self, frame, hidden_states, cell_states=None, present=None):
+        """
+        Run one model step on the peds of a frame tile by tile. The steps of the peds are independent, each tile
+        only runs its core peds
+        :param frame: MNP x 2 tensor of positions
+        :param hidden_states: MNP x rnn_size tensor
+        :param cell_states: MNP x rnn_size tensor, None for a GRU
+        :param present: indices of the peds present in the frame, the peds with a finite position if None
+        :return: outputs (MNP x output_size), hidden states and cell states of the peds, zeros and unchanged states
+        for the peds not present
+        """
+        tiles = [(torch.from_numpy(core), members) for core, members in self.tiles(frame.detach().cpu(), present)]
+        # the models of the workers are on the cpu
+        device = 'cpu' if self.pool is not None else hidden_states.device
+        results = self.map(partial(tile_step, net=None if self.pool is not None else self.net),
+                           [(frame[core].to(device), hidden_states[core].to(device),
+                             None if cell_states is None else cell_states[core].to(device)) for core, _ in tiles])
+
+        outputs = torch.zeros(len(frame), self.net.output_size, device=hidden_states.device)
+        hidden_states, cell_states = hidden_states.clone(), None if cell_states is None else cell_states.clone()
+        for (core, _), (tile_outputs, tile_hidden, tile_cell) in zip(tiles, results):
+            outputs[core] = tile_outputs.to(outputs.device)
+            hidden_states[core] = tile_hidden.to(outputs.device)
+            if cell_states is not None:
+                cell_states[core] = tile_cell.to(outputs.device)
+        return outputs, hidden_states, cell_states
+
+    def model_step(self, frame, hidden_states, cell_states, pedlist, look_up):
+        """
+        Run one model step on a frame given as to VLSTMModel.forward, tile by tile
+        :param frame: MNP x 2 tensor of positions of the peds of the sequence
+        :param hidden_states: MNP x rnn_size tensor
+        :param cell_states: MNP x rnn_size tensor, None for a GRU
+        :param pedlist: ids of the peds present in the frame
+        :param look_up: lookup table of the sequence
+        :return: outputs (1 x MNP x output_size), hidden states and cell states, as VLSTMModel.forward of the frame
+        """
+        present = [look_up[int(ped_id)] for ped_id in pedlist]
+        outputs, hidden_states, cell_states = self.step(frame, hidden_states, cell_states, present)
+        return outputs.unsqueeze(0), hidden_states, cell_states
+
+    def close(self):
+        """
+        Stop the worker processes
+        :return:
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,352 @@
+"""
+Python script for keeping pre-processed trajectory data on disk as flat numpy arrays plus offsets.
+Stores are opened with np.memmap, so processes reading the same store share the same pages
+"""
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+# Version of the on-disk layout, bump it when the stored arrays change
+STORE_VERSION = 3
+
+MANIFEST_FILE = 'manifest.json'
+
+# Stored arrays -> (dtype, number of columns, the dimension the array is indexed by)
+STORE_ARRAYS = {
+    'frame_rows': (np.float32, 3, 'frame_rows'),
+    'frame_offsets': (np.int64, 0, 'frames'),
+    'row_frames': (np.int64, 0, 'rows'),
+    'orig_data': (np.float64, 4, 'rows'),
+    'target_ids': (np.int64, 0, 'targets'),
+}
+
+
+def file_digest(path, block_size=1 << 20):
+    """
+    Return the sha1 hex digest of a file content
+    :param path:
+    :param block_size:
+    :return:
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cache_key(data_dirs, params):
+    """
+    Return the key of a store given its source files and pre-processing parameters
+    :param data_dirs: list of source files, the order matters
+    :param params: dictionary of pre-processing parameters
+    :return:
+    """
+    sha = hashlib.sha1()
+    sha.update(json.dumps({'version': STORE_VERSION, 'params': params}, sort_keys=True).encode())
+    for path in data_dirs:
+        sha.update(os.path.basename(path).encode())
+        sha.update(file_digest(path).encode())
+    return sha.hexdigest()
+
+
+def read_manifest(path):
+    """
+    Return the manifest of a store or None if there is no (complete) store in the path
+    :param path:
+    :return:
+    """
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def is_current(path, key):
+    """
+    Check if the store in the path has been built with the given key
+    :param path:
+    :param key:
+    :return:
+    """
+    manifest = read_manifest(path)
+    return manifest is not None and manifest.get('version') == STORE_VERSION and manifest.get('key') == key
+
+
+class StoreWriter:
+    """
+    Incremental writer of a store. Arrays are appended to the files of the store as they come, so a dataset never
+    has to be held in memory as a whole. The store is only visible in its path once close is called
+    """
+
+    def __init__(self, path, key):
+        """
+        Initializer function
+        params:
+        path: store directory, replaced on close if it exists
+        key: cache key of the store
+        """
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+        self.manifest = {'version': STORE_VERSION, 'key': key, 'datasets': []}
+        self.files = {name: open(os.path.join(self.tmp_path, name + '.bin'), 'wb') for name in STORE_ARRAYS}
+
+        # Number of elements written for each array, in the whole store and before the current dataset
+        self.counts = {name: 0 for name in STORE_ARRAYS}
+        self.dataset_counts = dict(self.counts)
+
+    def write(self, name, array):
+        """
+        Append elements to a stored array of the current dataset. row_frames are frame indices local to the dataset
+        :param name:
+        :param array:
+        :return:
+        """
+        dtype = STORE_ARRAYS[name][0]
+        if name == 'row_frames':
+            array = np.asarray(array) + self.dataset_counts['frame_offsets']
+        np.ascontiguousarray(array, dtype=dtype).tofile(self.files[name])
+        self.counts[name] += len(array)
+
+    def write_frames(self, frame_rows, frame_offsets):
+        """
+        Append complete frames to the current dataset
+        :param frame_rows: [pedID, x, y] rows of the frames
+        :param frame_offsets: offsets of the frames in frame_rows, with the closing offset
+        :return: index of the first appended frame in the current dataset
+        """
+        first_frame = self.counts['frame_offsets'] - self.dataset_counts['frame_offsets']
+        # frame_offsets are stored without the closing offset, it is written once at the end
+        self.write('frame_offsets', np.asarray(frame_offsets[:-1]) + self.counts['frame_rows'])
+        self.write('frame_rows', frame_rows)
+        return first_frame
+
+    def end_dataset(self, num_valid):
+        """
+        Close the current dataset
+        :param num_valid: number of leading rows kept for validation
+        :return:
+        """
+        written = {name: self.counts[name] - self.dataset_counts[name] for name in STORE_ARRAYS}
+        if written['row_frames'] != written['orig_data']:
+            raise ValueError("%d row frames written for %d rows" % (written['row_frames'], written['orig_data']))
+
+        self.manifest['datasets'].append({'rows': written['orig_data'], 'frames': written['frame_offsets'],
+                                          'frame_rows': written['frame_rows'], 'targets': written['target_ids'],
+                                          'num_valid': int(num_valid)})
+        self.dataset_counts = dict(self.counts)
+
+    def add_dataset(self, dataset):
+        """
+        Append a pre-processed dataset held in memory
+        :param dataset: dictionary with the STORE_ARRAYS (frame_offsets and row_frames local to the dataset) and
+        num_valid
+        :return:
+        """
+        self.write_frames(dataset['frame_rows'], dataset['frame_offsets'])
+        for name in ['row_frames', 'orig_data', 'target_ids']:
+            self.write(name, dataset[name])
+        self.end_dataset(dataset['num_valid'])
+
+    def close(self):
+        """
+        Finish the store and move it to its path
+        :return:
+        """
+        self.write('frame_offsets', [self.counts['frame_rows']])
+        for f in self.files.values():
+            f.close()
+
+        # The manifest is written last, a store without manifest is never used
+        with open(os.path.join(self.tmp_path, MANIFEST_FILE), 'w') as f:
+            json.dump(self.manifest, f)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmp_path, self.path)
+
+
+def write_store(path, key, datasets):
+    """
+    Write pre-processed datasets as one store. Each dataset is a dictionary with the STORE_ARRAYS
+    (frame_offsets and row_frames local to the dataset) and num_valid, the number of leading rows kept for validation
+    :param path: store directory, replaced if it exists
+    :param key: cache key of the store
+    :param datasets: list of pre-processed datasets
+    :return:
+    """
+    writer = StoreWriter(path, key)
+    for dataset in datasets:
+        writer.add_dataset(dataset)
+    writer.close()
+
+
+class TrajectoryStore:
+    """
+    Read access to a store written by a StoreWriter
+    """
+
+    def __init__(self, path):
+        """
+        Initializer function
+        params:
+        path: store directory
+        """
+        self.path = path
+        self.manifest = read_manifest(path)
+        if self.manifest is None:
+            raise IOError("No pre-processed data in %s" % path)
+        self.datasets = self.manifest['datasets']
+
+        # Start offset of each dataset for each dimension
+        self.offsets = {}
+        for dim in ['rows', 'frames', 'frame_rows', 'targets']:
+            counts = [dataset[dim] for dataset in self.datasets]
+            self.offsets[dim] = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+
+        self.arrays = {name: self.read_array(name) for name in STORE_ARRAYS}
+
+    def read_array(self, name):
+        """
+        Read a stored array
+        :param name:
+        :return:
+        """
+        dtype, columns, dim = STORE_ARRAYS[name]
+        length = self.offsets[dim][-1] + (1 if name == 'frame_offsets' else 0)
+        shape = (length, columns) if columns else (length,)
+        if length == 0:
+            # an empty file can not be memory mapped
+            return np.empty(shape, dtype=dtype)
+        # Read only mapping of the file, the returned array is a plain ndarray view on the mapped pages
+        return np.asarray(np.memmap(os.path.join(self.path, name + '.bin'), dtype=dtype, mode='r', shape=shape))
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def get(self, name, dataset):
+        """
+        Return the part of a stored array belonging to a dataset
+        :param name:
+        :param dataset:
+        :return:
+        """
+        dim = STORE_ARRAYS[name][2]
+        begin, end = self.offsets[dim][dataset], self.offsets[dim][dataset + 1]
+        return self.arrays[name][begin:end]
+
+    def num_valid(self, dataset):
+        """
+        Return the number of leading rows of a dataset kept for validation
+        :param dataset:
+        :return:
+        """
+        return self.datasets[dataset]['num_valid']
+
+    def frame_sequence(self, dataset, valid=False, column=None):
+        """
+        Return the entries of a dataset as a FrameSequence
+        :param dataset:
+        :param valid: true for the leading entries kept for validation, false for the others
+        :param column: column of the frame rows to return (all columns if None)
+        :return:
+        """
+        row_frames = self.get('row_frames', dataset)
+        num_valid = self.num_valid(dataset)
+        row_frames = row_frames[:num_valid] if valid else row_frames[num_valid:]
+        return FrameSequence(self.arrays['frame_rows'], self.arrays['frame_offsets'], row_frames, column)
+
+    def num_peds(self, dataset, valid=False):
+        """
+        Return the number of peds of each entry of a dataset
+        :param dataset:
+        :param valid: true for the leading entries kept for validation, false for the others
+        :return:
+        """
+        row_frames = self.get('row_frames', dataset)
+        num_valid = self.num_valid(dataset)
+        row_frames = row_frames[:num_valid] if valid else row_frames[num_valid:]
+        return np.diff(self.arrays['frame_offsets'])[row_frames]
+
+
+class FrameSequence:
+    """
+    Entries of a dataset on top of the flat frame arrays (CSR layout). Entry i is a zero-copy view on the
+    [pedID, x, y] rows of the frame of the i-th row of the file. Slicing returns a list of views
+    """
+
+    def __init__(self, frame_rows, frame_offsets, row_frames, column=None):
+        """
+        Initializer function
+        params:
+        frame_rows: [pedID, x, y] rows of all the frames
+        frame_offsets: offsets of each frame in frame_rows
+        row_frames: frame of each entry
+        column: column of the frame rows to return (all columns if None)
+        """
+        self.frame_rows = frame_rows if column is None else frame_rows[:, column]
+        self.frame_offsets = frame_offsets
+        self.row_frames = row_frames
+
+    def __len__(self):
+        return len(self.row_frames)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.get_frame(frame) for frame in self.row_frames[index]]
+        return self.get_frame(self.row_frames[index])
+
+    def __iter__(self):
+        for frame in self.row_frames:
+            yield self.get_frame(frame)
+
+    def get_frame(self, frame):
+        """
+        Return the rows of a frame
+        :param frame: frame index
+        :return:
+        """
+        return self.frame_rows[self.frame_offsets[frame]:self.frame_offsets[frame + 1]]
+
+
+class CompositeStore:
+    """
+    Datasets of several stores seen as one store, with the read interface of TrajectoryStore
+    """
+
+    def __init__(self, paths):
+        """
+        Initializer function
+        params:
+        paths: store directories, the datasets keep the order of the stores
+        """
+        self.stores = [TrajectoryStore(path) for path in paths]
+        # (store, dataset in the store) of each dataset
+        self.datasets = [(store, dataset) for store in self.stores for dataset in range(len(store))]
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def get(self, name, dataset):
+        store, dataset = self.datasets[dataset]
+        return store.get(name, dataset)
+
+    def num_valid(self, dataset):
+        store, dataset = self.datasets[dataset]
+        return store.num_valid(dataset)
+
+    def frame_sequence(self, dataset, valid=False, column=None):
+        store, dataset = self.datasets[dataset]
+        return store.frame_sequence(dataset, valid, column)
+
+    def num_peds(self, dataset, valid=False):
+        store, dataset = self.datasets[dataset]
+        return store.num_peds(dataset, valid)
@@ -1,16 +1,27 @@
 """
 Python script for handling input train/test/validation data and batching it (grouping it)
 """
+import hashlib
 import pickle
 import random
 import pandas as pd
 from helper import *
+from preprocessing import preprocess_files, stream_file
+from data_pipeline import SequenceIndex, SequenceTensors, collate_sequences
+from preprocess_cache import PreprocessCache, file_stat
+from trajectory_store import StoreWriter, write_store
 
 
 class DataLoader:
+    # Attributes of a loaded split and its batch pointers, kept per split by use_split
+    SPLIT_ATTRIBUTES = ['data_dirs', 'numDatasets', 'store', 'data', 'valid_data', 'numPedsList', 'valid_numPedsList',
+                        'pedsList', 'valid_pedsList', 'target_ids', 'orig_data', 'frameList', 'num_batches',
+                        'valid_num_batches', 'dataset_pointer', 'frame_pointer', 'valid_dataset_pointer',
+                        'valid_frame_pointer']
 
     def __init__(self, f_prefix, batch_size=5, seq_length=20, num_of_validation=0, forcePreProcess=False, infer=False,
-                 generate=False):
+                 generate=False, preprocess_workers=1,
+                 preprocess_chunk_rows=0):
         """
         initializer (constructor) function for the DataLoader class
         params:
@@ -20,7 +31,11 @@ class DataLoader:
         num_of_validation : number of validation dataset will be used
         infer : flag for test mode
         generate : flag for data generation mode
-        forcePreProcess : Flag to forcefully preprocess the data again from csv files
+        forcePreProcess : Flag to forcefully preprocess the data again from csv files even if the pre-processed
+        data is up to date
+        preprocess_workers : number of worker processes used to preprocess the files
+        preprocess_chunk_rows : if not 0, the files are preprocessed in streaming mode, reading this number of rows
+        at once instead of whole files
         """
         # base test files
         base_test_dataset = ['data/test/herms/eo-300-frei2_cam2_MB_pre.txt']
@@ -82,6 +97,8 @@ class DataLoader:
 
         self.infer = infer
         self.generate = generate
+        self.preprocess_workers = preprocess_workers
+        self.preprocess_chunk_rows = preprocess_chunk_rows
 
         # Number of datasets to process
         self.numDatasets = len(self.data_dirs)
@@ -102,223 +119,135 @@ class DataLoader:
         # Validation arguments
         self.val_fraction = 0
 
-        # Define the path in which the processed data would be stored
-        self.data_file_tr = os.path.join(self.train_data_dir, "trajectories_train.cpkl")
-        self.data_file_te = os.path.join(self.base_test_path, "trajectories_test.cpkl")
-        self.data_file_vl = os.path.join(self.val_data_dir, "trajectories_val.cpkl")
+        # Define the path in which the processed data would be stored, one entry per file
+        self.cache = PreprocessCache(os.path.join(f_prefix, 'data', 'cache'))
+        # Dense sequence tensors already built, by key
+        self.sequence_tensors = {}
+        # Resident splits by name and the name of the current one
+        self.splits = {}
+        self.split = None
 
         # For creating a dict key: folder names, values: files in this folder
         # THis method defines a self.folder_file_dict parameter
         self.create_folder_file_dict()
 
-        # If additional_validation is True (request of use validation dataset), then check if the file exist or not
+        # If additional_validation is True (request of use validation dataset), then pre-process the validation
+        # files that are missing from the cache or have changed
         if self.additional_validation:
-            # If the file doesn't exist or forcePreProcess is true
-            if not (os.path.exists(self.data_file_vl)) or forcePreProcess:
-                print("Creating pre-processed validation data from raw data")
-                # Preprocess the data from the csv files of the datasets
-                # Note that this data is processed in frames
-                self.frame_preprocess(self.validation_dataset, self.data_file_vl, self.additional_validation)
+            print("Checking pre-processed validation data")
+            self.frame_preprocess(self.validation_dataset, self.additional_validation, forcePreProcess)
 
         if self.infer:
             # if infer mode, and no additional files -> test preprocessing
             if not self.additional_validation:
-                if not (os.path.exists(self.data_file_te)) or forcePreProcess:
-                    print("Creating pre-processed test data from raw data")
-                    # Preprocess the data from the csv files of the datasets
-                    # Note that this data is processed in frames
-                    print("Working on directory: ", self.data_file_te)
-                    self.frame_preprocess(self.data_dirs, self.data_file_te)
+                print("Checking pre-processed test data")
+                self.frame_preprocess(self.data_dirs, force=forcePreProcess)
             # if infer mode, and there are additional validation files -> validation dataset visualization
             else:
                 print("Validation visualization file will be created")
 
         # if not infer mode
         else:
-            # If the file doesn't exist or forcePreProcess is true -> training pre-process
-            if not (os.path.exists(self.data_file_tr)) or forcePreProcess:
-                print("Creating pre-processed training data from raw data")
-                # Preprocess the data from the csv files of the datasets
-                # Note that this data is processed in frames
-                self.frame_preprocess(self.data_dirs, self.data_file_tr)
+            # training pre-process of the missing or changed files
+            print("Checking pre-processed training data")
+            self.frame_preprocess(self.data_dirs, force=forcePreProcess)
 
         if self.infer:
-            # Load the processed data from the pickle file
+            # Load the processed data from the cache
             if not self.additional_validation:  # test mode
-                self.load_preprocessed(self.data_file_te)
+                self.use_split('test', self.data_dirs)
             else:  # validation mode
-                self.load_preprocessed(self.data_file_vl, True)
+                self.use_split('validation', self.validation_dataset, True)
 
         else:  # training mode
-            self.load_preprocessed(self.data_file_tr)
+            self.use_split('train', self.data_dirs)
 
         # Reset all the data pointers of the dataloader object
         # TODO: why he change the same value twice?
         self.reset_batch_pointer(valid=False)
         self.reset_batch_pointer(valid=True)
 
-    def frame_preprocess(self, data_dirs, data_file, validation_set=False):
+    def get_preprocess_params(self, validation_set=False):
+        """
+        Parameters that change the result of the pre-processing of a set of files
+        :param validation_set: true when a dataset is in validation set
+        :return:
+        """
+        # At inference time, data generation and if dataset is a validation dataset, no validation data
+        if self.infer or self.generate or validation_set:
+            val_fraction = 0
+        else:
+            val_fraction = self.val_fraction
+
+        return {'test_format': bool(self.infer and not self.additional_validation), 'val_fraction': val_fraction}
+
+    def frame_preprocess(self, data_dirs, validation_set=False, force=False):
         """
         Function that will pre-process the pixel_pos.csv files of each dataset
-        into data with occupancy grid that can be used
+        into data with occupancy grid that can be used. Only the files missing from the cache or changed since
+        they were cached are pre-processed
         params:
         data_dirs : List of directories where raw data resides
-        data_file : The file into which all the pre-processed data needs to be stored
         validation_set: true when a dataset is in validation set
+        force: pre-process all the files even if they are up to date
         """
-        # all_frame_data would be a list of list of numpy arrays corresponding to each dataset
-        # Each numpy array will correspond to a frame and would be of size (numPeds, 3) each row
-        # containing pedID, x, y
-        all_frame_data = []
-        # Validation frame data
-        valid_frame_data = []
-        # frameList_data would be a list of lists corresponding to each dataset
-        # Each list would contain the frameIds of all the frames in the dataset
-        frameList_data = []
-        valid_numPeds_data = []
-        # numPeds_data would be a list of lists corresponding to each dataset
-        # Each list would contain the number of pedestrians in each frame in the dataset
-        numPeds_data = []
-
-        # Each list includes ped. ids of this frame
-        pedsList_data = []
-        valid_pedsList_data = []
-        # Target ped ids for each sequence
-        target_ids = []
-        orig_data = []
+        params = self.get_preprocess_params(validation_set)
+        stale_dirs = data_dirs if force else self.cache.stale_files(data_dirs, params)
+        if not stale_dirs:
+            return
+        print("Creating pre-processed data from raw data for", len(stale_dirs), "of", len(data_dirs), "files")
 
-        # Index of the current dataset
-        dataset_index = 0
+        # taken before reading, a file changed while it is pre-processed is seen as changed next time
+        stats = [file_stat(directory) for directory in stale_dirs]
 
-        # For each dataset
-        for directory in data_dirs:
-            # Load the data from the txt file
-            print("Now processing: ", directory)
-            column_names = ['frame_num', 'ped_id', 'y', 'x']
-
-            # if training mode, read train file to pandas dataframe and process
-            if not self.infer:
-                df = pd.read_csv(directory, dtype={'frame_num': 'int', 'ped_id': 'int'}, delimiter='\t', header=None,
-                                 names=column_names)
-                # target_ids is stores the ped. ids in the dataset file
-                self.target_ids = np.array(df.drop_duplicates(subset={'ped_id'}, keep='first', inplace=False)['ped_id'])
-            else:
-                # if validation mode, read validation file to pandas dataframe and process
-                if self.additional_validation:
-                    df = pd.read_csv(directory, dtype={'frame_num': 'int', 'ped_id': 'int'}, delimiter='\t', header=None,
-                                     names=column_names)
-                    self.target_ids = np.array(
-                        df.drop_duplicates(subset={'ped_id'}, keep='first', inplace=False)['ped_id'])
-
-                # if test mode, read test file to pandas dataframe and process
-                else:
-                    column_names = ['frame_num', 'ped_id', 'y', 'x']
-                    df = pd.read_csv(directory, dtype={'frame_num': 'int', 'ped_id': 'int'}, delimiter='\t', header=None,
-                                     names=column_names,
-                                     converters={c: lambda x: float('nan') if x == '?' else float(x) for c in
-                                                 ['y', 'x']})
-                    self.target_ids = np.array(
-                        df[df['y'].isnull()].drop_duplicates(subset={'ped_id'}, keep='first', inplace=False)['ped_id'])
-
-            # Convert pandas -> numpy array
-            data = np.array(df)
-
-            # keep original copy of file
-            orig_data.append(data)
-
-            # Swap x and y points (in txt file it is like -> y,x)
-            data = np.swapaxes(data, 0, 1)
-
-            # Get frame numbers
-            frameList = data[0, :].tolist()
-
-            # Number of frames
-            numFrames = len(frameList)
-
-            # Add the list of frameIDs to the frameList_data
-            frameList_data.append(frameList)
-            # Initialize the list of numPeds for the current dataset
-            numPeds_data.append([])
-            valid_numPeds_data.append([])
-
-            # Initialize the list of numpy arrays for the current dataset
-            all_frame_data.append([])
-            # Initialize the list of numpy arrays for the current dataset
-            valid_frame_data.append([])
-
-            # list of peds for each frame
-            pedsList_data.append([])
-            valid_pedsList_data.append([])
-
-            target_ids.append(self.target_ids)
-
-            for ind, frame in enumerate(frameList):
-                # Extract all pedestrians in current frame
-                pedsInFrame = data[:, data[0, :] == frame]
-                # print("peds in %d: %s"%(frame,str(pedsInFrame)))
-
-                # Extract peds list
-                pedsList = pedsInFrame[1, :].tolist()
-
-                # Add number of peds in the current frame to the stored data
-
-                # Initialize the row of the numpy array
-                pedsWithPos = []
-
-                # For each ped. in the current frame
-                for ped in pedsList:
-                    # Extract their x and y positions
-                    current_x = pedsInFrame[3, pedsInFrame[1, :] == ped][0]
-                    current_y = pedsInFrame[2, pedsInFrame[1, :] == ped][0]
-
-                    # Add their pedID, x, y to the row of the numpy array
-                    pedsWithPos.append([ped, current_x, current_y])
-
-                # At inference time, data generation and if dataset is a validation dataset, no validation data
-                if (ind >= numFrames * self.val_fraction) or self.infer or self.generate or validation_set:
-                    # Add the details of all the peds in the current frame to all_frame_data
-                    all_frame_data[dataset_index].append(np.array(pedsWithPos))
-                    pedsList_data[dataset_index].append(pedsList)
-                    numPeds_data[dataset_index].append(len(pedsList))
-                else:
-                    valid_frame_data[dataset_index].append(np.array(pedsWithPos))
-                    valid_pedsList_data[dataset_index].append(pedsList)
-                    valid_numPeds_data[dataset_index].append(len(pedsList))
-
-            dataset_index += 1
-        # Save the arrays in the pickle file
-        f = open(data_file, "wb")
-        pickle.dump((all_frame_data, frameList_data, numPeds_data, valid_numPeds_data, valid_frame_data, pedsList_data,
-                     valid_pedsList_data, target_ids, orig_data), f, protocol=2)
-        f.close()
-
-    def load_preprocessed(self, data_file, validation_set=False):
+        # Streaming mode: each file is read in blocks and written straight into its store
+        if self.preprocess_chunk_rows:
+            for directory, stat in zip(stale_dirs, stats):
+                writer = StoreWriter(self.cache.entry_path(directory, params), self.cache.entry_key(directory, params))
+                stream_file(directory, params, writer, self.preprocess_chunk_rows)
+                writer.close()
+                self.cache.record_source(directory, params, stat)
+            return
+
+        # Read and group each file, in worker processes if requested
+        datasets = preprocess_files(stale_dirs, params, self.preprocess_workers)
+
+        # Save the arrays of each file in its store
+        for directory, stat, dataset in zip(stale_dirs, stats, datasets):
+            write_store(self.cache.entry_path(directory, params), self.cache.entry_key(directory, params), [dataset])
+            self.cache.record_source(directory, params, stat)
+
+    def load_preprocessed(self, data_dirs, validation_set=False):
         """
         Function to load the pre-processed data into the DataLoader object
         params:
-        data_file : the path to the pickled data file
+        data_dirs : List of directories where raw data resides, their pre-processed data is read from the cache
         validation_set : flag for validation dataset
         """
-        # Load data from the pickled file
+        # Load data from the cache
         if (validation_set):
-            print("Loading validaton datasets: ", data_file)
+            print("Loading validaton datasets: ", self.cache.path)
         else:
-            print("Loading train or test dataset: ", data_file)
-
-        f = open(data_file, 'rb')
-        self.raw_data = pickle.load(f)
-        f.close()
-
-        # Get all the data from the pickle file
-        self.data = self.raw_data[0]
-        self.frameList = self.raw_data[1]
-        self.numPedsList = self.raw_data[2]
-        self.valid_numPedsList = self.raw_data[3]
-        self.valid_data = self.raw_data[4]
-        self.pedsList = self.raw_data[5]
-        self.valid_pedsList = self.raw_data[6]
-        self.target_ids = self.raw_data[7]
-        self.orig_data = self.raw_data[8]
+            print("Loading train or test dataset: ", self.cache.path)
+
+        self.store = self.cache.open(data_dirs, self.get_preprocess_params(validation_set))
+
+        # data would be a list of FrameSequence corresponding to each dataset
+        # Each entry is a zero-copy view of size (numPeds, 3) on the store, each row containing pedID, x, y
+        self.data = [self.store.frame_sequence(dataset) for dataset in range(len(self.store))]
+        self.valid_data = [self.store.frame_sequence(dataset, True) for dataset in range(len(self.store))]
+        # numPedsList would be a list of arrays corresponding to each dataset
+        # Each array would contain the number of pedestrians in each frame in the dataset
+        self.numPedsList = [self.store.num_peds(dataset) for dataset in range(len(self.store))]
+        self.valid_numPedsList = [self.store.num_peds(dataset, True) for dataset in range(len(self.store))]
+        # Each entry includes ped. ids of this frame
+        self.pedsList = [self.store.frame_sequence(dataset, column=0) for dataset in range(len(self.store))]
+        self.valid_pedsList = [self.store.frame_sequence(dataset, True, column=0) for dataset in range(len(self.store))]
+        # Target ped ids for each sequence
+        self.target_ids = [self.store.get('target_ids', dataset) for dataset in range(len(self.store))]
+        # Original copy of each file and its frame numbers
+        self.orig_data = [self.store.get('orig_data', dataset) for dataset in range(len(self.store))]
+        self.frameList = [orig_data[:, 0] for orig_data in self.orig_data]
 
         counter = 0
         valid_counter = 0
@@ -474,6 +403,114 @@ class DataLoader:
 
         return x_batch, y_batch, d, numPedsList_batch, PedsList_batch, target_ids
 
+    def get_sequence(self, dataset, start, valid=False):
+        """
+        Function to get the sequence of seq_length entries starting at an entry of a dataset. The batch pointers
+        are not used nor changed
+        :param dataset: dataset index
+        :param start: first entry of the sequence
+        :param valid: true for the validation entries of the dataset
+        :return: source frames, target frames, number of peds and ped ids of each frame, target ped id
+        """
+        frame_data = self.valid_data[dataset] if valid else self.data[dataset]
+        numPedsList = self.valid_numPedsList[dataset] if valid else self.numPedsList[dataset]
+        pedsList = self.valid_pedsList[dataset] if valid else self.pedsList[dataset]
+
+        return (frame_data[start:start + self.seq_length], frame_data[start + 1:start + self.seq_length + 1],
+                numPedsList[start:start + self.seq_length], pedsList[start:start + self.seq_length],
+                self.target_ids[dataset][start // self.seq_length])
+
+    def get_sequence_index(self, stride=None, shuffle=False, weights=None, seed=0, valid=False):
+        """
+        Function to build the index of the sequences of the loaded datasets
+        :param stride: distance between two consecutive sequences of a dataset (seq_length if None)
+        :param shuffle: permute the sequences at each epoch
+        :param weights: sampling weight of each dataset
+        :param seed:
+        :param valid: true for the validation entries
+        :return: SequenceIndex
+        """
+        frame_data = self.valid_data if valid else self.data
+        # same sequences as next_batch and next_valid_batch with the default stride: a validation sequence needs
+        # the target frame of its last entry, but starts seq_length entries after the previous one
+        window_length = self.seq_length + 1 if valid else self.seq_length
+        return SequenceIndex([len(data) for data in frame_data], window_length, stride or self.seq_length, shuffle,
+                             weights, seed)
+
+    def get_sequence_key(self, sequence_index, valid=False):
+        """
+        Function to get the key of the sequences of an index: the pre-processed data, the sequence length and the
+        windows of the index
+        :param sequence_index: SequenceIndex of the loaded datasets
+        :param valid: true if the index was built on the validation entries
+        :return:
+        """
+        sha = hashlib.sha1()
+        for store in self.store.stores:
+            sha.update(store.manifest['key'].encode())
+        sha.update(str((valid, self.seq_length)).encode())
+        sha.update(sequence_index.datasets.tobytes())
+        sha.update(sequence_index.starts.tobytes())
+        return sha.hexdigest()
+
+    def get_sequence_tensors(self, sequence_index, valid=False):
+        """
+        Function to get the dense tensors of the sequences of an index. They are built once and kept in memory and
+        in the cache directory, so later epochs, trials and runs on the same data reuse them
+        :param sequence_index: SequenceIndex of the loaded datasets
+        :param valid: true if the index was built on the validation entries
+        :return: SequenceTensors
+        """
+        key = self.get_sequence_key(sequence_index, valid)
+        if key not in self.sequence_tensors:
+            tensors_file = os.path.join(self.cache.path, 'sequences-%s.npz' % key)
+            if os.path.isfile(tensors_file):
+                self.sequence_tensors[key] = SequenceTensors.load(tensors_file)
+            else:
+                print("Creating dense sequence tensors of", len(sequence_index), "sequences")
+                tensors = SequenceTensors.build(self.valid_data if valid else self.data, sequence_index,
+                                                self.seq_length)
+                tensors.save(tensors_file)
+                self.sequence_tensors[key] = tensors
+
+        return self.sequence_tensors[key]
+
+    def get_batch(self, sequence_index, positions, valid=False):
+        """
+        Function to get the batch of the sequences at some positions of a sequence index
+        :param sequence_index: SequenceIndex of the loaded datasets
+        :param positions: positions of the sequences in the current epoch of the index
+        :param valid: true if the index was built on the validation entries
+        :return: same as next_batch
+        """
+        x_batch, y_batch, d, numPedsList_batch, PedsList_batch, target_ids = [], [], [], [], [], []
+        for position in positions:
+            dataset, start = sequence_index[position]
+            x_seq, y_seq, numPeds_seq, PedsList_seq, target_id = self.get_sequence(dataset, start, valid)
+            x_batch.append(x_seq)
+            y_batch.append(y_seq)
+            d.append(dataset)
+            numPedsList_batch.append(numPeds_seq)
+            PedsList_batch.append(PedsList_seq)
+            target_ids.append(target_id)
+
+        return x_batch, y_batch, d, numPedsList_batch, PedsList_batch, target_ids
+
+    def get_collated_batch(self, sequence_index, positions, valid=False):
+        """
+        Function to get the sequences at some positions of a sequence index as one padded batch
+        :param sequence_index: SequenceIndex of the loaded datasets
+        :param positions: positions of the sequences in the current epoch of the index
+        :param valid: true if the index was built on the validation entries
+        :return: SequenceBatch
+        """
+        target_ids = []
+        for position in positions:
+            dataset, start = sequence_index[position]
+            target_ids.append(self.target_ids[dataset][start // self.seq_length])
+        return collate_sequences(self.get_sequence_tensors(sequence_index, valid), sequence_index, positions,
+                                 target_ids)
+
     def tick_batch_pointer(self, valid=False):
         """
         Advance the dataset pointer
@@ -528,10 +565,8 @@ class DataLoader:
             if self.additional_validation:
                 print("Dataset type switching: training ----> validation")
                 self.orig_seq_length, self.seq_length = self.seq_length, self.orig_seq_length
-                self.data_dirs = self.validation_dataset
-                self.numDatasets = len(self.data_dirs)
+                self.use_split('validation', self.validation_dataset, True, load_data)
                 if load_data:
-                    self.load_preprocessed(self.data_file_vl, True)
                     self.reset_batch_pointer(valid=False)
             else:
                 print("There is no validation dataset.Aborted.")
@@ -539,13 +574,41 @@ class DataLoader:
         else:  # if validation mode, switch to train mode
             print("Dataset type switching: validation -----> training")
             self.orig_seq_length, self.seq_length = self.seq_length, self.orig_seq_length
-            self.data_dirs = self.train_dataset
-            self.numDatasets = len(self.data_dirs)
+            self.use_split('train', self.train_dataset, load_data=load_data)
             if load_data:
-                self.load_preprocessed(self.data_file_tr)
                 self.reset_batch_pointer(valid=False)
                 self.reset_batch_pointer(valid=True)
 
+    def use_split(self, split, data_dirs, validation_set=False, load_data=True):
+        """
+        Function to make a split the current one. A split is loaded once and stays resident with its own batch
+        pointers, switching back to it only swaps the references
+        :param split: name of the split (train, validation or test)
+        :param data_dirs: List of directories where raw data of the split resides
+        :param validation_set: flag for validation dataset
+        :param load_data: load the split if it is not resident
+        :return:
+        """
+        if self.split is not None:
+            self.splits[self.split] = {name: getattr(self, name) for name in self.SPLIT_ATTRIBUTES}
+
+        if split in self.splits:
+            for name, value in self.splits[split].items():
+                setattr(self, name, value)
+            self.split = split
+            return
+
+        self.data_dirs = data_dirs
+        self.numDatasets = len(self.data_dirs)
+        if load_data:
+            self.load_preprocessed(data_dirs, validation_set)
+            self.reset_batch_pointer(valid=False)
+            self.reset_batch_pointer(valid=True)
+            self.split = split
+        else:
+            # only the directories changed, the loaded data is not the one of the split
+            self.split = None
+
     def convert_proper_array(self, x_seq, num_pedlist, pedlist):
         """
         Converter function to appropriate format. Instead of directly use ped ids, we are mapping ped ids to array
@@ -5,8 +5,9 @@ import argparse
 import pickle
 import time
 
-from grid import getSequenceGridMask
+from data_pipeline import SequenceDataset, prefetch_batches
 from helper import *
+from tiling import SceneTiler
 from utils import DataLoader
 
 
@@ -39,6 +40,26 @@ def main():
     # method selection
     parser.add_argument('--method', type=int, default=1,
                         help='Method of lstm will be used (1 = social lstm, 2 = obstacle lstm, 3 = vanilla lstm)')
+    # number of worker processes for preprocessing
+    parser.add_argument('--preprocess_workers', type=int, default=1,
+                        help='Number of worker processes used to preprocess the data files')
+    # number of rows read at once when preprocessing in streaming mode
+    parser.add_argument('--preprocess_chunk_rows', type=int, default=0,
+                        help='Preprocess the data files in blocks of this number of rows (0: whole files in memory)')
+    # number of worker processes preparing the batches
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='Number of worker processes preparing the batches (0: prepared by the main process)')
+    # number of batches prepared in advance by each worker
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='Number of batches prepared in advance by each worker process')
+    # side of the tiles of large scenes
+    parser.add_argument('--tile_size', type=int, default=0,
+                        help='Compute the grid masks and the model steps tile by tile, with tiles of this side '
+                             '(0: whole frames)')
+    # number of worker processes computing the tiles of the model steps
+    parser.add_argument('--tile_workers', type=int, default=0,
+                        help='Number of worker processes computing the tiles of the model steps (0: computed by the '
+                             'main process)')
 
     # Parse the parameters
     sample_args = parser.parse_args()
@@ -85,7 +106,8 @@ def main():
 
     # Create the DataLoader object
     dataloader = DataLoader(f_prefix, 1, sample_args.seq_length, num_of_validation=sample_args.num_validation,
-                            forcePreProcess=True, infer=True)
+                            infer=True, preprocess_workers=sample_args.preprocess_workers,
+                            preprocess_chunk_rows=sample_args.preprocess_chunk_rows)
     create_directories(plot_directory, [plot_validation_file_directory])
     dataloader.reset_batch_pointer()
 
@@ -104,11 +126,35 @@ def main():
     # results of one validation dataset
     results = []
 
+    # grid masks of the social methods are computed with the rest of the batch preparation
+    grid_args = None
+    # configs saved before the option pool all the neighbors
+    max_neighbors = getattr(saved_args, 'max_neighbors', 0)
+    if sample_args.method == 2:  # obstacle lstm
+        grid_args = (saved_args.neighborhood_size, saved_args.grid_size, True, max_neighbors)
+    elif sample_args.method == 1:  # social lstm
+        grid_args = (saved_args.neighborhood_size, saved_args.grid_size, False, max_neighbors)
+
+    # Sequences in the order of next_batch, prepared in worker processes if num_workers > 0
+    sequence_index = dataloader.get_sequence_index()
+    sequence_dataset = SequenceDataset(dataloader, sequence_index, grid_args=grid_args, tile_size=sample_args.tile_size)
+
+    # model steps of large scenes tile by tile (no halo, the steps of the peds are independent), the workers hold
+    # the parameters of the loaded checkpoint
+    tiler = None
+    if sample_args.tile_size > 0 and sample_args.method == 3:
+        tiler = SceneTiler(dataloader.get_dataset_dimension(dataloader.get_directory_name_with_pointer(0)), 0, 0,
+                           sample_args.tile_size, num_workers=sample_args.tile_workers, net=net)
+    batches = sequence_index.batches(dataloader.batch_size, drop_last=True)[:dataloader.num_batches]
+    prepared_batches = prefetch_batches(sequence_dataset, batches, sample_args.num_workers, sample_args.prefetch)
+
     # For each batch
     for batch in range(dataloader.num_batches):
         start = time.time()
         # Get batch data
-        x, y, d, numPedsList, PedsList, target_ids = dataloader.next_batch()
+        prepared_batch = next(prepared_batches)
+        # next_batch would point to the dataset of the last sequence of the batch
+        dataloader.dataset_pointer = prepared_batch[-1]['dataset']
 
         if dataset_pointer_ins is not dataloader.dataset_pointer:
             if dataloader.dataset_pointer is not 0:
@@ -120,6 +166,10 @@ def main():
             dataset_pointer_ins = dataloader.dataset_pointer
             results = []
 
+        if tiler is not None:
+            tiler.set_dimensions(dataloader.get_dataset_dimension(
+                dataloader.get_directory_name_with_pointer(dataloader.dataset_pointer)))
+
         # Loss for this batch
         loss_batch = 0
         err_batch = 0
@@ -128,15 +178,12 @@ def main():
         # For each sequence
         for sequence in range(dataloader.batch_size):
             # Get data corresponding to the current sequence
-            x_seq, _, d_seq, numPedsList_seq, PedsList_seq = x[sequence], y[sequence], d[sequence], numPedsList[
-                sequence], PedsList[sequence]
-            target_id = target_ids[sequence]
+            prepared = prepared_batch[sequence]
+            numPedsList_seq, PedsList_seq = prepared['numPedsList_seq'], prepared['PedsList_seq']
+            target_id = prepared['target_id']
 
-            folder_name = dataloader.get_directory_name_with_pointer(d_seq)
-            dataset_data = dataloader.get_dataset_dimension(folder_name)
-
-            # dense vector creation
-            x_seq, lookup_seq = dataloader.convert_proper_array(x_seq, numPedsList_seq, PedsList_seq)
+            # precomputed dense vector
+            x_seq, lookup_seq = prepared['x_seq'], prepared['lookup_seq']
 
             # will be used for error calculation
             orig_x_seq = x_seq.clone()
@@ -144,15 +191,12 @@ def main():
             target_id_values = x_seq[0][lookup_seq[target_id], 0:2]
 
             # grid mask calculation
-            if sample_args.method == 2:  # obstacle lstm
-                grid_seq = getSequenceGridMask(x_seq, dataset_data, PedsList_seq, saved_args.neighborhood_size,
-                                               saved_args.grid_size, saved_args.use_cuda, True)
-            elif sample_args.method == 1:  # social lstm
-                grid_seq = getSequenceGridMask(x_seq, dataset_data, PedsList_seq, saved_args.neighborhood_size,
-                                               saved_args.grid_size, saved_args.use_cuda)
+            grid_seq = prepared['grid_seq']
+            if saved_args.use_cuda and grid_seq is not None:
+                grid_seq = [grid.cuda() for grid in grid_seq]
 
-            # vectorize datapoints
-            x_seq, first_values_dict = vectorize_seq(x_seq, PedsList_seq, lookup_seq)
+            # vectorized datapoints
+            x_seq, first_values_dict = prepared['vectorized_x_seq'], prepared['first_values_dict']
 
             # <---------------- Experimental block (may need update in methods)-----------------------> x_seq =
             # translate(x_seq, PedsList_seq, lookup_seq ,target_id_values) angle = angle_between(reference_point,
@@ -167,7 +211,7 @@ def main():
 
             if sample_args.method == 3:  # vanilla lstm
                 ret_x_seq, loss = sample_validation_data_vanilla(x_seq, PedsList_seq, sample_args, net, lookup_seq,
-                                                                 numPedsList_seq, dataloader)
+                                                                 numPedsList_seq, dataloader, tiler)
 
             else:
                 ret_x_seq, loss = sample_validation_data(x_seq, PedsList_seq, grid_seq, sample_args, net, lookup_seq,
@@ -188,7 +232,7 @@ def main():
             err_batch += err
             f_err_batch += f_err
             results.append((orig_x_seq.data.cpu().numpy(), ret_x_seq.data.cpu().numpy(), PedsList_seq, lookup_seq,
-                            dataloader.get_frame_sequence(sample_args.seq_length), target_id))
+                            prepared['frame_numbers'], target_id))
 
         end = time.time()
         print('Current file : ', dataloader.get_file_name(0), ' Batch : ', batch + 1, ' Sequence: ', sequence + 1,
@@ -212,6 +256,9 @@ def main():
 
     dataloader.write_to_plot_file(epoch_result, os.path.join(plot_directory, plot_validation_file_directory))
 
+    if tiler is not None:
+        tiler.close()
+
 
 if __name__ == '__main__':
     main()
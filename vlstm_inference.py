@@ -0,0 +1,116 @@
+"""
+Python script includes the inference only Vanilla LSTM model with a tensor only interface, exportable with
+torch.jit.script, and its loader from the saved checkpoints
+"""
+import os
+import pickle
+
+import torch
+import torch.nn as nn
+
+from vlstm_model import VLSTMModel
+
+
+class VLSTMInference(nn.Module):
+    """
+    Inference only Vanilla LSTM model (no dropout). The peds are tensor columns and their presence is a mask, there
+    is no lookup table, so the module can be compiled with torch.jit.script
+    """
+    gru: torch.jit.Final[bool]
+
+    def __init__(self, net):
+        """
+        Initializer function
+        params:
+        net: VLSTMModel whose parameters are used (shared, not copied)
+        """
+        super(VLSTMInference, self).__init__()
+
+        self.gru = net.gru
+        self.rnn_size = net.rnn_size
+        self.output_size = net.output_size
+
+        self.input_embedding_layer = net.input_embedding_layer
+        self.output_layer = net.output_layer
+        # parameters of the cell, run with the same ops as nn.LSTMCell / nn.GRUCell
+        self.weight_ih = net.cell.weight_ih
+        self.weight_hh = net.cell.weight_hh
+        self.bias_ih = net.cell.bias_ih
+        self.bias_hh = net.cell.bias_hh
+
+    @torch.jit.export
+    def step(self, positions, mask, hidden_states, cell_states):
+        """
+        One step of the model for the peds of a frame
+        params:
+        positions: Input positions [N, 2]
+        mask: presence of each ped [N]
+        hidden_states: Hidden states of the peds [N, rnn_size]
+        cell_states: Cell states of the peds [N, rnn_size] (returned as is for GRU)
+
+        returns:
+        outputs: Outputs corresponding to bivariate Gaussian distributions [N, output_size], zeros for the absent
+        peds
+        hidden_states: kept as they are for the absent peds
+        cell_states
+        """
+        # Embed inputs
+        input_embedded = torch.relu(self.input_embedding_layer(positions))
+
+        if self.gru:
+            h_nodes = torch.gru_cell(input_embedded, hidden_states, self.weight_ih, self.weight_hh, self.bias_ih,
+                                     self.bias_hh)
+            c_nodes = cell_states
+        else:
+            h_nodes, c_nodes = torch.lstm_cell(input_embedded, [hidden_states, cell_states], self.weight_ih,
+                                               self.weight_hh, self.bias_ih, self.bias_hh)
+
+        present = mask.unsqueeze(1)
+        outputs = self.output_layer(h_nodes)
+        outputs = torch.where(present, outputs, torch.zeros_like(outputs))
+        return outputs, torch.where(present, h_nodes, hidden_states), torch.where(present, c_nodes, cell_states)
+
+    def forward(self, positions, mask, hidden_states, cell_states):
+        """
+        Forward pass for a sequence of frames
+        params:
+        positions: Input positions [T, N, 2]
+        mask: presence of each ped in each frame [T, N]
+        hidden_states: Hidden states of the peds [N, rnn_size]
+        cell_states: Cell states of the peds [N, rnn_size] (returned as is for GRU)
+
+        returns:
+        outputs: Outputs corresponding to bivariate Gaussian distributions [T, N, output_size], zeros for the
+        absent peds
+        hidden_states
+        cell_states
+        """
+        outputs = []
+        for framenum in range(positions.size(0)):
+            outputs_current, hidden_states, cell_states = self.step(positions[framenum], mask[framenum],
+                                                                    hidden_states, cell_states)
+            outputs.append(outputs_current)
+        return torch.stack(outputs), hidden_states, cell_states
+
+
+def load_inference_model(checkpoint_path, config_path=None, script=True):
+    """
+    Build the inference model of a saved Vanilla LSTM checkpoint (VANILLALSTM_*_model_N.tar)
+    :param checkpoint_path: path of the checkpoint
+    :param config_path: path of the saved training arguments (config.pkl next to the checkpoint if None)
+    :param script: compile the model with torch.jit.script
+    :return: VLSTMInference (scripted if script), on the cpu
+    """
+    if config_path is None:
+        config_path = os.path.join(os.path.dirname(checkpoint_path), 'config.pkl')
+    with open(config_path, 'rb') as f:
+        saved_args = pickle.load(f)
+
+    net = VLSTMModel(saved_args, True)
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    net.load_state_dict(checkpoint['state_dict'])
+
+    inference_net = VLSTMInference(net).eval()
+    if script:
+        return torch.jit.script(inference_net)
+    return inference_net
@@ -5,6 +5,7 @@ import torch
 import torch.nn as nn
 
 from torch.autograd import Variable
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
 # nn.Module: base class for all neural network modules
@@ -61,6 +62,161 @@ class VLSTMModel(nn.Module):
         self.relu = nn.ReLU()
         self.dropout = nn.Dropout(args.dropout)
 
+    def step(self, nodes, hidden_states, cell_states=None):
+        """
+        One step of the model for a set of peds, independent of the other peds
+        params:
+        nodes: Input positions of the peds
+        hidden_states: Hidden states of the peds
+        cell_states: Cell states of the peds (None for GRU)
+
+        returns:
+        outputs: Outputs corresponding to bivariate Gaussian distributions
+        hidden_states
+        cell_states (None for GRU)
+        """
+        # Embed inputs
+        input_embedded = self.dropout(self.relu(self.input_embedding_layer(nodes)))
+
+        if not self.gru:
+            # One-step of the LSTM
+            hidden_states, cell_states = self.cell(input_embedded, (hidden_states, cell_states))
+        else:
+            hidden_states = self.cell(input_embedded, (hidden_states))
+
+        return self.output_layer(hidden_states), hidden_states, cell_states
+
+    def forward_batch(self, input_data, mask, hidden_states=None, cell_states=None):
+        """
+        Forward pass for a padded batch of sequences (data_pipeline.SequenceBatch), one step of the LSTM per frame
+        for the peds of all the sequences. The states of the peds absent from a frame are kept as they are
+        params:
+        input_data: Input positions [B, T, N, 2]
+        mask: presence of each ped in each frame [B, T, N]
+        hidden_states: Hidden states of the peds [B, N, rnn_size] (zeros if None)
+        cell_states: Cell states of the peds [B, N, rnn_size] (zeros if None, not used for GRU)
+
+        returns:
+        outputs_return: Outputs corresponding to bivariate Gaussian distributions [B, T, N, output_size], zeros
+        for the absent peds
+        hidden_states
+        cell_states (None for GRU)
+        """
+        batch_size, seq_length, num_peds, _ = input_data.size()
+        # peds of all the sequences side by side: [T, B * N, ...]
+        nodes = input_data.transpose(0, 1).reshape(seq_length, batch_size * num_peds, -1)
+        present = mask.transpose(0, 1).reshape(seq_length, batch_size * num_peds, 1)
+
+        if hidden_states is None:
+            hidden_states = input_data.new_zeros(batch_size, num_peds, self.rnn_size)
+        hidden_states = hidden_states.reshape(batch_size * num_peds, self.rnn_size)
+        if self.gru:
+            cell_states = None
+        else:
+            if cell_states is None:
+                cell_states = input_data.new_zeros(batch_size, num_peds, self.rnn_size)
+            cell_states = cell_states.reshape(batch_size * num_peds, self.rnn_size)
+
+        outputs = []
+        for framenum in range(seq_length):
+            outputs_current, h_nodes, c_nodes = self.step(nodes[framenum], hidden_states, cell_states)
+
+            # Update hidden and cell states of the present peds only
+            hidden_states = torch.where(present[framenum], h_nodes, hidden_states)
+            if not self.gru:
+                cell_states = torch.where(present[framenum], c_nodes, cell_states)
+            outputs.append(torch.where(present[framenum], outputs_current, torch.zeros_like(outputs_current)))
+
+        outputs_return = torch.stack(outputs).reshape(seq_length, batch_size, num_peds, -1).transpose(0, 1)
+        hidden_states = hidden_states.reshape(batch_size, num_peds, self.rnn_size)
+        if not self.gru:
+            cell_states = cell_states.reshape(batch_size, num_peds, self.rnn_size)
+        return outputs_return, hidden_states, cell_states
+
+    def fused_rnn(self):
+        """
+        Return an nn.LSTM (nn.GRU) running the cell of the model over whole sequences. It holds the parameters of
+        the cell itself, so it trains them and adds nothing to the state dict
+        """
+        rnn_class = nn.GRU if self.gru else nn.LSTM
+        # built without parameters of its own
+        rnn = rnn_class(self.embedding_size, self.rnn_size, device='meta')
+        for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+            setattr(rnn, name + '_l0', getattr(self.cell, name))
+        return rnn
+
+    def forward_tracks(self, input_data, mask, hidden_states=None, cell_states=None):
+        """
+        Teacher-forced forward pass of a padded batch of sequences, same as forward_batch. The recurrence of each ped
+        only depends on its own positions: the present frames of each ped are packed into its track and all the
+        tracks are run by one nn.LSTM (nn.GRU) call instead of a loop over the frames
+        params:
+        input_data: Input positions [B, T, N, 2]
+        mask: presence of each ped in each frame [B, T, N]
+        hidden_states: Hidden states of the peds [B, N, rnn_size] (zeros if None)
+        cell_states: Cell states of the peds [B, N, rnn_size] (zeros if None, not used for GRU)
+
+        returns:
+        outputs_return: Outputs corresponding to bivariate Gaussian distributions [B, T, N, output_size], zeros
+        for the absent peds
+        hidden_states
+        cell_states (None for GRU)
+        """
+        batch_size, seq_length, num_peds, _ = input_data.size()
+        # peds of all the sequences side by side: [T, B * N, ...]
+        nodes = input_data.transpose(0, 1).reshape(seq_length, batch_size * num_peds, -1)
+        present = mask.transpose(0, 1).reshape(seq_length, batch_size * num_peds)
+
+        if hidden_states is None:
+            hidden_states = input_data.new_zeros(batch_size, num_peds, self.rnn_size)
+        hidden_states = hidden_states.reshape(batch_size * num_peds, self.rnn_size)
+        if self.gru:
+            cell_states = None
+        else:
+            if cell_states is None:
+                cell_states = input_data.new_zeros(batch_size, num_peds, self.rnn_size)
+            cell_states = cell_states.reshape(batch_size * num_peds, self.rnn_size)
+
+        outputs = input_data.new_zeros(seq_length, batch_size * num_peds, self.output_size)
+        lengths = present.sum(dim=0)
+        tracks = torch.nonzero(lengths).squeeze(1)
+        if len(tracks) > 0:
+            # (frame, ped) of each present position and its step in the track of the ped
+            frame_index, ped_index = present.nonzero(as_tuple=True)
+            step_index = (torch.cumsum(present.long(), dim=0) - 1)[frame_index, ped_index]
+            track_index = torch.full_like(lengths, -1)
+            track_index[tracks] = torch.arange(len(tracks), device=tracks.device)
+            track_index = track_index[ped_index]
+
+            track_nodes = nodes.new_zeros(int(lengths.max()), len(tracks), nodes.size(-1))
+            track_nodes[step_index, track_index] = nodes[frame_index, ped_index]
+
+            # Embed inputs
+            input_embedded = self.dropout(self.relu(self.input_embedding_layer(track_nodes)))
+            packed = pack_padded_sequence(input_embedded, lengths[tracks].cpu(), enforce_sorted=False)
+
+            if not self.gru:
+                # All the steps of the LSTM
+                packed_h, (h_nodes, c_nodes) = self.fused_rnn()(packed, (hidden_states[tracks].unsqueeze(0),
+                                                                         cell_states[tracks].unsqueeze(0)))
+            else:
+                packed_h, h_nodes = self.fused_rnn()(packed, hidden_states[tracks].unsqueeze(0))
+            track_h, _ = pad_packed_sequence(packed_h)
+
+            # Compute the outputs back in the frames
+            outputs = outputs.index_put((frame_index, ped_index), self.output_layer(track_h[step_index, track_index]))
+
+            # Update hidden and cell states to the last step of the tracks
+            hidden_states = hidden_states.index_copy(0, tracks, h_nodes[0])
+            if not self.gru:
+                cell_states = cell_states.index_copy(0, tracks, c_nodes[0])
+
+        outputs_return = outputs.reshape(seq_length, batch_size, num_peds, -1).transpose(0, 1)
+        hidden_states = hidden_states.reshape(batch_size, num_peds, self.rnn_size)
+        if not self.gru:
+            cell_states = cell_states.reshape(batch_size, num_peds, self.rnn_size)
+        return outputs_return, hidden_states, cell_states
+
     # def forward(self, input_data, grids, hidden_states, cell_states ,PedsList, num_pedlist,dataloader, look_up):
     def forward(self, *args):
 
@@ -141,29 +297,21 @@ class VLSTMModel(nn.Module):
             if not self.gru:
                 cell_states_current = torch.index_select(cell_states, 0, corr_index)
 
-            # Embed inputs
-            input_embedded = self.dropout(self.relu(self.input_embedding_layer(nodes_current)))
-
             if not self.gru:
-                # One-step of the LSTM
-                h_nodes, c_nodes = self.cell(input_embedded, (hidden_states_current, cell_states_current))
+                outputs_current, h_nodes, c_nodes = self.step(nodes_current, hidden_states_current,
+                                                              cell_states_current)
             else:
-                h_nodes = self.cell(input_embedded, (hidden_states_current))
+                outputs_current, h_nodes, _ = self.step(nodes_current, hidden_states_current)
 
             # Compute the output
-            outputs[framenum * numNodes + corr_index.data] = self.output_layer(h_nodes)
+            outputs[framenum * numNodes + corr_index.data] = outputs_current
 
             # Update hidden and cell states
             hidden_states[corr_index.data] = h_nodes
             if not self.gru:
                 cell_states[corr_index.data] = c_nodes
 
-        # Reshape outputs
-        outputs_return = Variable(torch.zeros(self.seq_length, numNodes, self.output_size))
-        if self.use_cuda:
-            outputs_return = outputs_return.cuda()
-        for framenum in range(self.seq_length):
-            for node in range(numNodes):
-                outputs_return[framenum, node, :] = outputs[framenum * numNodes + node, :]
+        # Reshape outputs, row framenum * numNodes + node is outputs_return[framenum, node]
+        outputs_return = outputs.view(self.seq_length, numNodes, self.output_size)
 
         return outputs_return, hidden_states, cell_states
@@ -8,6 +8,7 @@ import subprocess
 import time
 import timeit
 
+from data_pipeline import SequenceDataset, prefetch_batches
 from helper import *
 from utils import DataLoader
 
@@ -79,6 +80,32 @@ def get_parser_args():
     parser.add_argument('--freq_optimizer', type=int, default=8,
                         help='Frequency number(epoch) of learning decay for optimizer')
 
+    parser.add_argument('--preprocess_workers', type=int, default=1,
+                        help='Number of worker processes used to preprocess the data files')
+
+    parser.add_argument('--preprocess_chunk_rows', type=int, default=0,
+                        help='Preprocess the data files in blocks of this number of rows (0: whole files in memory)')
+
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='Number of worker processes preparing the batches (0: prepared by the training process)')
+
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='Number of batches prepared in advance by each worker process')
+
+    parser.add_argument('--bucket_boundaries', type=int, nargs='+', default=None,
+                        help='Ped counts separating the buckets of the batches (no bucketing if not given)')
+    # number of nearest neighbors pooled by each ped, recorded in the config for the social methods
+    parser.add_argument('--max_neighbors', type=int, default=0,
+                        help='Number of nearest neighbors in the grid of each ped (0: all neighbors)')
+
+    parser.add_argument('--batched_forward', action="store_true", default=False,
+                        help='Forward the sequences of a batch together, with one parameter update per batch '
+                             '(default: one forward pass and update per sequence)')
+
+    parser.add_argument('--fused_rnn', action="store_true", default=False,
+                        help='Run the teacher-forced forward pass as one nn.LSTM/nn.GRU call over the ped tracks '
+                             'instead of one cell call per frame')
+
     args = parser.parse_args()
 
     return args
@@ -111,7 +138,9 @@ def train(args):
 
     # Create the data loader object. This object would preprocess the data in terms of
     # batches each of size args.batch_size, of length args.seq_length
-    dataloader = DataLoader(f_prefix, args.batch_size, args.seq_length, args.num_validation, forcePreProcess=True)
+    dataloader = DataLoader(f_prefix, args.batch_size, args.seq_length, args.num_validation,
+                            preprocess_workers=args.preprocess_workers,
+                            preprocess_chunk_rows=args.preprocess_chunk_rows)
 
     method_name = "VANILLALSTM"
     model_name = "LSTM"
@@ -174,57 +203,41 @@ def train(args):
         dataloader.reset_batch_pointer(valid=False)
         loss_epoch = 0
 
+        # Sequences of the epoch in the order of next_batch, their dense tensors are built once. The batches are
+        # prepared in worker processes while the model trains if num_workers > 0
+        sequence_index = dataloader.get_sequence_index()
+        sequence_dataset = SequenceDataset(dataloader, sequence_index)
+        if args.bucket_boundaries:
+            # sequences with similar ped counts share a batch, full batches only
+            batches = sequence_index.bucket_batches(dataloader.batch_size, sequence_dataset.sequence_tensors.num_peds(),
+                                                    args.bucket_boundaries, drop_last=True)[:dataloader.num_batches]
+        else:
+            batches = sequence_index.batches(dataloader.batch_size, drop_last=True)[:dataloader.num_batches]
+        # padded batches if the sequences are forwarded at once
+        prepared_batches = prefetch_batches(sequence_dataset, batches, args.num_workers, args.prefetch,
+                                            collate=args.batched_forward)
+
         # For each batch
-        for batch in range(dataloader.num_batches):
+        for batch in range(len(batches)):
             start = time.time()
 
-            # Get batch data
-            x, y, d, numPedsList, PedsList, target_ids = dataloader.next_batch()
-            loss_batch = 0
-
-            # For each sequence
-            for sequence in range(dataloader.batch_size):
-                # Get the data corresponding to the current sequence
-                x_seq, _, d_seq, numPedsList_seq, PedsList_seq = x[sequence], y[sequence], d[sequence], numPedsList[
-                    sequence], PedsList[sequence]
-                target_id = target_ids[sequence]
-
-                # get processing file name and then get dimensions of file
-                folder_name = dataloader.get_directory_name_with_pointer(d_seq)
-                dataset_data = dataloader.get_dataset_dimension(folder_name)
-
-                # dense vector creation
-                x_seq, lookup_seq = dataloader.convert_proper_array(x_seq, numPedsList_seq, PedsList_seq)
-                # target_id_values = x_seq[0][lookup_seq[target_id], 0:2]
-
-                # vectorize trajectories in sequence
-                x_seq, _ = vectorize_seq(x_seq, PedsList_seq, lookup_seq)
-
-                if args.use_cuda:
-                    x_seq = x_seq.cuda()
-
-                # number of peds in this sequence per frame
-                numNodes = len(lookup_seq)
-
-                hidden_states = Variable(torch.zeros(numNodes, args.rnn_size))
-                if args.use_cuda:
-                    hidden_states = hidden_states.cuda()
-
-                cell_states = Variable(torch.zeros(numNodes, args.rnn_size))
+            if args.batched_forward:
+                # padded batch of the sequences, all of them forwarded at once
+                sequence_batch = next(prepared_batches)
                 if args.use_cuda:
-                    cell_states = cell_states.cuda()
+                    sequence_batch.to('cuda')
 
                 # Zero out gradients
                 net.zero_grad()
                 optimizer.zero_grad()
 
                 # Forward prop
-                outputs, _, _ = net(x_seq, hidden_states, cell_states, PedsList_seq, numPedsList_seq, dataloader,
-                                    lookup_seq)
+                forward_batch = net.forward_tracks if args.fused_rnn else net.forward_batch
+                outputs, _, _ = forward_batch(sequence_batch.relative, sequence_batch.mask)
 
-                # Compute loss
-                loss = Gaussian2DLikelihood(outputs, x_seq, PedsList_seq, lookup_seq)
-                loss_batch += loss.item()
+                # Compute loss, mean of the losses of the sequences
+                loss = Gaussian2DLikelihoodMasked(outputs, sequence_batch.relative, sequence_batch.mask).mean()
+                loss_batch = loss.item()
 
                 # Compute gradients
                 loss.backward()
@@ -234,9 +247,67 @@ def train(args):
 
                 # Update parameters
                 optimizer.step()
+            else:
+                # Get batch data
+                prepared_batch = next(prepared_batches)
+                loss_batch = 0
+
+                # For each sequence
+                for sequence in range(dataloader.batch_size):
+                    # Get the data corresponding to the current sequence
+                    prepared = prepared_batch[sequence]
+                    numPedsList_seq, PedsList_seq = prepared['numPedsList_seq'], prepared['PedsList_seq']
+
+                    # precomputed dense vector with vectorized trajectories
+                    x_seq, lookup_seq = prepared['vectorized_x_seq'], prepared['lookup_seq']
+
+                    if args.use_cuda:
+                        x_seq = x_seq.cuda()
+
+                    # number of peds in this sequence per frame
+                    numNodes = len(lookup_seq)
+
+                    hidden_states = Variable(torch.zeros(numNodes, args.rnn_size))
+                    if args.use_cuda:
+                        hidden_states = hidden_states.cuda()
+
+                    cell_states = Variable(torch.zeros(numNodes, args.rnn_size))
+                    if args.use_cuda:
+                        cell_states = cell_states.cuda()
+
+                    # Zero out gradients
+                    net.zero_grad()
+                    optimizer.zero_grad()
+
+                    # Forward prop
+                    if args.fused_rnn:
+                        # presence of the peds in each frame, the tracks of the fused rnn
+                        mask = torch.zeros(x_seq.size(0), numNodes, dtype=torch.bool, device=x_seq.device)
+                        for framenum, nodeIDs in enumerate(PedsList_seq):
+                            mask[framenum, [lookup_seq[int(nodeID)] for nodeID in nodeIDs]] = True
+                        outputs, _, _ = net.forward_tracks(x_seq.unsqueeze(0), mask.unsqueeze(0),
+                                                           hidden_states.unsqueeze(0), cell_states.unsqueeze(0))
+                        outputs = outputs[0]
+                    else:
+                        outputs, _, _ = net(x_seq, hidden_states, cell_states, PedsList_seq, numPedsList_seq,
+                                            dataloader, lookup_seq)
+
+                    # Compute loss
+                    loss = Gaussian2DLikelihood(outputs, x_seq, PedsList_seq, lookup_seq)
+                    loss_batch += loss.item()
+
+                    # Compute gradients
+                    loss.backward()
+
+                    # Clip gradients
+                    torch.nn.utils.clip_grad_norm_(net.parameters(), args.grad_clip)
+
+                    # Update parameters
+                    optimizer.step()
+
+                loss_batch = loss_batch / dataloader.batch_size
 
             end = time.time()
-            loss_batch = loss_batch / dataloader.batch_size
             loss_epoch += loss_batch
 
             print('{}/{} (epoch {}), train_loss = {:.3f}, time/batch = {:.3f}'.format(
@@ -245,7 +316,7 @@ def train(args):
                 epoch,
                 loss_batch, end - start))
 
-        loss_epoch /= dataloader.num_batches
+        loss_epoch /= len(batches)
         # Log loss values
         log_file_curve.write("Training epoch: " + str(epoch) + " loss: " + str(loss_epoch) + '\n')
 
@@ -253,14 +324,20 @@ def train(args):
             print('****************Validation epoch beginning******************')
 
             # Validation
-            dataloader.reset_batch_pointer(valid=True)
+            # same sequences as next_valid_batch, prepared by the workers
+            valid_sequence_index = dataloader.get_sequence_index(valid=True)
+            valid_sequence_dataset = SequenceDataset(dataloader, valid_sequence_index, valid=True)
+            valid_batches = valid_sequence_index.batches(dataloader.batch_size, drop_last=True)[
+                :dataloader.valid_num_batches]
+            prepared_batches = prefetch_batches(valid_sequence_dataset, valid_batches, args.num_workers,
+                                                args.prefetch)
             loss_epoch = 0
             err_epoch = 0
 
             # For each batch
             for batch in range(dataloader.valid_num_batches):
                 # Get batch data
-                x, y, d, numPedsList, PedsList, target_ids = dataloader.next_valid_batch()
+                prepared_batch = next(prepared_batches)
 
                 # Loss for this batch
                 loss_batch = 0
@@ -268,22 +345,10 @@ def train(args):
 
                 # For each sequence
                 for sequence in range(dataloader.batch_size):
-                    # Get data corresponding to the current sequence
-                    x_seq, _, d_seq, numPedsList_seq, PedsList_seq = x[sequence], y[sequence], d[sequence], numPedsList[
-                        sequence], PedsList[sequence]
-                    target_id = target_ids[sequence]
-
-                    # get processing file name and then get dimensions of file
-                    folder_name = dataloader.get_directory_name_with_pointer(d_seq)
-                    dataset_data = dataloader.get_dataset_dimension(folder_name)
-
-                    # dense vector creation
-                    x_seq, lookup_seq = dataloader.convert_proper_array(x_seq, numPedsList_seq, PedsList_seq)
-
-                    target_id_values = x_seq[0][lookup_seq[target_id], 0:2]
-
-                    # vectorize seq
-                    x_seq, first_values_dict = vectorize_seq(x_seq, PedsList_seq, lookup_seq)
+                    # Get data corresponding to the current sequence (dense and vectorized)
+                    prepared = prepared_batch[sequence]
+                    x_seq, lookup_seq = prepared['vectorized_x_seq'], prepared['lookup_seq']
+                    numPedsList_seq, PedsList_seq = prepared['numPedsList_seq'], prepared['PedsList_seq']
 
                     if args.use_cuda:
                         x_seq = x_seq.cuda()
@@ -348,6 +413,13 @@ def train(args):
             print('****************Validation with dataset epoch beginning******************')
             dataloader.reset_batch_pointer(valid=False)
             dataset_pointer_ins = dataloader.dataset_pointer
+            # same sequences as next_batch, prepared by the workers
+            validation_sequence_index = dataloader.get_sequence_index()
+            validation_sequence_dataset = SequenceDataset(dataloader, validation_sequence_index)
+            validation_batches = validation_sequence_index.batches(dataloader.batch_size, drop_last=True)[
+                :dataloader.num_batches]
+            prepared_batches = prefetch_batches(validation_sequence_dataset, validation_batches, args.num_workers,
+                                                args.prefetch)
             validation_dataset_executed = True
 
             loss_epoch = 0
@@ -364,7 +436,8 @@ def train(args):
             # For each batch
             for batch in range(dataloader.num_batches):
                 # Get batch data
-                x, y, d, numPedsList, PedsList, target_ids = dataloader.next_batch()
+                prepared_batch = next(prepared_batches)
+                dataloader.dataset_pointer = prepared_batch[-1]['dataset']
 
                 if dataset_pointer_ins is not dataloader.dataset_pointer:
                     if dataloader.dataset_pointer != 0:
@@ -384,16 +457,12 @@ def train(args):
                 # For each sequence
                 for sequence in range(dataloader.batch_size):
                     # Get data corresponding to the current sequence
-                    x_seq, _, d_seq, numPedsList_seq, PedsList_seq = x[sequence], y[sequence], d[sequence], numPedsList[
-                        sequence], PedsList[sequence]
-                    target_id = target_ids[sequence]
-
-                    # get processing file name and then get dimensions of file
-                    folder_name = dataloader.get_directory_name_with_pointer(d_seq)
-                    dataset_data = dataloader.get_dataset_dimension(folder_name)
+                    prepared = prepared_batch[sequence]
+                    numPedsList_seq, PedsList_seq = prepared['numPedsList_seq'], prepared['PedsList_seq']
+                    target_id = prepared['target_id']
 
                     # dense vector creation
-                    x_seq, lookup_seq = dataloader.convert_proper_array(x_seq, numPedsList_seq, PedsList_seq)
+                    x_seq, lookup_seq = prepared['x_seq'], prepared['lookup_seq']
 
                     # will be used for error calculation
                     orig_x_seq = x_seq.clone()
@@ -401,8 +470,8 @@ def train(args):
                     # TODO: I commented this line below. Check what is for
                     # target_id_values = orig_x_seq[0][lookup_seq[target_id], 0:2]
 
-                    # vectorize datapoints
-                    x_seq, first_values_dict = vectorize_seq(x_seq, PedsList_seq, lookup_seq)
+                    # vectorized datapoints
+                    x_seq, first_values_dict = prepared['vectorized_x_seq'], prepared['first_values_dict']
 
                     if args.use_cuda:
                         x_seq = x_seq.cuda()
@@ -424,7 +493,7 @@ def train(args):
                           sequence + 1, ' Sequence mean error: ', err, ' Sequence final error: ', f_err, ' time: ',
                           end - start)
                     results.append((orig_x_seq.data.cpu().numpy(), ret_x_seq.data.cpu().numpy(), PedsList_seq,
-                                    lookup_seq, dataloader.get_frame_sequence(args.seq_length), target_id))
+                                    lookup_seq, prepared['frame_numbers'], target_id))
 
                 loss_batch = loss_batch / dataloader.batch_size
                 err_batch = err_batch / dataloader.batch_size